@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+import argparse
+import sys
+import os
+import csv
+csv.field_size_limit(sys.maxsize)
+partis_dir = os.path.dirname(os.path.realpath(__file__)).replace('/bin', '')
+if not os.path.exists(partis_dir):
+    print 'WARNING current script dir %s doesn\'t exist, so python path may not be correctly set' % partis_dir
+sys.path.insert(1, partis_dir + '/python')
+import partitioncache
+from partitioncache import PartitionCache
+
+parser = argparse.ArgumentParser(description='Compact a partition cache file (e.g. from --persistent-cachefname), merging the lines for each set of uids into one line (so no logprobs or naive seqs are lost) and, optionally, evicting entries that are no longer useful. Holds an exclusive lock on the cache file while it works, so it\'s safe to run while partis jobs are using the same file.')
+parser.add_argument('cachefname')
+parser.add_argument('--keep-uids-from', help='colon-separated list of files (fasta/fastq, or csv with either a \'unique_id\', \'unique_ids\', or \'partition\' column) from which to read the uids that are still in use. Entries including any other uid are evicted.')
+parser.add_argument('--max-cluster-size', type=int, help='evict entries for uid sets larger than this')
+parser.add_argument('--dry-run', action='store_true', help='just print what would be evicted')
+args = parser.parse_args()
+
+# ----------------------------------------------------------------------------------------
+def read_uids(fname):
+    uids = set()
+    if os.path.splitext(fname)[1] in ['.fa', '.fasta', '.fq', '.fastq']:
+        with open(fname) as seqfile:
+            header_char = '>' if os.path.splitext(fname)[1] in ['.fa', '.fasta'] else '@'
+            for line in seqfile:
+                if line[0] == header_char:
+                    uids.add(line[1:].split()[0])
+    else:
+        with open(fname) as csvfile:
+            reader = csv.DictReader(csvfile)
+            for line in reader:
+                if 'partition' in line:
+                    uids |= set([uid for cluster_str in line['partition'].split(';') for uid in cluster_str.split(':')])
+                elif 'unique_ids' in line:
+                    uids |= set(line['unique_ids'].split(':'))
+                elif 'unique_id' in line:
+                    uids.add(line['unique_id'])
+                else:
+                    raise Exception('couldn\'t find uid column in %s' % fname)
+    print '  read %d uids from %s' % (len(uids), fname)
+    return uids
+
+keep_uids = None
+if args.keep_uids_from is not None:
+    keep_uids = set()
+    for fname in args.keep_uids_from.split(':'):
+        keep_uids |= read_uids(fname)
+
+# ----------------------------------------------------------------------------------------
+def keep(key):
+    uids = key.split(':')
+    if args.max_cluster_size is not None and len(uids) > args.max_cluster_size:
+        return False
+    if keep_uids is not None and not all([uid in keep_uids for uid in uids]):
+        return False
+    return True
+
+lockfile = partitioncache.lock(args.cachefname)
+cache = PartitionCache(args.cachefname)
+n_to_evict = len([key for key in cache.offsets if not keep(key)])
+print '  %d entries in %s, %d to be evicted' % (len(cache), args.cachefname, n_to_evict)
+if not args.dry_run:
+    cache.compact(keep_fcn=keep, debug=True)
+lockfile.close()
@@ -5,11 +5,15 @@
 #include <fstream>
 #include <cassert>
 #include <ctime>
+#include <algorithm>
 
 #include <text.h>
 #include "tclap/CmdLine.h"
 using namespace TCLAP;
 using namespace std;
+
+#define WORKER_DONE_STR "bcrham worker: done"  // written to stdout after each job in --worker mode
+
 namespace ham {
 // ----------------------------------------------------------------------------------------
 // input processing class
@@ -22,6 +26,7 @@ public:
   string hmmdir() { return hmmdir_arg_.getValue(); }
   string datadir() { return datadir_arg_.getValue(); }
   string infile() { return infile_arg_.getValue(); }
+  string seqfile() { return seqfile_arg_.getValue(); }
   string outfile() { return outfile_arg_.getValue(); }
   string annotationfile() { return annotationfile_arg_.getValue(); }
   string cachefile() { return cachefile_arg_.getValue(); }
@@ -47,17 +52,18 @@ public:
   bool cache_naive_hfracs() { return cache_naive_hfracs_arg_.getValue(); }
   bool only_cache_new_vals() { return only_cache_new_vals_arg_.getValue(); }
   bool write_logprob_for_each_partition() { return write_logprob_for_each_partition_arg_.getValue(); }
+  bool worker() { return worker_arg_.getValue(); }
  
   // command line arguments
   vector<string> algo_strings_;
   vector<int> debug_ints_;
   ValuesConstraint<string> algo_vals_;
   ValuesConstraint<int> debug_vals_;
-  ValueArg<string> hmmdir_arg_, datadir_arg_, infile_arg_, outfile_arg_, annotationfile_arg_, cachefile_arg_, chain_arg_, algorithm_arg_, ambig_base_arg_, seed_unique_id_arg_;
+  ValueArg<string> hmmdir_arg_, datadir_arg_, infile_arg_, seqfile_arg_, outfile_arg_, annotationfile_arg_, cachefile_arg_, chain_arg_, algorithm_arg_, ambig_base_arg_, seed_unique_id_arg_;
   ValueArg<float> hamming_fraction_bound_lo_arg_, hamming_fraction_bound_hi_arg_, logprob_ratio_threshold_arg_, max_logprob_drop_arg_;
   ValueArg<int> debug_arg_, smc_particles_arg_, naive_hamming_cluster_arg_, biggest_naive_seq_cluster_to_calculate_arg_, biggest_logprob_cluster_to_calculate_arg_, n_partitions_to_write_arg_;
   ValueArg<unsigned> random_seed_arg_;
-  SwitchArg no_chunk_cache_arg_, partition_arg_, dont_rescale_emissions_arg_, cache_naive_seqs_arg_, cache_naive_hfracs_arg_, only_cache_new_vals_arg_, write_logprob_for_each_partition_arg_;
+  SwitchArg no_chunk_cache_arg_, partition_arg_, dont_rescale_emissions_arg_, cache_naive_seqs_arg_, cache_naive_hfracs_arg_, only_cache_new_vals_arg_, write_logprob_for_each_partition_arg_, worker_arg_;
 
   // arguments read from csv input file
   map<string, vector<string> > strings_;
@@ -2,6 +2,24 @@
 
 namespace ham {
 
+// ----------------------------------------------------------------------------------------
+// read the name and sequence on each line of (whitespace-separated) <fname>, keeping them around so a worker only reads each file once
+map<string, string> &GetSeqTable(string fname) {
+  static map<string, map<string, string> > seq_tables;
+  if(seq_tables.count(fname) == 0) {
+    ifstream ifs(fname);
+    if(!ifs.is_open())
+      throw runtime_error("args.cc: sequence file '" + fname + "' d.n.e.\n");
+    string line;
+    getline(ifs, line);  // header
+    map<string, string> &seq_table(seq_tables[fname]);
+    string name, seq;
+    while(ifs >> name >> seq)
+      seq_table[name] = seq;
+  }
+  return seq_tables[fname];
+}
+
 // ----------------------------------------------------------------------------------------
 Args::Args(int argc, const char * argv[]):
   algo_strings_ {"viterbi", "forward"},
@@ -11,6 +29,7 @@ Args::Args(int argc, const char * argv[]):
   hmmdir_arg_("", "hmmdir", "directory in which to look for hmm model files", true, "", "string"),
   datadir_arg_("", "datadir", "directory in which to look for non-sample-specific data (eg human germline seqs)", true, "", "string"),
   infile_arg_("", "infile", "input (whitespace-separated) file", true, "", "string"),
+  seqfile_arg_("", "seqfile", "(whitespace-separated) file with a name and a sequence on each line (after a header), from which we get the sequences if the input file has no seqs column. NOTE workers only read each file once, so it can't change while they're running", false, "", "string"),
   outfile_arg_("", "outfile", "output csv file", true, "", "string"),
   annotationfile_arg_("", "annotationfile", "if specified, write annotations for each cluster to here", false, "", "string"),
   cachefile_arg_("", "cachefile", "input (and output) cache log prob csv file", false, "", "string"),
@@ -36,6 +55,7 @@ Args::Args(int argc, const char * argv[]):
   cache_naive_hfracs_arg_("", "cache-naive-hfracs", "cache naive hamming fraction between sequence sets (in addition to log probs and naive seqs)", false),
   only_cache_new_vals_arg_("", "only-cache-new-vals", "only write sequence sets with newly-calculated values to cache file", false),
   write_logprob_for_each_partition_arg_("", "write-logprob-for-each-partition", "By default, we don't know the total logprob of each partition (since many merges are by naive hfrac). This argument tells us that this is the last time through (with one process) and we want to know the total probability of each partition.", false),
+  worker_arg_("", "worker", "after running the job on the command line, keep the hmms in memory and read the arguments for each subsequent job (with the same hmmdir, datadir, chain, and ambig-base) from a line on stdin, writing '" + string(WORKER_DONE_STR) + "' to stdout after each job", false),
   str_headers_ {},
   int_headers_ {"k_v_min", "k_v_max", "k_d_min", "k_d_max", "cdr3_length"},
   float_headers_ {"mut_freq"},
@@ -48,6 +68,7 @@ Args::Args(int argc, const char * argv[]):
     cmd.add(hmmdir_arg_);
     cmd.add(datadir_arg_);
     cmd.add(infile_arg_);
+    cmd.add(seqfile_arg_);
     cmd.add(outfile_arg_);
     cmd.add(annotationfile_arg_);
     cmd.add(cachefile_arg_);
@@ -73,6 +94,7 @@ Args::Args(int argc, const char * argv[]):
     cmd.add(write_logprob_for_each_partition_arg_);
     cmd.add(partition_arg_);
     cmd.add(dont_rescale_emissions_arg_);
+    cmd.add(worker_arg_);
 
     cmd.parse(argc, argv);
 
@@ -137,6 +159,19 @@ Args::Args(int argc, const char * argv[]):
     }
   }
 
+  if(seqfile() != "" && find(headers.begin(), headers.end(), "seqs") == headers.end()) {  // look up each name's sequence in the sequence file
+    map<string, string> &seq_table(GetSeqTable(seqfile()));
+    for(auto &names : str_lists_["names"]) {
+      vector<string> seqs;
+      for(auto &name : names) {
+        if(seq_table.count(name) == 0)
+          throw runtime_error("args.cc: " + name + " not in sequence file " + seqfile());
+        seqs.push_back(seq_table[name]);
+      }
+      str_lists_["seqs"].push_back(seqs);
+    }
+  }
+
   // Check();
 }
 
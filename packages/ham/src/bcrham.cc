@@ -8,6 +8,7 @@
 #include <ctime>
 #include <fstream>
 #include <cfenv>
+#include <sstream>
 
 #include "dphandler.h"
 #include "bcrutils.h"
@@ -22,21 +23,45 @@ using namespace std;
 
 // ----------------------------------------------------------------------------------------
 vector<vector<Sequence> > GetSeqs(Args &args, Track *trk);
+void run_job(HMMHolder &hmms, GermLines &gl, Track &track, Args &args);
 void run_algorithm(HMMHolder &hmms, GermLines &gl, vector<vector<Sequence> > &qry_seq_list, Args &args);
+Args *read_next_job(Args &first_args);
 
 // ----------------------------------------------------------------------------------------
 int main(int argc, const char * argv[]) {
-  clock_t run_start(clock());
   Args args(argc, argv);
-  if(args.smc_particles() > 1)
-    assert(0);  // see commented code below
-  srand(args.random_seed());
 
   // init some infrastructure
   vector<string> characters {"A", "C", "G", "T"};
   Track track("NUKES", characters, args.ambig_base());
   GermLines gl(args.datadir(), args.chain());
   HMMHolder hmms(args.hmmdir(), gl, &track);
+
+  run_job(hmms, gl, track, args);
+  if(!args.worker())
+    return 0;
+
+  // in worker mode, hang around and run more jobs (which reuses the germline info and the hmms we've already read) until stdin closes
+  cout << WORKER_DONE_STR << endl;
+  while(true) {
+    Args *job_args = read_next_job(args);
+    if(job_args == nullptr)
+      break;
+    run_job(hmms, gl, track, *job_args);
+    delete job_args;
+    cerr << flush;
+    cout << WORKER_DONE_STR << endl;
+  }
+  return 0;
+}
+
+// ----------------------------------------------------------------------------------------
+void run_job(HMMHolder &hmms, GermLines &gl, Track &track, Args &args) {
+  clock_t run_start(clock());
+  if(args.smc_particles() > 1)
+    assert(0);  // see commented code below
+  srand(args.random_seed());
+
   vector<vector<Sequence> > qry_seq_list(GetSeqs(args, &track));
 
   if(args.cache_naive_seqs()) {
@@ -50,7 +75,31 @@ int main(int argc, const char * argv[]) {
   }
 
   printf("        time: bcrham %.1f\n", ((clock() - run_start) / (double)CLOCKS_PER_SEC));
-  return 0;
+  fflush(stdout);
+}
+
+// ----------------------------------------------------------------------------------------
+// read the (whitespace-separated) arguments for the next job from a line on stdin, returning nullptr when there aren't any more
+Args *read_next_job(Args &first_args) {
+  string line;
+  do {
+    if(!getline(cin, line))
+      return nullptr;
+  } while(line.find_first_not_of(" \t") == string::npos);
+
+  vector<string> argstrs {"bcrham"};
+  stringstream ss(line);
+  string argstr;
+  while(ss >> argstr)
+    argstrs.push_back(argstr);
+  vector<const char*> argv;
+  for(auto &astr : argstrs)
+    argv.push_back(astr.c_str());
+
+  Args *job_args = new Args(argv.size(), argv.data());
+  if(job_args->hmmdir() != first_args.hmmdir() || job_args->datadir() != first_args.datadir() || job_args->chain() != first_args.chain() || job_args->ambig_base() != first_args.ambig_base())
+    throw runtime_error("worker jobs have to use the same --hmmdir, --datadir, --chain, and --ambig-base as the first job");
+  return job_args;
 }
 
 // ----------------------------------------------------------------------------------------
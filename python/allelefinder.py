@@ -72,6 +72,7 @@ class AlleleFinder(object):
 
         self.reflengths = {}
         self.alleles_with_evidence = set()
+        self.germline_seqs, self.query_seqs = {}, {}  # per-gene (trimmed) germline sequence, and list of (trimmed) query sequences, which we collect in increment() and count in count_mutations()
 
     # ----------------------------------------------------------------------------------------
     def init_gene(self, gene):
@@ -85,6 +86,7 @@ class AlleleFinder(object):
         for side in self.n_big_del_skipped:
             self.n_big_del_skipped[side][gene] = 0
         self.n_seqs_too_highly_mutated[gene] = 0
+        self.query_seqs[gene] = []
 
     # ----------------------------------------------------------------------------------------
     def set_excluded_bases(self, swfo, debug=False):
@@ -149,8 +151,7 @@ class AlleleFinder(object):
             self.reflengths[gene] = len(query_seq)
         assert self.reflengths[gene] == len(query_seq)  # just an internal consistency check now -- they should all be identical
 
-        n_mutes = utils.hamming_distance(germline_seq, query_seq)
-        return n_mutes, germline_seq, query_seq
+        return germline_seq, query_seq
 
     # ----------------------------------------------------------------------------------------
     def increment(self, info):
@@ -160,7 +161,6 @@ class AlleleFinder(object):
                 continue
             if gene not in self.counts:
                 self.init_gene(gene)
-            gcts = self.counts[gene]  # shorthand name
 
             self.gene_obs_counts[gene] += 1
 
@@ -173,27 +173,40 @@ class AlleleFinder(object):
             if skip_this:
                 continue
 
-            n_mutes, germline_seq, query_seq = self.get_seqs(info, region, gene)  # NOTE no longer necessarily correspond to <info>
-            if n_mutes == 0:
-                self.unmutated_gene_obs_counts[gene] += 1
-
-            # i.e. do *not* use <info> after this point
-
-            if n_mutes > self.args.n_max_mutations_per_segment:
-                self.n_seqs_too_highly_mutated[gene] += 1
-                continue
-
+            germline_seq, query_seq = self.get_seqs(info, region, gene)  # NOTE no longer necessarily correspond to <info>
             assert len(germline_seq) == len(self.glfo['seqs'][region][gene]) - self.n_bases_to_exclude['5p'][gene] - self.n_bases_to_exclude['3p'][gene]
-            for ipos in range(len(germline_seq)):
-                igl = ipos + self.n_bases_to_exclude['5p'][gene]  # position in original (i.e. complete) germline gene
+            if gene not in self.germline_seqs:
+                self.germline_seqs[gene] = germline_seq
+            assert germline_seq == self.germline_seqs[gene]  # once we've trimmed off the deletions and excluded bases, the germline sequence is the same for every query
+            self.query_seqs[gene].append(query_seq)
 
-                if germline_seq[ipos] in utils.ambiguous_bases or query_seq[ipos] in utils.ambiguous_bases:  # skip if either germline or query sequence is ambiguous at this position
-                    continue
-
-                gcts[igl][n_mutes]['total'] += 1
-                if query_seq[ipos] != germline_seq[ipos]:  # if this position is mutated
-                    gcts[igl][n_mutes]['muted'] += 1  # mark that we saw this germline position mutated once in a sequence with <n_mutes> regional mutation frequency
-                gcts[igl][n_mutes][query_seq[ipos]] += 1  # if there's a new allele, we need this to work out what the snp'd base is
+    # ----------------------------------------------------------------------------------------
+    def count_mutations(self):
+        """ fill in <self.counts> from the sequences we collected in increment(), doing all of each gene's sequences at once (they're all the same length) """
+        for gene, query_seqs in self.query_seqs.items():
+            if len(query_seqs) == 0:
+                continue
+            gcts = self.counts[gene]  # shorthand name
+            germline_seq = utils.encode_seqs([self.germline_seqs[gene], ])[0]
+            query_seqs = utils.encode_seqs(query_seqs)
+            n_mutes, _ = utils.hamming_distances(germline_seq, query_seqs)
+            self.unmutated_gene_obs_counts[gene] += int((n_mutes == 0).sum())
+
+            too_highly_mutated = n_mutes > self.args.n_max_mutations_per_segment
+            self.n_seqs_too_highly_mutated[gene] += int(too_highly_mutated.sum())
+            query_seqs, n_mutes = query_seqs[~too_highly_mutated], n_mutes[~too_highly_mutated]
+
+            unambiguous = ~(utils.ambiguous_base_table[germline_seq] | utils.ambiguous_base_table[query_seqs])  # skip positions where either germline or query sequence is ambiguous
+            muted = (query_seqs != germline_seq) & unambiguous
+            for n_mutes_val in numpy.unique(n_mutes).tolist():
+                irows = n_mutes == n_mutes_val
+                counts = {'total' : unambiguous[irows].sum(axis=0), 'muted' : muted[irows].sum(axis=0)}  # number of sequences with <n_mutes_val> mutations in which we saw each position, and in which it was mutated
+                for nuke in utils.nukes:  # if there's a new allele, we need these to work out what the snp'd base is
+                    counts[nuke] = ((query_seqs[irows] == ord(nuke)) & unambiguous[irows]).sum(axis=0)
+                for ipos in range(len(germline_seq)):
+                    igl = ipos + self.n_bases_to_exclude['5p'][gene]  # position in original (i.e. complete) germline gene
+                    for key in counts:
+                        gcts[igl][n_mutes_val][key] += int(counts[key][ipos])
 
     # ----------------------------------------------------------------------------------------
     def get_residual_sum(self, xvals, yvals, errs, slope, intercept):
@@ -627,6 +640,7 @@ class AlleleFinder(object):
         assert not self.finalized
 
         start = time.time()
+        self.count_mutations()
         self.xyvals = {}
         self.positions_to_plot = {gene : set() for gene in self.counts}
         print '%s: looking for new alleles' % utils.color('blue', 'try ' + str(self.itry))
@@ -80,17 +80,18 @@ class AlleleRemover(object):
 
         # don't keep it if it's pretty close to a gene we already have
         nearest_gene, nearest_hdist = None, None
-        for kgene in self.genes_to_keep:
-            kseq = glseqs[kgene][:codon_positions[kgene] + 3]
-            if len(kseq) != len(this_seq):
-                continue
-            hdist = utils.hamming_distance(kseq, this_seq)
-            if nearest_hdist is None or hdist < nearest_hdist:
-                nearest_hdist = hdist
-                nearest_gene = kgene
-            if hdist < self.args.n_max_snps - 1:
-                self.dbg_strings[this_gene] = 'too close (%d < %d) to %s' % (hdist, self.args.n_max_snps - 1, kgene)
-                return False
+        kseqs = [(kgene, glseqs[kgene][:codon_positions[kgene] + 3]) for kgene in self.genes_to_keep]
+        kseqs = [(kgene, kseq) for kgene, kseq in kseqs if len(kseq) == len(this_seq)]
+        if len(kseqs) > 0:
+            kgenes = [kgene for kgene, _ in kseqs]
+            hdists, _ = utils.hamming_distances(this_seq, [kseq for _, kseq in kseqs])
+            hdists = hdists.tolist()
+            for kgene, hdist in zip(kgenes, hdists):
+                if hdist < self.args.n_max_snps - 1:
+                    self.dbg_strings[this_gene] = 'too close (%d < %d) to %s' % (hdist, self.args.n_max_snps - 1, kgene)
+                    return False
+            nearest_hdist = min(hdists)
+            nearest_gene = kgenes[hdists.index(nearest_hdist)]
 
         if easycounts[this_gene] < self.alfinder.n_total_min:  # if we hardly ever saw it, there's no good reason to believe it wasn't the result of just mutational wandering
             self.dbg_strings[this_gene] = 'not enough counts (%d < %d)' % (easycounts[this_gene], self.alfinder.n_total_min)
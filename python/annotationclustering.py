@@ -43,25 +43,18 @@ def vollmers(info, threshold, reco_info=None, debug=False):
         return cdr3_seq
 
     def from_same_lineage(cluster_id, uid):
-        for clid in id_clusters[cluster_id]:  # loop over seqs already in the cluster (it only has to match one of 'em)
-            is_match = True
-            for key in ('cdr3_length', 'v_gene', 'j_gene'):  # same cdr3 length, v gene, and j gene
-                if info[clid][key] != info[uid][key]:
-                    is_match = False
-                    break
-            if not is_match:
+        u_seq = get_d_plus_insertions(uid)
+        cl_seqs = []  # seqs already in the cluster with the same cdr3 length, v gene, and j gene, and the same length d + insertions (it only has to match one of 'em)
+        for clid in id_clusters[cluster_id]:
+            if any([info[clid][key] != info[uid][key] for key in ('cdr3_length', 'v_gene', 'j_gene')]):
                 continue
             cl_seq = get_d_plus_insertions(clid)
-            u_seq = get_d_plus_insertions(uid)
             if len(cl_seq) != len(u_seq):
                 continue
-            hamming_frac = utils.hamming_fraction(cl_seq, u_seq)
-            if hamming_frac > 1. - threshold:
-                continue
-
-            return True  # if we get to here, it's a match
-
-        return False
+            cl_seqs.append(cl_seq)
+        if len(cl_seqs) == 0:
+            return False
+        return min(utils.hamming_fractions(u_seq, cl_seqs)) <= 1. - threshold
 
     def check_unclustered_seqs():
         """ loop through all unclustered sequences, adding them to the most recently created cluster """
@@ -4,6 +4,8 @@ import sys
 import math
 import csv
 import time
+import heapq
+import numpy
 
 import utils
 from opener import opener
@@ -18,97 +20,72 @@ class Glomerator(object):
         self.seed_unique_id = seed_unique_id
 
     # ----------------------------------------------------------------------------------------
-    def naive_seq_glomerate(self, naive_seqs, n_clusters, debug=False):
-        """ Perform hierarchical agglomeration (with naive hamming distance as the distance), stopping at <n_clusters> """
+    def naive_seq_glomerate(self, naive_seqs, n_clusters, threshold=0.1, costs=None, debug=False):
+        """
+        Divide the names in <naive_seqs> into <n_clusters> groups of roughly equal total cost (<costs> defaults to one for each name), such that names whose naive sequences are within hamming fraction <threshold> of each other tend to end up in the same group.
+        Each name is first assigned to a 'leader' (the first name we saw in its neighborhood), where we only calculate hamming fractions to the leaders with which it shares identical sequence chunks (all at once, and taking
+        the one with the most shared chunks that's within <threshold>), so this is roughly linear in the number of names.
+        Leader groups that cost more than one group's share are split, and then leader groups are packed (most expensive first) into whichever group is currently cheapest.
+        """
         start = time.time()
-        clusters = [[names,] for names in naive_seqs.keys()]
+        if costs is None:
+            costs = {name : 1. for name in naive_seqs}
+
+        n_chunks = 8
+        max_leaders_per_chunk = 20  # chunks from unmutated germline regions are shared by lots of leaders, so we only keep track of the first few (the informative chunks are the ones around the cdr3)
+        leader_groups = []  # list of lists of names, where the first name in each is the leader
+        leader_seqs = []  # encoded naive sequence of each leader
+        chunk_leaders = {}  # map from (chunk index, chunk string) to indices in <leader_groups>
+        for name, seq in naive_seqs.items():
+            chunklen = int(math.ceil(float(len(seq)) / n_chunks))
+            chunks = [(ichunk, seq[ichunk * chunklen : (ichunk + 1) * chunklen]) for ichunk in range(n_chunks)]
+            chunks = [chunk for chunk in chunks if len(chunk[1]) > 0 and utils.ambiguous_bases[0] not in chunk[1]]  # padding differs between queries, so chunks with ambiguous bases don't tell us anything
+            n_shared = {}  # number of chunks we share with each leader
+            for chunk in chunks:
+                for ileader in chunk_leaders.get(chunk, []):
+                    n_shared[ileader] = n_shared.get(ileader, 0) + 1
+            ibest = None
+            candidates = sorted([il for il in n_shared if len(leader_seqs[il]) == len(seq)], key=lambda il: (-n_shared[il], il))  # most shared chunks first, and ties go to the earliest leader
+            if len(candidates) > 0:
+                hfracs = utils.hamming_fractions(seq, numpy.array([leader_seqs[il] for il in candidates]))
+                close_candidates = [il for il, hfrac in zip(candidates, hfracs) if hfrac <= threshold]
+                if len(close_candidates) > 0:
+                    ibest = close_candidates[0]
+            if ibest is None:  # start a new leader group
+                ibest = len(leader_groups)
+                leader_groups.append([])
+                leader_seqs.append(utils.encode_seqs([seq, ])[0])
+                for chunk in chunks:
+                    if chunk not in chunk_leaders:
+                        chunk_leaders[chunk] = []
+                    if len(chunk_leaders[chunk]) < max_leaders_per_chunk:
+                        chunk_leaders[chunk].append(ibest)
+            leader_groups[ibest].append(name)
+
+        # split any leader groups that are too expensive
+        share = sum([costs[name] for name in naive_seqs]) / n_clusters
+        pieces = []  # list of (cost, names)
+        for group in leader_groups:
+            piece, piece_cost = [], 0.
+            for name in group:
+                if len(piece) > 0 and piece_cost + costs[name] > share:
+                    pieces.append((piece_cost, piece))
+                    piece, piece_cost = [], 0.
+                piece.append(name)
+                piece_cost += costs[name]
+            pieces.append((piece_cost, piece))
+
+        # and pack them into <n_clusters> groups
+        clusters = [[] for _ in range(n_clusters)]
+        loads = [(0., iclust) for iclust in range(n_clusters)]  # heap of (total cost, cluster index)
+        for piece_cost, piece in sorted(pieces, key=lambda p: p[0], reverse=True):
+            load, iclust = heapq.heappop(loads)
+            clusters[iclust] += piece
+            heapq.heappush(loads, (load + piece_cost, iclust))
 
-        seqs_per_cluster = float(len(clusters)) / n_clusters
-        max_per_cluster = int(math.ceil(seqs_per_cluster))
         if debug:
-            print '  max %d per cluster' % max_per_cluster
-
-        distances = {}  # cache the calculated fractional hamming distances
-
-        # ----------------------------------------------------------------------------------------
-        def get_clusters_to_merge():
-            smallest_min_distance, clusters_to_merge = None, None
-            n_skipped = 0
-            for clust_a, clust_b in itertools.combinations(clusters, 2):  # find the two clusters which contain the pair of sequences which are closest in hamming fraction (skipping cluster pairs that would make a cluster that's too big)
-                if len(clust_a) + len(clust_b) > max_per_cluster and not glomerate.merge_whatever_you_got:  # merged cluster would be too big, so look for smaller (albeit further-apart) things to merge
-                    n_skipped += 1
-                    continue
-                min_distance = None  # find the smallest hamming distance between any two sequences in the two clusters
-                for query_a in clust_a:
-                    for query_b in clust_b:
-                        joint_key = query_a + ';' + query_b  #';'.join([query_a, query_b])
-                        if joint_key not in distances:
-                            distances[joint_key] = utils.hamming_fraction(naive_seqs[query_a], naive_seqs[query_b])
-                            distances[query_b + ';' + query_a] = distances[joint_key]  # also add with key in reverse order, in case we run into the pair that way later on
-                        if min_distance is None or distances[joint_key] < min_distance:
-                            min_distance = distances[joint_key]
-                if smallest_min_distance is None or min_distance < smallest_min_distance:
-                    smallest_min_distance = min_distance
-                    clusters_to_merge = (clust_a, clust_b)
-
-            if debug and n_skipped > 0:
-                print '      skipped: %d ' % n_skipped
-
-            return clusters_to_merge
-
-        # ----------------------------------------------------------------------------------------
-        def glomerate():
-            if debug:
-                print '    current ', ' '.join([str(len(cl)) for cl in clusters])
-            clusters_to_merge = get_clusters_to_merge()
-            if clusters_to_merge is None:  # if we didn't find a suitable pair
-                if debug:
-                    print '    didn\'t find shiznitz'
-                glomerate.merge_whatever_you_got = True  # next time through, merge whatever's best regardless of size
-            else:
-                if debug:
-                    print '    merging', len(clusters_to_merge[0]), len(clusters_to_merge[1])
-                clusters.append(clusters_to_merge[0] + clusters_to_merge[1])
-                clusters.remove(clusters_to_merge[0])
-                clusters.remove(clusters_to_merge[1])
-
-        # ----------------------------------------------------------------------------------------
-        def homogenize():
-            """ roughly equalize the cluster sizes """
-            if debug:
-                print '  homogenizing', len(clusters[0]), len(clusters[-1])  #, len(clusters[-1]) / 3.
-                print '    before ', ' '.join([str(len(cl)) for cl in clusters])
-
-            # move enough items from the end of the biggest cluster to the end of the smallest cluster that their sizes are equal (well, within one of each other, with the last cluster allowed to stay one bigger)
-            n_to_keep_in_biggest_cluster = int(math.ceil(float(len(clusters[0]) + len(clusters[-1])) / 2))
-            clusters[0] = clusters[0] + clusters[-1][n_to_keep_in_biggest_cluster : ]
-            clusters[-1] = clusters[-1][ : n_to_keep_in_biggest_cluster]
-            if debug:
-                print '    after  ', ' '.join([str(len(cl)) for cl in clusters])
-            clusters.sort(key=len)
-            if debug:
-                print '    sorted ', ' '.join([str(len(cl)) for cl in clusters])
-
-        # ----------------------------------------------------------------------------------------
-        # da bizniz
-        glomerate.merge_whatever_you_got = False  # merge the best pair, even if together they'll be to big
-
-        while len(clusters) > n_clusters:
-            glomerate()
-        
-        if len(clusters) > 1:  # homogenize if partition is non-trivial
-            clusters.sort(key=len)
-
-            itries = 0
-            # while len(clusters[0]) < 2./3 * len(clusters[-1]):  # and len(clusters[-1]) - len(clusters[0]) > 2:  # keep homogenizing while biggest cluster is more than 3/2 the size of the smallest (and while their sizes differ by more than 2)
-            while float(len(clusters[-1])) / len(clusters[0]) > 1.1 and len(clusters[-1]) - len(clusters[0]) > 3:  # keep homogenizing while biggest cluster is more than 3/2 the size of the smallest (and while their sizes differ by more than 2)
-                homogenize()
-                itries += 1
-                if itries > len(clusters):
-                    if debug:
-                        print '  too many homogenization tries'
-                    break
-
+            print '    %d leader groups (%d pieces) for %d names' % (len(leader_groups), len(pieces), len(naive_seqs))
+            print '    sizes: %s' % ' '.join([str(len(cl)) for cl in clusters])
         print '    divvy time: %.3f' % (time.time()-start)
         return clusters
 
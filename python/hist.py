@@ -96,8 +96,8 @@ class Hist(object):
         if self.sum_weights_squared is not None:
             self.sum_weights_squared[ibin] += weight*weight
         if self.errors is not None:
-            if weight != 1.0:
-                print 'WARNING using errors instead of sumw2 with weight != 1.0 in Hist::fill_ibin()'
+            if weight != int(weight):  # integer weights are the same as filling that many times, so sqrt(contents) is still right
+                print 'WARNING using errors instead of sumw2 with non-integer weight in Hist::fill_ibin()'
             self.errors[ibin] = math.sqrt(self.bin_contents[ibin])
 
     # ----------------------------------------------------------------------------------------
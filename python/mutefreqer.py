@@ -26,20 +26,21 @@ class MuteFreqer(object):
         self.subplotdirs = ['overall', ] + ['per-gene/' + r for r in utils.regions]  # + ['per-gene-per-position/' + r for r in utils.regions]  # + ['per-gene-per-position--per-base' for r in utils.regions]:
 
     # ----------------------------------------------------------------------------------------
-    def increment(self, info, iseq):
-        self.mean_rates['all'].fill(utils.get_mutation_rate(info, iseq))  # mean freq over whole sequence (excluding insertions)
+    def increment(self, info, iseq, weight=1):
+        """ <weight> is the (integer) number of identical sequences that <iseq> stands for """
+        self.mean_rates['all'].fill(utils.get_mutation_rate(info, iseq), weight=weight)  # mean freq over whole sequence (excluding insertions)
 
         for region in utils.regions:
             # first do mean freqs
             regional_freq = utils.get_mutation_rate(info, iseq, restrict_to_region=region)  # NOTE It might really make more sense to exclude the last few bases next to NTIs here, like I do in allelefinder
-            self.mean_rates[region].fill(regional_freq)  # per-region mean freq
+            self.mean_rates[region].fill(regional_freq, weight=weight)  # per-region mean freq
 
             # then do per-gene and per-gene, per-position freqs
             gene = info[region + '_gene']
             if gene not in self.counts:
                 self.counts[gene] = {}
                 self.per_gene_mean_rates[gene] = Hist(self.n_bins, self.xmin, self.xmax, xtitle='mut freq', ytitle='freq', title=gene)
-            self.per_gene_mean_rates[gene].fill(regional_freq)
+            self.per_gene_mean_rates[gene].fill(regional_freq, weight=weight)
             if gene == 'IGHV1-69*14':
                 self.per_gene_mean_rates[gene].fill(0.7)
 
@@ -60,8 +61,8 @@ class MuteFreqer(object):
                     gcts[igl] = {n : 0 for n in utils.nukes + ['total', ]}
                     gcts[igl]['gl_nuke'] = germline_seq[ipos]
 
-                gcts[igl]['total'] += 1
-                gcts[igl][query_seq[ipos]] += 1  # note that if <query_seq[ipos]> isn't among <utils.nukes>, this will toss a key error
+                gcts[igl]['total'] += weight
+                gcts[igl][query_seq[ipos]] += weight  # note that if <query_seq[ipos]> isn't among <utils.nukes>, this will toss a key error
 
     # ----------------------------------------------------------------------------------------
     def get_uncertainty(self, obs, total):
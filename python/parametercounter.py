@@ -48,43 +48,49 @@ class ParameterCounter(object):
         return tuple(index)
 
     # ----------------------------------------------------------------------------------------
-    def increment(self, info):
-        self.increment_per_family_params(info)
+    def increment(self, info, multiplicities=None):
+        """
+        If set, <multiplicities> is the number of identical sequences that each sequence in <info> stands for (see --collapse-duplicate-sequences), so we
+        count each of them that many times. For a single-sequence line that includes the per-family parameters, since each duplicate would have been its own event.
+        """
+        if multiplicities is None:
+            multiplicities = [1 for _ in info['seqs']]
+        self.increment_per_family_params(info, weight=multiplicities[0] if len(info['seqs']) == 1 else 1)
         for iseq in range(len(info['seqs'])):
-            self.increment_per_sequence_params(info, iseq)
+            self.increment_per_sequence_params(info, iseq, weight=multiplicities[iseq])
 
     # ----------------------------------------------------------------------------------------
-    def increment_per_sequence_params(self, info, iseq):
+    def increment_per_sequence_params(self, info, iseq, weight=1):
         """ increment parameters that differ for each sequence within the clonal family """
-        self.mute_total += 1
-        self.mfreqer.increment(info, iseq)
+        self.mute_total += weight
+        self.mfreqer.increment(info, iseq, weight=weight)
         for nuke in info['seqs'][iseq]:
             if nuke in utils.ambiguous_bases:
                 continue
-            self.counts['seq_content'][nuke] += 1
+            self.counts['seq_content'][nuke] += weight
 
     # ----------------------------------------------------------------------------------------
-    def increment_per_family_params(self, info):
+    def increment_per_family_params(self, info, weight=1):
         """ increment parameters that are the same for the entire clonal family """
-        self.reco_total += 1
+        self.reco_total += weight
 
         all_index = self.get_index(info, tuple(list(utils.index_columns) + ['cdr3_length', ]))
         if all_index not in self.counts['all']:
             self.counts['all'][all_index] = 0
-        self.counts['all'][all_index] += 1
+        self.counts['all'][all_index] += weight
 
         for deps in utils.column_dependency_tuples:
             column = deps[0]
             index = self.get_index(info, deps)
             if index not in self.counts[column]:
                 self.counts[column][index] = 0
-            self.counts[column][index] += 1
+            self.counts[column][index] += weight
 
         for bound in utils.boundaries:
             for nuke in info[bound + '_insertion']:
                 if nuke in utils.ambiguous_bases:
                     continue
-                self.counts[bound + '_insertion_content'][nuke] += 1
+                self.counts[bound + '_insertion_content'][nuke] += weight
 
     # ----------------------------------------------------------------------------------------
     def clean_plots(self, plotdir):
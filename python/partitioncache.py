@@ -0,0 +1,212 @@
+import os
+import csv
+import fcntl
+
+import utils
+
+# ----------------------------------------------------------------------------------------
+def lock(fname, shared=False):
+    """
+    Block until we have an fcntl lock on <fname>.lock (shared for readers, exclusive for writers), and return the open lock file, which releases the lock when closed.
+    NOTE we never remove the lock file, since someone else could be waiting on (and would then get a lock on) the removed inode.
+    """
+    lockfile = open(fname + '.lock', 'a')
+    fcntl.flock(lockfile, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+    return lockfile
+
+# ----------------------------------------------------------------------------------------
+def truncate_incomplete_line(fname):
+    """ if the last line in <fname> wasn't completely written (e.g. we got killed while appending), chop it off """
+    if not os.path.exists(fname) or os.stat(fname).st_size == 0:
+        return
+    with open(fname, 'r+') as cachefile:
+        cachefile.seek(-1, os.SEEK_END)
+        if cachefile.read(1) == '\n':
+            return
+        cachefile.seek(0)
+        last_newline = cachefile.read().rfind('\n')
+        cachefile.truncate(last_newline + 1)
+
+# ----------------------------------------------------------------------------------------
+class PartitionCache(object):
+    """
+    Log-structured store for bcrham's partition cache (naive seqs, logprobs, etc. for each set of unique ids).
+    The csv file itself (which is what bcrham reads and writes) is only ever appended to, and we keep an in-memory index
+    from each unique_ids string to the offsets of its lines in the file, as well as from each uid to all the unique_ids strings that include it.
+    This means we can write the subset of the cache that's relevant to each subprocess, and add the subprocesses' new values, without copying or re-sorting the whole file.
+    NOTE there can be more than one line for each key, since bcrham often calculates the naive seq for a cluster in one step (or run), and its logprob in a later one.
+    bcrham merges the lines when it reads the file, and we keep track of which fields (logprob, naive_seq...) we have for each key, so we only append lines that add something.
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        self.offsets = {}  # map from unique_ids string to the offsets of its lines in <self.fname>
+        self.field_masks = {}  # map from unique_ids string to a bit mask of the (non-key) columns for which we have a non-empty value (see get_field_mask())
+        self.uid_keys = {}  # map from each uid to the unique_ids strings in which it appears
+        self.header = None
+        self.columns = None  # column names from <self.header>
+        self.n_indexed_bytes = 0  # how far into <self.fname> we've indexed
+
+        if not os.path.exists(self.fname) or os.stat(self.fname).st_size == 0:
+            with open(self.fname, 'w') as cachefile:
+                writer = csv.DictWriter(cachefile, utils.partition_cachefile_headers)
+                writer.writeheader()
+        self.index()
+
+    # ----------------------------------------------------------------------------------------
+    def __len__(self):
+        return len(self.offsets)
+
+    # ----------------------------------------------------------------------------------------
+    def __contains__(self, key):
+        return key in self.offsets
+
+    # ----------------------------------------------------------------------------------------
+    def split_line(self, line):
+        """ split raw csv <line> into its fields (without the csv module, unless it's quoted) """
+        if '"' in line:
+            return csv.reader([line]).next()
+        return line.rstrip('\r\n').split(',')
+
+    # ----------------------------------------------------------------------------------------
+    def get_field_mask(self, fields):
+        """ bit mask with a bit set for each non-key column in <fields> that's non-empty """
+        mask = 0
+        for ifield in range(1, len(fields)):
+            if fields[ifield] != '':
+                mask |= 1 << ifield
+        return mask
+
+    # ----------------------------------------------------------------------------------------
+    def add_to_index(self, fields, offset):
+        """ add the line at <offset> (split into <fields>) to the index, unless it doesn't tell us anything new, and return True if we added it """
+        key = fields[0]
+        mask = self.get_field_mask(fields)
+        if key in self.offsets:
+            if mask & ~self.field_masks[key] == 0:  # we already have a value for each of its non-empty fields
+                return False
+            self.offsets[key].append(offset)
+            self.field_masks[key] |= mask
+            return True
+        self.offsets[key] = [offset, ]
+        self.field_masks[key] = mask
+        for uid in utils.intern_uids(key.split(':')):
+            if uid not in self.uid_keys:
+                self.uid_keys[uid] = []
+            self.uid_keys[uid].append(key)
+        return True
+
+    # ----------------------------------------------------------------------------------------
+    def index(self):
+        """ index any lines that have been added to <self.fname> since the last time we indexed it """
+        with open(self.fname) as cachefile:
+            if self.header is None:
+                self.header = cachefile.readline()
+                self.columns = self.header.strip().split(',')
+                if set(self.columns) != set(utils.partition_cachefile_headers) or self.columns[0] != 'unique_ids':
+                    raise Exception('unexpected header in partition cache file %s: %s' % (self.fname, self.header.strip()))
+                self.n_indexed_bytes = cachefile.tell()
+            cachefile.seek(self.n_indexed_bytes)
+            while True:
+                offset = cachefile.tell()
+                line = cachefile.readline()
+                if line == '':
+                    break
+                if line[-1] != '\n':  # partially-written line (shouldn't happen, since we only index after the writers have finished)
+                    raise Exception('incomplete line at offset %d in %s' % (offset, self.fname))
+                self.add_to_index(self.split_line(line), offset)  # NOTE lines with nothing new stay in the file, they're just not in the index (compact() removes them)
+            self.n_indexed_bytes = cachefile.tell()
+
+    # ----------------------------------------------------------------------------------------
+    def reindex(self):
+        """ start from scratch (e.g. after bcrham has rewritten the whole file) """
+        self.offsets, self.field_masks, self.uid_keys = {}, {}, {}
+        self.header, self.columns = None, None
+        self.n_indexed_bytes = 0
+        self.index()
+
+    # ----------------------------------------------------------------------------------------
+    def write_subset(self, outfname, uids):
+        """ write to <outfname> the cache entries for which every uid is in <uids> (i.e. all the entries that a process working on <uids> could use) """
+        uids = set(uids)
+        keys = set()
+        for uid in uids:
+            for key in self.uid_keys.get(uid, []):
+                if key not in keys and all([u in uids for u in key.split(':')]):
+                    keys.add(key)
+        offsets = sorted([offset for key in keys for offset in self.offsets[key]])  # read them in file order (bcrham merges multiple lines for the same key)
+        with open(self.fname) as cachefile:
+            with open(outfname, 'w') as outfile:
+                outfile.write(self.header)
+                for offset in offsets:
+                    cachefile.seek(offset)
+                    outfile.write(cachefile.readline())
+        return len(keys)
+
+    # ----------------------------------------------------------------------------------------
+    def get_logprob(self, key):
+        """ return the logprob for <key> (-inf if bcrham couldn't find a path), or None if we don't have one """
+        if key not in self.offsets:
+            return None
+        logprob = None
+        with open(self.fname) as cachefile:
+            for offset in self.offsets[key]:  # same merging rules as in compact()
+                cachefile.seek(offset)
+                fields = self.split_line(cachefile.readline())
+                if 'no_path' in fields[self.columns.index('errors')]:
+                    return float('-inf')
+                if fields[self.columns.index('logprob')] != '':
+                    logprob = float(fields[self.columns.index('logprob')])
+        return logprob
+
+    # ----------------------------------------------------------------------------------------
+    def append_new_entries(self, infname):
+        """ append any lines in cache file <infname> that have values we don't already have (either new keys, or new fields for existing keys), and return the number appended """
+        n_new = 0
+        with open(infname) as infile:
+            header = infile.readline()
+            if header.strip().split(',') != self.columns:
+                raise Exception('header in %s (%s) doesn\'t match %s (%s)' % (infname, header.strip(), self.fname, self.header.strip()))
+            with open(self.fname, 'a') as cachefile:
+                cachefile.seek(0, os.SEEK_END)  # 'a' mode doesn't necessarily move to the end until we write something
+                for line in infile:
+                    if line.strip() == '':
+                        continue
+                    if line[-1] != '\n':
+                        line += '\n'
+                    if not self.add_to_index(self.split_line(line), cachefile.tell()):
+                        continue
+                    cachefile.write(line)
+                    n_new += 1
+                self.n_indexed_bytes = cachefile.tell()
+        return n_new
+
+    # ----------------------------------------------------------------------------------------
+    def compact(self, keep_fcn=None, debug=False):
+        """
+        Rewrite <self.fname> with one line for each key (merging the fields from all of its lines), and (if <keep_fcn> is set) only the keys for which keep_fcn(key) is True.
+        The new file is written alongside and then moved into place, so readers see either the old or the new version. NOTE you should hold an exclusive lock.
+        """
+        tmpfname = self.fname + '.tmp'
+        keys = sorted([key for key in self.offsets if keep_fcn is None or keep_fcn(key)], key=lambda k: self.offsets[k][0])  # keep them in file order
+        with open(self.fname) as cachefile:
+            with open(tmpfname, 'w') as tmpfile:
+                tmpfile.write(self.header)
+                writer = csv.writer(tmpfile, lineterminator='\n')
+                ierrors = self.columns.index('errors')
+                for key in keys:
+                    merged_fields = [key, ] + [''] * (len(self.columns) - 1)
+                    for offset in self.offsets[key]:  # same merging rules as bcrham: later non-empty values win, and lines with a no_path error only tell us that the query failed
+                        cachefile.seek(offset)
+                        fields = self.split_line(cachefile.readline())
+                        if 'no_path' in fields[ierrors]:
+                            merged_fields[ierrors] = fields[ierrors]
+                            continue
+                        for ifield in range(1, len(fields)):
+                            if fields[ifield] != '' and 'no_path' not in merged_fields[ifield]:
+                                merged_fields[ifield] = fields[ifield]
+                    writer.writerow(merged_fields)
+        n_before, size_before = len(self.offsets), os.stat(self.fname).st_size
+        os.rename(tmpfname, self.fname)
+        self.reindex()
+        if debug:
+            print '    compacted %s: %d --> %d entries, %.1f --> %.1f MB' % (self.fname, n_before, len(self.offsets), size_before / 1e6, os.stat(self.fname).st_size / 1e6)
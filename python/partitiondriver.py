@@ -6,6 +6,7 @@ import math
 import os
 import glob
 import csv
+import json
 csv.field_size_limit(sys.maxsize)  # make sure we can write very large csv fields
 import random
 from collections import OrderedDict
@@ -13,6 +14,7 @@ from subprocess import Popen, check_call, PIPE, CalledProcessError, check_output
 import copy
 import multiprocessing
 import operator
+import heapq
 
 import utils
 import glutils
@@ -20,6 +22,9 @@ from opener import opener
 import seqfileopener
 from glomerator import Glomerator
 from clusterpath import ClusterPath
+import partitioncache
+import seqpool
+from partitioncache import PartitionCache
 from waterer import Waterer
 from parametercounter import ParameterCounter
 from performanceplotter import PerformancePlotter
@@ -40,8 +45,13 @@ class PartitionDriver(object):
         glutils.write_glfo(self.my_gldir, self.glfo)  # need a copy on disk for vdjalign and bcrham (note that what we write to <self.my_gldir> in general differs from what's in <initial_gldir>)
 
         self.input_info, self.reco_info = None, None
+        self.duplicates = {}  # map from each representative uid to the uids of the identical sequences that were collapsed into it (if --collapse-duplicate-sequences is set)
         if self.args.infname is not None:
             self.input_info, self.reco_info = seqfileopener.get_seqfile_info(self.args.infname, self.args.is_data, n_max_queries=self.args.n_max_queries, args=self.args, glfo=self.glfo, simglfo=self.simglfo)
+            if self.args.collapse_duplicate_sequences:
+                self.duplicates = seqfileopener.collapse_duplicate_sequences(self.input_info, seed_unique_id=self.args.seed_unique_id)  # NOTE <self.reco_info> keeps the duplicates
+                n_collapsed = sum([len(dups) for dups in self.duplicates.values()])
+                print '  collapsed %d duplicate sequences into %d representatives (%d sequences remaining)' % (n_collapsed, len(self.duplicates), len(self.input_info))
             if len(self.input_info) > 1000:
                 if self.args.n_procs == 1:
                     print '  note:! running on %d sequences spread over %d processes. This will be kinda slow, so it might be a good idea to set --n-procs N to the number of processors on your local machine, or look into non-local parallelization with --slurm.\n' % (len(self.input_info), self.args.n_procs)
@@ -53,6 +63,16 @@ class PartitionDriver(object):
 
         self.sw_info = None
         self.bcrham_proc_info = None
+        self.bcrham_pool = None  # persistent bcrham workers (with --bcrham-worker-pool, while partitioning)
+        self.naive_hamming_bounds = {}  # keyed by parameter dir (they don't change over the course of the partition loop, so no sense re-reading the mute freq hist every step)
+        self.hmm_subworkdirs = set()  # subworkdirs for bcrham procs, which we keep around between agglomeration steps (they're removed by remove_hmm_subworkdirs())
+        self.hmm_file_genes = {}  # genes with hmm files in each parameter dir (see get_existing_hmm_files())
+        self.query_features = {}  # per-query info that combine_queries() needs (see get_query_features())
+        self.combined_records = {}  # bcrham input line for each cluster that we wrote last time through write_to_single_input_file(), so unchanged clusters don't need to be recombined
+        self.combined_parameter_dir = None  # parameter dir to which <self.query_features> and <self.combined_records> correspond (set to None to invalidate them)
+
+        self.block_procs = None  # for each block (see get_block_key()), the set of procs to which we sent its clusters in the most recent step
+        self.finished_clusters = []  # clusters from blocks that were entirely agglomerated within one process, which we hold out of subsequent steps
 
         self.unseeded_clusters = set()  # all the queries that we *didn't* cluster with the seed uid
         self.time_to_remove_unseeded_clusters = False
@@ -65,8 +85,15 @@ class PartitionDriver(object):
         self.hmm_infname = self.args.workdir + '/hmm_input.csv'
         self.hmm_cachefname = self.args.workdir + '/hmm_cached_info.csv'
         self.hmm_outfname = self.args.workdir + '/hmm_output.csv'
+        self.hmm_cache = None  # index into <self.hmm_cachefname> (see get_hmm_cache())
+        self.hmm_seqfname = None  # table of each query's sequence, so bcrham input files only need the uids (see write_hmm_seqfile())
         self.annotation_fname = self.hmm_outfname.replace('.csv', '_annotations.csv')
 
+        if self.args.checkpoint_dir is not None:
+            self.checkpoint_fname = self.args.checkpoint_dir + '/checkpoint.json'
+            self.checkpoint_cachefname = self.args.checkpoint_dir + '/' + os.path.basename(self.hmm_cachefname)
+        self.checkpoint_cache = None  # index into <self.checkpoint_cachefname>, to which we append each step's new cache entries
+
         if self.args.outfname is not None:
             outdir = os.path.dirname(self.args.outfname)
             if outdir != '' and not os.path.exists(outdir):
@@ -82,20 +109,17 @@ class PartitionDriver(object):
     def clean(self):
         glutils.remove_glfo_files(self.my_gldir, self.args.chain)
 
-        # merge persistent and current cache files into the persistent cache file
-        if self.args.persistent_cachefname is not None:
-            lockfname = self.args.persistent_cachefname + '.lock'
-            while os.path.exists(lockfname):
-                print '  waiting for lock on %s' % lockfname
-                time.sleep(0.5)
-            lockfile = open(lockfname, 'w')
-            if not os.path.exists(self.args.persistent_cachefname):
-                open(self.args.persistent_cachefname, 'w').close()
-            self.merge_files(infnames=[self.args.persistent_cachefname, self.hmm_cachefname], outfname=self.args.persistent_cachefname, dereplicate=True)
+        # append any new entries in the current cache file to the persistent cache file
+        if self.args.persistent_cachefname is not None and os.path.exists(self.hmm_cachefname):
+            lockfile = partitioncache.lock(self.args.persistent_cachefname)
+            persistent_cache = PartitionCache(self.args.persistent_cachefname)
+            n_new = persistent_cache.append_new_entries(self.hmm_cachefname)
             lockfile.close()
-            os.remove(lockfname)
+            print '    added %d new entries to persistent cache file %s (%d total)' % (n_new, self.args.persistent_cachefname, len(persistent_cache))
         if os.path.exists(self.hmm_cachefname):
             os.remove(self.hmm_cachefname)
+        if self.hmm_seqfname is not None and os.path.exists(self.hmm_seqfname):
+            os.remove(self.hmm_seqfname)
 
         try:
             os.rmdir(self.args.workdir)
@@ -122,7 +146,9 @@ class PartitionDriver(object):
                         outrow = {'unique_ids' : line['unique_ids'], 'naive_seq' : line['padlefts'][0] * utils.ambiguous_bases[0] + line['naive_seq'] + line['padrights'][0] * utils.ambiguous_bases[0]}
                         writer.writerow(outrow)
             elif set(reader.fieldnames) == set(utils.partition_cachefile_headers):  # headers are ok, so can just copy straight over
+                lockfile = partitioncache.lock(self.args.persistent_cachefname, shared=True)  # make sure nobody's in the middle of appending to it
                 check_call(['cp', '-v', self.args.persistent_cachefname, self.hmm_cachefname])
+                lockfile.close()
             else:
                 raise Exception('--persistent-cachefname %s has unexpected header list %s' % (self.args.persistent_cachefname, reader.fieldnames))
 
@@ -160,13 +186,18 @@ class PartitionDriver(object):
                           count_parameters=(remove_less_likely_alleles or parameter_out_dir is not None),
                           parameter_out_dir=parameter_out_dir, remove_less_likely_alleles=remove_less_likely_alleles, find_new_alleles=find_new_alleles,
                           plot_performance=(self.args.plot_performance and not remove_less_likely_alleles and not find_new_alleles),
-                          simglfo=self.simglfo, itry=itry)
+                          simglfo=self.simglfo, itry=itry, duplicates=self.duplicates)
         cachefname = self.get_cachefname(write_parameters, find_new_alleles)
         if cachefname is None or not os.path.exists(cachefname):  # run sw if we either don't want to do any caching (None) or if we are planning on writing the results after we run
             waterer.run(cachefname)
         else:
             waterer.read_cachefile(cachefname)
         self.sw_info = waterer.info
+        self.combined_parameter_dir = None  # new sw info, so need to recalculate query features
+        if len(self.duplicates) > 0:
+            collapsed_queries = [uid for dups in self.duplicates.values() for uid in dups if uid in self.sw_info]
+            if len(collapsed_queries) > 0:
+                raise Exception('sw info includes %d sequences that were collapsed as duplicates (e.g. %s) -- was %s written without --collapse-duplicate-sequences?' % (len(collapsed_queries), collapsed_queries[0], cachefname))
 
     # ----------------------------------------------------------------------------------------
     def find_new_alleles(self):
@@ -225,7 +256,8 @@ class PartitionDriver(object):
     def cache_parameters(self):
         """ Infer full parameter sets and write hmm files for sequences from <self.input_info>, first with Smith-Waterman, then using the SW output as seed for the HMM """
         print 'caching parameters'
-        if len(self.input_info) < 10 * self.args.min_observations_to_write:
+        n_input_seqs = len(self.input_info) + sum([len(dups) for dups in self.duplicates.values()])  # parameters are counted including collapsed duplicates
+        if n_input_seqs < 10 * self.args.min_observations_to_write:
             print """
             %s: number of input sequences (%d) isn\'t very large compared to --min-observations-to-write (%d), i.e. when we write hmm files we\'re going to be doing a lot of interpolation and smoothing.
             This is not necessarily terrible -- if you really only have %d input sequences, you will, in general, get sensible answers.
@@ -235,7 +267,7 @@ class PartitionDriver(object):
 
             For now, we assume the first case (you actually want to infer parameters on this small data set), so we reset --min-observations-to-write to 1 and charge ahead.
             It would also be sensible to compare the hmm output results (--outfname) to the smith-waterman results (which are cached in a file whose path should be printed just below).
-            """ % (utils.color('red', 'warning'), len(self.input_info), self.args.min_observations_to_write, len(self.input_info), )
+            """ % (utils.color('red', 'warning'), n_input_seqs, self.args.min_observations_to_write, n_input_seqs, )
 
             self.args.min_observations_to_write = 1
 
@@ -290,19 +322,42 @@ class PartitionDriver(object):
         """ Partition sequences in <self.input_info> into clonally related lineages """
         print 'partitioning'
         self.run_waterer()  # run smith-waterman
-
-        # cache hmm naive seq for each single query
-        if len(self.sw_info['queries']) > 50 or self.args.naive_vsearch or self.args.naive_swarm:
-            self.run_hmm('viterbi', self.sub_param_dir, n_procs=self.get_n_precache_procs(), precache_all_naive_seqs=True)
+        self.write_hmm_seqfile()
+
+        checkpoint = None
+        if self.args.resume:
+            checkpoint = self.read_checkpoint()
+        elif self.args.checkpoint_dir is not None:  # starting from scratch, so clear out any old checkpoint
+            utils.prep_dir(self.args.checkpoint_dir, wildlings=[os.path.basename(self.checkpoint_fname) + '*', os.path.basename(self.checkpoint_cachefname)])
+
+        initial_partition = [[q, ] for q in self.sw_info['queries']]  # NOTE sw info excludes failed sequences
+        precache_queries = self.sw_info['queries']
+        if checkpoint is None and self.args.incremental_from is not None:
+            initial_partition = self.read_incremental_partition()
+            hmm_cache = self.get_hmm_cache()
+            if hmm_cache is not None:  # only need naive seqs for queries that aren't already cached (in general, the new ones)
+                precache_queries = [q for q in self.sw_info['queries'] if q not in hmm_cache]
+                print '    %d / %d single queries already cached' % (len(self.sw_info['queries']) - len(precache_queries), len(self.sw_info['queries']))
+
+        if self.args.bcrham_worker_pool:
+            self.bcrham_pool = utils.WorkerPool('--worker', 'bcrham worker: done', debug='print')
+
+        # cache hmm naive seq for each single query (unless we're resuming, in which case they're in the checkpoint's cache file)
+        if checkpoint is None and (len(precache_queries) > 50 or self.args.naive_vsearch or self.args.naive_swarm):
+            self.run_hmm('viterbi', self.sub_param_dir, n_procs=self.get_n_precache_procs(len(precache_queries)), precache_all_naive_seqs=True, queries=precache_queries)
 
         if self.args.naive_vsearch or self.args.naive_swarm:
+            self.close_bcrham_pool()
             self.cluster_with_naive_vsearch_or_swarm(self.sub_param_dir)
             return
 
-        n_procs = self.args.n_procs
-        cpath = ClusterPath(seed_unique_id=self.args.seed_unique_id)
-        cpath.add_partition([[cl, ] for cl in self.sw_info['queries']], logprob=0., n_procs=n_procs)  # NOTE sw info excludes failed sequences
-        n_proc_list = []
+        if checkpoint is None:
+            n_procs = self.args.n_procs
+            cpath = ClusterPath(seed_unique_id=self.args.seed_unique_id)
+            cpath.add_partition(initial_partition, logprob=0., n_procs=n_procs)
+            n_proc_list = []
+        else:
+            cpath, n_procs, n_proc_list = checkpoint
         start = time.time()
         while n_procs > 0:
             print '--> %d clusters with %d procs' % (len(cpath.partitions[cpath.i_best_minus_x]), n_procs)  # write_hmm_input uses the best-minus-ten partition
@@ -310,8 +365,20 @@ class PartitionDriver(object):
             n_proc_list.append(n_procs)
             if n_procs == 1:
                 break
+            if self.blocking():
+                cpath = self.hold_out_finished_blocks(cpath, n_procs)
+                if len(cpath.partitions[cpath.i_best_minus_x]) == 0:  # every block is finished
+                    break
             n_procs = self.get_next_n_procs(n_procs, n_proc_list, cpath)
-
+            if self.blocking():  # holding out finished blocks can leave us with fewer clusters than procs
+                n_procs = min(n_procs, len(cpath.partitions[cpath.i_best_minus_x]))
+            if self.args.checkpoint_dir is not None:
+                self.write_checkpoint(cpath, n_procs, n_proc_list)
+
+        self.close_bcrham_pool()
+        self.remove_hmm_subworkdirs()
+        if len(self.finished_clusters) > 0:
+            cpath = self.stitch_finished_blocks(cpath)
         print '      loop time: %.1f' % (time.time()-start)
 
         if self.args.debug:
@@ -334,6 +401,261 @@ class PartitionDriver(object):
         if self.args.outfname is not None:
             self.write_clusterpaths(self.args.outfname, cpath)  # [last agglomeration step]
 
+    # ----------------------------------------------------------------------------------------
+    def write_hmm_seqfile(self):
+        """
+        Write each query's (padded) sequence to a table that bcrham reads with --seqfile, so the input files for each agglomeration step only have to list the uids in each cluster.
+        NOTE this only works because the padding is the same for the whole sample, so each query's sequence is the same in every cluster (see get_query_features()).
+        """
+        self.hmm_seqfname = self.args.workdir + '/hmm_seqs.csv'
+        with open(self.hmm_seqfname, 'w') as seqfile:
+            writer = csv.DictWriter(seqfile, ('names', 'seqs'), delimiter=' ')
+            writer.writeheader()
+            for query in self.sw_info['queries']:
+                writer.writerow({'names' : query, 'seqs' : self.sw_info[query]['seqs'][0]})
+
+    # ----------------------------------------------------------------------------------------
+    def get_hmm_input_headers(self):
+        """ columns for bcrham input files (without the seqs, if they're in the seq table) """
+        return [h for h in utils.hmm_input_headers if h != 'seqs' or self.hmm_seqfname is None]
+
+    # ----------------------------------------------------------------------------------------
+    def read_incremental_partition(self):
+        """ return the best partition from --incremental-from, restricted to the current queries, plus any new queries as singletons """
+        previous_cpath = ClusterPath()
+        previous_cpath.readfile(self.args.incremental_from)
+        queries = set(self.sw_info['queries'])
+        partition = []
+        n_dropped = 0
+        for cluster in previous_cpath.partitions[previous_cpath.i_best]:
+            kept_cluster = [uid for uid in cluster if uid in queries]
+            n_dropped += len(cluster) - len(kept_cluster)
+            if len(kept_cluster) > 0:
+                partition.append(kept_cluster)
+        previous_uids = set([uid for cluster in partition for uid in cluster])
+        new_queries = [q for q in self.sw_info['queries'] if q not in previous_uids]
+        print '  starting from best partition in %s: %d clusters with %d sequences (%d previous sequences not in current input), plus %d new sequences' % (self.args.incremental_from, len(partition), len(previous_uids), n_dropped, len(new_queries))
+        if self.args.persistent_cachefname is None:
+            print '    %s --incremental-from without --persistent-cachefname, so we\'ll need to recalculate everything for the previous clusters' % utils.color('yellow', 'note')
+        return partition + [[q, ] for q in new_queries]
+
+    # ----------------------------------------------------------------------------------------
+    def write_checkpoint(self, cpath, n_procs, n_proc_list):
+        """ write everything we need to pick up the partition loop at the start of the next step (which'll use <n_procs> procs) to --checkpoint-dir """
+        if self.checkpoint_cache is None:
+            self.checkpoint_cache = PartitionCache(self.checkpoint_cachefname)
+        if os.path.exists(self.hmm_cachefname):  # do the cache first, so the checkpoint never refers to entries that aren't there (the cache is append-only, so an older checkpoint is fine with extra entries)
+            self.checkpoint_cache.append_new_entries(self.hmm_cachefname)
+
+        ipartitions = range(cpath.i_best_minus_x, cpath.i_best + 1)  # the next step starts from i_best_minus_x, and makes a new cluster path, so we don't need the rest (and there can be a lot of them)
+        checkpoint = {
+            'partitions' : [cpath.partitions[ip] for ip in ipartitions],
+            'logprobs' : [cpath.logprobs[ip] for ip in ipartitions],
+            'n_procs' : [cpath.n_procs[ip] for ip in ipartitions],
+            'logweights' : [cpath.logweights[ip] for ip in ipartitions],
+            'next_n_procs' : n_procs,
+            'n_proc_list' : n_proc_list,
+            'finished_clusters' : self.finished_clusters,
+            'unseeded_clusters' : sorted(self.unseeded_clusters),
+            'time_to_remove_unseeded_clusters' : self.time_to_remove_unseeded_clusters,
+            'already_removed_unseeded_clusters' : self.already_removed_unseeded_clusters,
+        }
+        tmpfname = self.checkpoint_fname + '.tmp'
+        with open(tmpfname, 'w') as checkfile:
+            json.dump(checkpoint, checkfile)
+        os.rename(tmpfname, self.checkpoint_fname)  # so if we get killed while writing, the previous checkpoint is still intact
+        if self.args.debug:
+            print '      wrote checkpoint to %s (%d cache entries)' % (self.args.checkpoint_dir, len(self.checkpoint_cache))
+
+    # ----------------------------------------------------------------------------------------
+    def read_checkpoint(self):
+        """ restore the partition loop state (and the hmm cache) from --checkpoint-dir, and return (cpath, n_procs, n_proc_list) for the next step, or None if there's no checkpoint """
+        if not os.path.exists(self.checkpoint_fname):
+            print '  no checkpoint in %s, so starting from the beginning' % self.args.checkpoint_dir
+            return None
+
+        with open(self.checkpoint_fname) as checkfile:
+            checkpoint = json.load(checkfile)
+
+        def strify(clusters):  # json gives us unicode
+            return [[str(uid) for uid in cl] for cl in clusters]
+
+        cpath = ClusterPath(seed_unique_id=self.args.seed_unique_id)
+        for ip in range(len(checkpoint['partitions'])):
+            cpath.add_partition(strify(checkpoint['partitions'][ip]), checkpoint['logprobs'][ip], checkpoint['n_procs'][ip], logweight=checkpoint['logweights'][ip])
+        self.finished_clusters = strify(checkpoint['finished_clusters'])
+        self.unseeded_clusters = set([str(uid) for uid in checkpoint['unseeded_clusters']])
+        self.time_to_remove_unseeded_clusters = checkpoint['time_to_remove_unseeded_clusters']
+        self.already_removed_unseeded_clusters = checkpoint['already_removed_unseeded_clusters']
+
+        checkpoint_uids = set([uid for cl in cpath.partitions[cpath.i_best] + self.finished_clusters for uid in cl]) | self.unseeded_clusters
+        missing_uids = checkpoint_uids - set(self.sw_info['queries'])
+        if len(missing_uids) > 0:
+            raise Exception('%d queries in checkpoint %s aren\'t in the current sw info (e.g. %s) -- did you change the input file?' % (len(missing_uids), self.checkpoint_fname, ' '.join(list(missing_uids)[:5])))
+
+        partitioncache.truncate_incomplete_line(self.checkpoint_cachefname)  # in case we got killed while appending to it
+        self.checkpoint_cache = PartitionCache(self.checkpoint_cachefname)
+        if self.get_hmm_cache() is None:
+            self.hmm_cache = PartitionCache(self.hmm_cachefname)
+        n_new = self.hmm_cache.append_new_entries(self.checkpoint_cachefname)
+
+        print '  resuming from checkpoint in %s after %d %s: %d clusters (plus %d finished) with %d procs, %d cache entries (%d new)' % (self.args.checkpoint_dir, len(checkpoint['n_proc_list']), utils.plural_str('step', len(checkpoint['n_proc_list'])),
+                                                                                                                                  len(cpath.partitions[cpath.i_best_minus_x]), len(self.finished_clusters), checkpoint['next_n_procs'], len(self.hmm_cache), n_new)
+        return cpath, checkpoint['next_n_procs'], checkpoint['n_proc_list']
+
+    # ----------------------------------------------------------------------------------------
+    def blocking(self):
+        """ are we splitting the partition problem into independent blocks? """
+        if self.args.seed_unique_id is not None or self.args.print_cluster_annotations:  # seeded partitioning does its own thing, and cluster annotations only get written for clusters in the last step
+            return False
+        return self.args.block_by_cdr3_length or self.args.block_by_vj_family
+
+    # ----------------------------------------------------------------------------------------
+    def get_block_key(self, cluster):
+        """ clusters with different keys are never merged (different cdr3 lengths) or at least shouldn't be (different v/j families) """
+        swfo = self.sw_info[cluster[0]]
+        key = (swfo['cdr3_length'], )  # bcrham already refuses to merge different cdr3 lengths, so this is always safe
+        if self.args.block_by_vj_family:
+            key += tuple([utils.primary_version(swfo[region + '_gene']) for region in ['v', 'j']])
+        return key
+
+    # ----------------------------------------------------------------------------------------
+    def hold_out_finished_blocks(self, cpath, n_procs):
+        """
+        Any block whose clusters were all in the same process in the step that just finished has been agglomerated as far as it's going to go, so we
+        pull its clusters (from the best partition) out of <cpath> and into <self.finished_clusters>, so they don't go into subsequent steps.
+        NOTE this means the partition logprobs from subsequent steps don't include the finished clusters, until stitch_finished_blocks() adds them back in.
+        """
+        if n_procs == 1 or self.block_procs is None:
+            return cpath
+
+        finished_keys = set([key for key, iprocs in self.block_procs.items() if len(iprocs) == 1])
+        new_finished_clusters = [cl for cl in cpath.partitions[cpath.i_best] if set([self.get_block_key([uid]) for uid in cl]) <= finished_keys]
+        if len(new_finished_clusters) == 0:
+            return cpath
+        finished_uids = set([uid for cl in new_finished_clusters for uid in cl])
+
+        new_cpath = ClusterPath(seed_unique_id=self.args.seed_unique_id)
+        for ip in range(len(cpath.partitions)):
+            partition = [cl for cl in cpath.partitions[ip] if len(finished_uids & set(cl)) == 0]
+            n_kept = sum([len(cl) for cl in partition])
+            if n_kept + len(finished_uids) != sum([len(cl) for cl in cpath.partitions[ip]]):  # some cluster in this partition straddles finished and unfinished blocks (can only happen with vj family blocking), so skip the partition
+                continue
+            new_cpath.add_partition(partition, cpath.logprobs[ip], cpath.n_procs[ip], logweight=cpath.logweights[ip])  # NOTE these logprobs are placeholders from a multi-process step anyway (bcrham only calculates partition logprobs in the last, single-process, step)
+        self.finished_clusters += new_finished_clusters
+        print '      holding out %d finished %s (%d clusters with %d sequences)' % (len(finished_keys), utils.plural_str('block', len(finished_keys)), len(new_finished_clusters), len(finished_uids))
+        return new_cpath
+
+    # ----------------------------------------------------------------------------------------
+    def stitch_finished_blocks(self, cpath):
+        """ add the clusters from finished blocks back into each partition in <cpath>, and their logprob into each partition's logprob """
+        print '    stitching %d clusters from finished blocks into final partitions' % len(self.finished_clusters)
+        finished_logprob = self.get_finished_logprob()
+        new_cpath = ClusterPath(seed_unique_id=self.args.seed_unique_id)
+        for ip in range(len(cpath.partitions)):
+            logprob = cpath.logprobs[ip] if len(cpath.partitions[ip]) > 0 else 0.  # if every block finished before the last step, there's nothing left (and bcrham never calculated a logprob)
+            new_cpath.add_partition(cpath.partitions[ip] + self.finished_clusters, logprob + finished_logprob, cpath.n_procs[ip], logweight=cpath.logweights[ip])
+        return new_cpath
+
+    # ----------------------------------------------------------------------------------------
+    def get_finished_logprob(self):
+        """
+        Return the total logprob of the clusters in <self.finished_clusters>, i.e. the sum of their forward logprobs (which is how bcrham calculates a partition's logprob).
+        Most of them are in the cache already (bcrham needed them to decide not to merge them), so we only run forward on the rest.
+        """
+        hmm_cache = self.get_hmm_cache()
+        logprobs = OrderedDict([(':'.join(cl), None if hmm_cache is None else hmm_cache.get_logprob(':'.join(cl))) for cl in self.finished_clusters])
+        missing_clusters = [cl for cl in self.finished_clusters if logprobs[':'.join(cl)] is None]
+        if len(missing_clusters) > 0:
+            print '      calculating logprobs for %d finished %s that aren\'t in the cache' % (len(missing_clusters), utils.plural_str('cluster', len(missing_clusters)))
+            self.write_to_single_input_file(self.hmm_infname, missing_clusters, self.sub_param_dir, set())
+            cmd_str = self.get_hmm_cmd_str('forward', self.hmm_infname, self.hmm_outfname, parameter_dir=self.sub_param_dir, precache_all_naive_seqs=False, n_procs=1, partition_step=False)
+            self.execute(cmd_str, n_procs=1)
+            with open(self.hmm_outfname) as outfile:
+                for line in csv.DictReader(outfile):
+                    logprobs[line['unique_ids']] = float(line['logprob']) if line['logprob'] != '' else float('-inf')  # empty means no path
+            os.remove(self.hmm_infname)
+            os.remove(self.hmm_outfname)
+        missing_keys = [key for key, logprob in logprobs.items() if logprob is None]
+        if len(missing_keys) > 0:
+            raise Exception('didn\'t get logprobs for %d finished clusters (e.g. %s)' % (len(missing_keys), missing_keys[0]))
+        return sum(logprobs.values())
+
+    # ----------------------------------------------------------------------------------------
+    def get_bcrham_cost(self, line):
+        """ rough estimate of how long bcrham will spend on the cluster in hmm input line <line>: number of seqs times seq length times the number of genes times the size of k space """
+        seqs = line['seqs'].split(':')
+        n_genes = len(line['only_genes'].split(':'))
+        k_space_size = (int(line['k_v_max']) - int(line['k_v_min'])) * (int(line['k_d_max']) - int(line['k_d_min']))
+        return float(len(seqs) * len(seqs[0]) * n_genes * max(1, k_space_size))
+
+    # ----------------------------------------------------------------------------------------
+    def deal_to_procs(self, info, n_procs, hfrac_bound=None):
+        """
+        Divvy up the hmm input lines in <info> among <n_procs> processes, balancing the estimated cost in each process.
+        Units (either single clusters, or blocks of clusters if we're blocking) are handed out, most expensive first, to whichever proc currently has the smallest total (i.e. longest-processing-time-first scheduling).
+        If <hfrac_bound> is set, anything that needs to be split up (the whole sample, or blocks that are too big for one proc) is split such that clusters with naive sequences closer than <hfrac_bound> tend to stay together.
+        """
+        costs = [self.get_bcrham_cost(line) for line in info]
+
+        blocks = OrderedDict()
+        if self.blocking():
+            for iline in range(len(info)):
+                key = self.get_block_key(info[iline]['names'].split(':'))
+                if key not in blocks:
+                    blocks[key] = []
+                blocks[key].append(iline)
+        elif len(info) > 0:
+            blocks[None] = range(len(info))  # no blocking, i.e. one big block
+
+        units = []  # list of (cost, key, line indices)
+        cost_per_proc = sum(costs) / n_procs
+        for key, ilines in blocks.items():
+            block_cost = sum([costs[iline] for iline in ilines])
+            n_pieces = n_procs if key is None else int(math.ceil(block_cost / cost_per_proc))
+            if hfrac_bound is not None and n_pieces > 1:  # split into pieces of similar naive sequences
+                naive_seqs = OrderedDict([(iline, self.sw_info[info[iline]['names'].split(':')[0]]['naive_seq']) for iline in ilines])  # NOTE just uses the sw naive seq of the first sequence in each cluster
+                glomerer = Glomerator()
+                pieces = glomerer.naive_seq_glomerate(naive_seqs, n_pieces, threshold=hfrac_bound, costs={iline : costs[iline] for iline in ilines}, debug=self.args.debug)
+                units += [(sum([costs[iline] for iline in piece]), key, piece) for piece in pieces if len(piece) > 0]
+            elif key is None:  # each cluster on its own, in (shuffled) input order
+                units += [(costs[iline], None, [iline, ]) for iline in ilines]
+            else:  # split the block into share-sized pieces, in (shuffled) input order
+                piece, piece_cost = [], 0.
+                for iline in ilines:
+                    if len(piece) > 0 and piece_cost + costs[iline] > cost_per_proc:
+                        units.append((piece_cost, key, piece))
+                        piece, piece_cost = [], 0.
+                    piece.append(iline)
+                    piece_cost += costs[iline]
+                units.append((piece_cost, key, piece))
+
+        proc_info = [[] for _ in range(n_procs)]
+        self.block_procs = {}
+        loads = [(0., iproc) for iproc in range(n_procs)]  # heap of (total cost, iproc)
+        for cost, key, ilines in sorted(units, key=operator.itemgetter(0), reverse=True):  # NOTE sort is stable, so equal-cost units stay in (shuffled) input order
+            load, iproc = heapq.heappop(loads)
+            proc_info[iproc] += [info[iline] for iline in ilines]
+            if key is not None:
+                if key not in self.block_procs:
+                    self.block_procs[key] = set()
+                self.block_procs[key].add(iproc)
+            heapq.heappush(loads, (load + cost, iproc))
+        for iproc in [ip for ip in range(n_procs) if len(proc_info[ip]) == 0]:  # bcrham needs at least one cluster in each proc (we can end up with empty ones if there's only a few big units), so take one from the proc with the most
+            ifull = max(range(n_procs), key=lambda ip: len(proc_info[ip]))
+            if len(proc_info[ifull]) < 2:
+                raise Exception('fewer clusters (%d) than procs (%d)' % (len(info), n_procs))
+            proc_info[iproc].append(proc_info[ifull].pop())
+            key = self.get_block_key(proc_info[iproc][0]['names'].split(':')) if self.blocking() else None
+            if key is not None:
+                self.block_procs[key].add(iproc)
+
+        if self.args.debug:
+            proc_costs = sorted([load for load, _ in loads])
+            print '      estimated per-proc cost: min %.0f  max %.0f  (%.2f of mean)' % (proc_costs[0], proc_costs[-1], proc_costs[-1] / numpy.mean(proc_costs) if sum(proc_costs) > 0. else 0.)
+
+        return proc_info
+
     # ----------------------------------------------------------------------------------------
     def get_next_n_procs(self, n_procs, n_proc_list, cpath):
         next_n_procs = n_procs
@@ -391,25 +713,46 @@ class PartitionDriver(object):
             print '  ' + utils.color('red', 'warning') + ' ' + warnstr
 
     # ----------------------------------------------------------------------------------------
-    def get_n_precache_procs(self):
+    def get_n_precache_procs(self, n_seqs=None):
         if self.args.n_precache_procs is not None:
             return self.args.n_precache_procs
 
-        n_seqs = len(self.sw_info['queries'])
+        if n_seqs is None:
+            n_seqs = len(self.sw_info['queries'])
         seqs_per_proc = 500  # 2.5 mins (at something like 0.3 sec/seq)
         if n_seqs > 3000:
             seqs_per_proc *= 2
         if n_seqs > 10000:
             seqs_per_proc *= 1.5
-        n_precache_procs = int(math.ceil(float(n_seqs) / seqs_per_proc))
+        n_precache_procs = max(1, int(math.ceil(float(n_seqs) / seqs_per_proc)))
         n_precache_procs = min(n_precache_procs, self.args.n_max_procs)  # I can't get more'n a few hundred slots at a time, so it isn't worth using too much more than that
         if not self.args.slurm and not utils.auto_slurm(self.args.n_procs):  # if we're not on slurm, make sure it's less than the number of cpus
             n_precache_procs = min(n_precache_procs, multiprocessing.cpu_count())
 
         return n_precache_procs
 
+    # ----------------------------------------------------------------------------------------
+    def expand_duplicates_in_partition(self, partition):
+        """ return a new partition in which each cluster also includes the duplicates of its uids (see --collapse-duplicate-sequences) """
+        return [cluster + [dup for uid in cluster for dup in self.duplicates.get(uid, [])] for cluster in partition]
+
+    # ----------------------------------------------------------------------------------------
+    def expand_duplicates_in_clusterpath(self, cpath):
+        """ return a new cluster path with the duplicates added back into each partition (the ccfs are left unset, so they get recalculated with the duplicates) """
+        expanded_cpath = ClusterPath(initial_path_index=cpath.initial_path_index, seed_unique_id=cpath.seed_unique_id)
+        for ip in range(len(cpath.partitions)):
+            expanded_cpath.add_partition(self.expand_duplicates_in_partition(cpath.partitions[ip]), cpath.logprobs[ip], cpath.n_procs[ip], logweight=cpath.logweights[ip])
+        return expanded_cpath
+
     # ----------------------------------------------------------------------------------------
     def write_clusterpaths(self, outfname, cpath):
+        seq_info = self.input_info
+        if len(self.duplicates) > 0:
+            cpath = self.expand_duplicates_in_clusterpath(cpath)
+            seq_info = dict(self.input_info)
+            for uid, dups in self.duplicates.items():
+                for dup in dups:
+                    seq_info[dup] = self.input_info[uid]  # same sequence, so we can use the representative's info
         outfile, writer = cpath.init_outfile(outfname, self.args.is_data)
         true_partition = None
         if not self.args.is_data:
@@ -420,7 +763,7 @@ class PartitionDriver(object):
         if self.args.presto_output:
             outstr = check_output(['mv', '-v', self.args.outfname, self.args.outfname + '.partis'])
             print '    backing up partis output before converting to presto: %s' % outstr.strip()
-            cpath.write_presto_partitions(self.args.outfname, self.input_info)
+            cpath.write_presto_partitions(self.args.outfname, seq_info)
 
     # ----------------------------------------------------------------------------------------
     def cluster_with_naive_vsearch_or_swarm(self, parameter_dir):
@@ -517,7 +860,7 @@ class PartitionDriver(object):
         self.check_partition(partition)
         ccfs = [None, None]
         if not self.args.is_data:  # it's ok to always calculate this since it's only ever for one partition
-            true_partition = utils.get_true_partition(self.reco_info)
+            true_partition = utils.get_true_partition(self.reco_info, ids=[uid for cluster in partition for uid in cluster])
             ccfs = utils.new_ccfs_that_need_better_names(partition, true_partition, self.reco_info)
         cpath = ClusterPath(seed_unique_id=self.args.seed_unique_id)
         cpath.add_partition(partition, logprob=0.0, n_procs=1, ccfs=ccfs)
@@ -531,9 +874,13 @@ class PartitionDriver(object):
 
     # ----------------------------------------------------------------------------------------
     def get_naive_hamming_bounds(self, parameter_dir):
+        if parameter_dir in self.naive_hamming_bounds:  # already worked them out (this gets called every agglomeration step)
+            return self.naive_hamming_bounds[parameter_dir]
+
         if self.args.naive_hamming_bounds is not None:  # let the command line override auto bound calculation
             print '       naive hfrac bounds: %.3f %.3f' % tuple(self.args.naive_hamming_bounds)
-            return self.args.naive_hamming_bounds
+            self.naive_hamming_bounds[parameter_dir] = self.args.naive_hamming_bounds
+            return self.naive_hamming_bounds[parameter_dir]
 
         mutehist = Hist(fname=parameter_dir + '/all-mean-mute-freqs.csv')
         mute_freq = mutehist.get_mean(ignore_overflows=True)
@@ -556,10 +903,11 @@ class PartitionDriver(object):
             hi = utils.intexterpolate(x1, y1, x2, y2, mute_freq)  # ...and never merge 'em if it's bigger than this
 
         print '       naive hfrac bounds: %.3f %.3f   (%.3f mutation in %s)' % (lo, hi, mute_freq, parameter_dir)
-        return [lo, hi]
+        self.naive_hamming_bounds[parameter_dir] = [lo, hi]
+        return self.naive_hamming_bounds[parameter_dir]
 
     # ----------------------------------------------------------------------------------------
-    def get_hmm_cmd_str(self, algorithm, csv_infname, csv_outfname, parameter_dir, precache_all_naive_seqs, n_procs):
+    def get_hmm_cmd_str(self, algorithm, csv_infname, csv_outfname, parameter_dir, precache_all_naive_seqs, n_procs, partition_step=True):
         """ Return the appropriate bcrham command string """
         cmd_str = self.args.partis_dir + '/packages/ham/bcrham'
         if self.args.slurm or utils.auto_slurm(n_procs):
@@ -570,6 +918,8 @@ class PartitionDriver(object):
         cmd_str += ' --hmmdir ' + os.path.abspath(parameter_dir) + '/hmms'
         cmd_str += ' --datadir ' + self.my_gldir
         cmd_str += ' --infile ' + csv_infname
+        if self.hmm_seqfname is not None:
+            cmd_str += ' --seqfile ' + self.hmm_seqfname
         cmd_str += ' --outfile ' + csv_outfname
         cmd_str += ' --chain ' + self.args.chain
         cmd_str += ' --random-seed ' + str(self.args.seed)
@@ -582,7 +932,7 @@ class PartitionDriver(object):
             cmd_str += ' --dont-rescale-emissions'
         if self.args.print_cluster_annotations and n_procs == 1:
             cmd_str += ' --annotationfile ' + self.annotation_fname
-        if self.current_action == 'partition':
+        if self.current_action == 'partition' and partition_step:  # (otherwise we're just running forward on some clusters, e.g. in get_finished_logprob())
             cmd_str += ' --cachefile ' + self.hmm_cachefname
             if precache_all_naive_seqs:
                 cmd_str += ' --cache-naive-seqs'
@@ -617,12 +967,28 @@ class PartitionDriver(object):
         else:
             return self.args.workdir + '/hmm-' + str(iproc)
 
+    # ----------------------------------------------------------------------------------------
+    def remove_hmm_subworkdirs(self):
+        """ remove the (by now empty) bcrham subworkdirs, which we leave in place between agglomeration steps so we don't have to keep re-making them """
+        for subworkdir in self.hmm_subworkdirs:
+            if os.path.exists(subworkdir):
+                os.rmdir(subworkdir)
+        self.hmm_subworkdirs = set()
+
     # ----------------------------------------------------------------------------------------
     def check_wait_times(self, wait_time):
         max_bcrham_time = max([procinfo['time']['bcrham'] for procinfo in self.bcrham_proc_info])
         if max_bcrham_time > 0. and wait_time / max_bcrham_time > 1.5 and wait_time > 30.:  # if we were waiting for a lot longer than the slowest process took, and if it took long enough for us to care
             print '    spent much longer waiting for bcrham (%.1fs) than bcrham reported taking (max per-proc time %.1fs)' % (wait_time, max_bcrham_time)
 
+    # ----------------------------------------------------------------------------------------
+    def close_bcrham_pool(self):
+        if self.bcrham_pool is None:
+            return
+        print '    closing bcrham worker pool (started %d %s)' % (self.bcrham_pool.n_workers_started, utils.plural_str('worker', self.bcrham_pool.n_workers_started))
+        self.bcrham_pool.close()
+        self.bcrham_pool = None
+
     # ----------------------------------------------------------------------------------------
     def execute(self, cmd_str, n_procs):
         # ----------------------------------------------------------------------------------------
@@ -646,17 +1012,29 @@ class PartitionDriver(object):
                    'outfname' : get_outfname(iproc),
                    'dbgfo' : self.bcrham_proc_info[iproc]}
                   for iproc in range(n_procs)]
-        utils.run_cmds(cmdfos, debug='print' if (self.args.debug or self.current_action=='partition') else None)
+        if self.bcrham_pool is not None:
+            bcrham_path = self.args.partis_dir + '/packages/ham/bcrham'
+            for cmdfo in cmdfos:
+                cmdfo['job_str'] = cmdfo['cmd_str'][cmdfo['cmd_str'].index(bcrham_path) + len(bcrham_path) : ].strip()
+            self.bcrham_pool.run(cmdfos)
+            executor = None
+        else:
+            straggler_factor = self.args.straggler_factor if (n_procs > 1 and self.args.straggler_factor > 0.) else None
+            executor = utils.run_cmds(cmdfos, debug='print' if (self.args.debug or self.current_action=='partition') else None, straggler_factor=straggler_factor)
 
-        print '      time waiting for bcrham: %.1f' % (time.time()-start)
+        print '      time waiting for bcrham: %.1f' % (time.time()-start),
+        if executor is not None and executor.n_speculative > 0:
+            print '   (%d speculative %s, %d finished first)' % (executor.n_speculative, utils.plural_str('duplicate', executor.n_speculative), executor.n_speculative_wins),
+        print ''
         self.check_wait_times(time.time()-start)
         sys.stdout.flush()
 
     # ----------------------------------------------------------------------------------------
-    def run_hmm(self, algorithm, parameter_in_dir, parameter_out_dir='', count_parameters=False, n_procs=None, precache_all_naive_seqs=False, cpath=None, shuffle_input=False):
+    def run_hmm(self, algorithm, parameter_in_dir, parameter_out_dir='', count_parameters=False, n_procs=None, precache_all_naive_seqs=False, cpath=None, shuffle_input=False, queries=None):
         """ 
         Run bcrham, possibly with many processes, and parse and interpret the output.
         NOTE the local <n_procs>, which overrides the one from <self.args>
+        If <queries> is set, we only run on them (rather than on all of self.sw_info['queries']) -- this doesn't apply to partitioning, where the queries are in <cpath>.
         """
         start = time.time()
         print 'hmm'
@@ -667,16 +1045,21 @@ class PartitionDriver(object):
         if n_procs is None:
             n_procs = self.args.n_procs
 
-        self.write_hmm_input(algorithm, parameter_in_dir, cpath, shuffle_input=shuffle_input)
+        hmm_input_lines = self.write_hmm_input(algorithm, parameter_in_dir, cpath, shuffle_input=shuffle_input, queries=queries, write_file=(n_procs == 1))  # with more than one proc, we write the subprocess input files directly from the lines
 
         cmd_str = self.get_hmm_cmd_str(algorithm, self.hmm_infname, self.hmm_outfname, parameter_dir=parameter_in_dir, precache_all_naive_seqs=precache_all_naive_seqs, n_procs=n_procs)
 
         if n_procs > 1:
-            self.split_input(n_procs, self.hmm_infname)
+            hfrac_bound = None
+            if shuffle_input and not self.args.random_redistribution:  # keep likely clonemates in the same process
+                hfrac_bound = self.get_naive_hamming_bounds(parameter_in_dir)[1]
+            self.split_input(n_procs, hmm_input_lines, hfrac_bound=hfrac_bound)
 
         self.execute(cmd_str, n_procs)
 
         new_cpath = self.read_hmm_output(algorithm, n_procs, count_parameters, parameter_out_dir, precache_all_naive_seqs)
+        if cpath is None:  # if we're in the partition loop, we leave the subworkdirs for the next step
+            self.remove_hmm_subworkdirs()
         print '      hmm step time: %.1f' % (time.time()-start)
         return new_cpath
 
@@ -702,9 +1085,11 @@ class PartitionDriver(object):
         naive_seqs = self.get_sw_naive_seqs(info, namekey)
         cachefo = self.read_cachefile()
         n_total, n_cached = 0, 0
-        for id_a, id_b in itertools.combinations(naive_seqs.keys(), 2):
-            seq_a, seq_b = naive_seqs[id_a], naive_seqs[id_b]
-            hfrac = utils.hamming_fraction(seq_a, seq_b)
+        names = naive_seqs.keys()
+        hfracs = utils.hamming_fraction_matrix([naive_seqs[name] for name in names])
+        for ia, ib in itertools.combinations(range(len(names)), 2):
+            id_a, id_b = names[ia], names[ib]
+            hfrac = hfracs[ia, ib]
             if hfrac >= self.args.hamming_fraction_bounds[0] and hfrac <= self.args.hamming_fraction_bounds[1]:  # NOTE not sure the equals match up exactly with what's in ham, but it's an estimate, so it doesn't matter
                 n_total += 1
                 if join_names(id_a, id_b) in cachefo:
@@ -739,28 +1124,26 @@ class PartitionDriver(object):
         return naive_seqs
 
     # ----------------------------------------------------------------------------------------
-    def split_input(self, n_procs, infname):
+    def split_input(self, n_procs, hmm_input_lines, hfrac_bound=None):
+        """ write the bcrham input lines in <hmm_input_lines> (from write_to_single_input_file()) to input files for <n_procs> subprocesses """
 
         # should we pull out the seeded clusters, and carefully re-inject them into each process?
         separate_seeded_clusters = self.args.seed_unique_id is not None and not (self.already_removed_unseeded_clusters or self.time_to_remove_unseeded_clusters)  # I think I ony actually need one of the latter bools
 
-        # read single input file
         info = []
         seeded_clusters = {}
-        with opener('r')(infname) as infile:
-            reader = csv.DictReader(infile, delimiter=' ')
-            for line in reader:
-                if separate_seeded_clusters and self.args.seed_unique_id in set(line['names'].split(':')):
-                    if len(seeded_clusters) > 0 and ':' not in line['names']:  # the first time through, we add the seed uid to *every* process. So, when we read those results back in, the procs that didn't merge the seed with anybody will have it as a singleton still, and we only need the singleton once
-                        continue
-                    seeded_clusters[line['names']] = line
-                    continue  # don't want the seeded clusters mixed in with the non-seeded clusters just yet (see below)
-                info.append(line)
+        for line in hmm_input_lines:
+            if separate_seeded_clusters and self.args.seed_unique_id in set(line['names'].split(':')):
+                if len(seeded_clusters) > 0 and ':' not in line['names']:  # the first time through, we add the seed uid to *every* process. So, when we read those results back in, the procs that didn't merge the seed with anybody will have it as a singleton still, and we only need the singleton once
+                    continue
+                seeded_clusters[line['names']] = line
+                continue  # don't want the seeded clusters mixed in with the non-seeded clusters just yet (see below)
+            info.append(line)
 
         # find the smallest seeded cluster
         if separate_seeded_clusters:
             if len(seeded_clusters) == 0:
-                raise Exception('couldn\'t find info for seed query %s in %s' % (self.args.seed_unique_id, infname))
+                raise Exception('couldn\'t find info for seed query %s in hmm input' % self.args.seed_unique_id)
             smallest_seed_cluster_str = None
             for unique_id_str in seeded_clusters:
                 if smallest_seed_cluster_str is None or len(unique_id_str.split(':')) < len(smallest_seed_cluster_str.split(':')):
@@ -770,14 +1153,14 @@ class PartitionDriver(object):
         def get_sub_outfile(siproc, mode):
             subworkdir = self.subworkdir(siproc, n_procs)
             if mode == 'w':
-                utils.prep_dir(subworkdir)
-                if os.path.exists(self.hmm_cachefname):  # copy cachefile to this subdir
-                    check_call(['cp', self.hmm_cachefname, subworkdir + '/'])
-            return open(subworkdir + '/' + os.path.basename(infname), mode)
+                if subworkdir not in self.hmm_subworkdirs:  # left over from a previous step, it should be empty (subprocess files are removed when we merge them)
+                    utils.prep_dir(subworkdir)
+                    self.hmm_subworkdirs.add(subworkdir)
+            return open(subworkdir + '/' + os.path.basename(self.hmm_infname), mode)
 
         # ----------------------------------------------------------------------------------------
         def get_writer(sub_outfile):
-            return csv.DictWriter(sub_outfile, reader.fieldnames, delimiter=' ')
+            return csv.DictWriter(sub_outfile, self.get_hmm_input_headers(), delimiter=' ', extrasaction='ignore')
 
         # initialize output files
         for iproc in range(n_procs):
@@ -787,29 +1170,58 @@ class PartitionDriver(object):
 
         # self.get_expected_number_of_forward_calculations(info, 'names', 'seqs')  # I think this didn't work that well
 
+        proc_info = self.deal_to_procs(info, n_procs, hfrac_bound=hfrac_bound)
+        hmm_cache = self.get_hmm_cache()
         seed_clusters_to_write = seeded_clusters.keys()  # the keys in <seeded_clusters> that we still need to write
         for iproc in range(n_procs):
-            sub_outfile = get_sub_outfile(iproc, 'a')
-            writer = get_writer(sub_outfile)
+            lines_to_write = []
 
             # first deal with the seeded clusters
             if separate_seeded_clusters:  # write the seed info line to each file
                 if len(seed_clusters_to_write) > 0:
                     if iproc < n_procs - 1:  # if we're not on the last proc, pop off and write the first one
-                        writer.writerow(seeded_clusters[seed_clusters_to_write.pop(0)])
+                        lines_to_write.append(seeded_clusters[seed_clusters_to_write.pop(0)])
                     else:
                         while len(seed_clusters_to_write) > 0:  # keep adding 'em until we run out
-                            writer.writerow(seeded_clusters[seed_clusters_to_write.pop(0)])
+                            lines_to_write.append(seeded_clusters[seed_clusters_to_write.pop(0)])
                 else:  # if we don't have any more that we *need* to write (i.e. that have other seqs in them), just write the shortest one (which will frequently be a singleton)
-                    writer.writerow(seeded_clusters[smallest_seed_cluster_str])
+                    lines_to_write.append(seeded_clusters[smallest_seed_cluster_str])
 
-            # then loop over the non-seeded clusters
-            for iquery in range(len(info)):
-                if iquery % n_procs != iproc:
-                    continue
-                writer.writerow(info[iquery])
+            # then the non-seeded clusters
+            lines_to_write += proc_info[iproc]
+
+            sub_outfile = get_sub_outfile(iproc, 'a')
+            writer = get_writer(sub_outfile)
+            for line in lines_to_write:
+                writer.writerow(line)
             sub_outfile.close()
 
+            if hmm_cache is not None:  # write the bits of the cache file that this proc can use (i.e. entries for which it has all the uids)
+                proc_uids = set([uid for line in lines_to_write for uid in line['names'].split(':')])
+                hmm_cache.write_subset(self.subworkdir(iproc, n_procs) + '/' + os.path.basename(self.hmm_cachefname), proc_uids)
+
+    # ----------------------------------------------------------------------------------------
+    def get_hmm_cache(self):
+        """ return the index into the partition cache file (or None if the cache file doesn't exist yet) """
+        if self.hmm_cache is None and os.path.exists(self.hmm_cachefname):
+            self.hmm_cache = PartitionCache(self.hmm_cachefname)
+        return self.hmm_cache
+
+    # ----------------------------------------------------------------------------------------
+    def merge_subprocess_cachefiles(self, n_procs):
+        """ append new entries from each subprocess's cache file (they only have the *new* values) to the main cache file """
+        if self.hmm_cache is None:  # no cache file before this step (e.g. precaching with no persistent cache file), so start one
+            self.hmm_cache = PartitionCache(self.hmm_cachefname)
+        n_new = 0
+        for iproc in range(n_procs):
+            subfname = self.subworkdir(iproc, n_procs) + '/' + os.path.basename(self.hmm_cachefname)
+            if not os.path.exists(subfname):
+                continue
+            n_new += self.hmm_cache.append_new_entries(subfname)
+            os.remove(subfname)
+        if self.args.debug:
+            print '      added %d new cache entries (%d total)' % (n_new, len(self.hmm_cache))
+
     # ----------------------------------------------------------------------------------------
     def merge_subprocess_files(self, fname, n_procs, include_outfile=False):
         subfnames = []
@@ -880,7 +1292,9 @@ class PartitionDriver(object):
         cpath = None  # it would be nice to figure out a cleaner way to do this
         if self.current_action == 'partition':  # merge partitions from several files
             if n_procs > 1:
-                self.merge_subprocess_files(self.hmm_cachefname, n_procs, include_outfile=True)  # sub cache files only have new info
+                self.merge_subprocess_cachefiles(n_procs)
+            else:
+                self.hmm_cache = None  # bcrham rewrote the whole cache file, so we'll need to reindex it if we use it again
 
             if not precache_all_naive_seqs:
                 if n_procs == 1:
@@ -902,7 +1316,6 @@ class PartitionDriver(object):
                 os.remove(subworkdir + '/' + os.path.basename(self.hmm_infname))
                 if os.path.exists(subworkdir + '/' + os.path.basename(self.hmm_outfname)):
                     os.remove(subworkdir + '/' + os.path.basename(self.hmm_outfname))
-                os.rmdir(subworkdir)
 
         return cpath
 
@@ -915,6 +1328,8 @@ class PartitionDriver(object):
         from hmmwriter import HmmWriter
         hmm_dir = parameter_dir + '/hmms'
         utils.prep_dir(hmm_dir, '*.yaml')
+        self.hmm_file_genes.pop(parameter_dir, None)
+        self.combined_parameter_dir = None
 
         if self.args.debug:
             print '    to %s' % parameter_dir + '/hmms'
@@ -928,11 +1343,13 @@ class PartitionDriver(object):
 
     # ----------------------------------------------------------------------------------------
     def get_existing_hmm_files(self, parameter_dir):
-        fnames = [os.path.basename(fn) for fn in glob.glob(parameter_dir + '/hmms/*.yaml')]
-        genes = set([utils.unsanitize_name(os.path.splitext(fn)[0]) for fn in fnames])
-        if len(genes) == 0:
-            raise Exception('no yamels in %s' % parameter_dir + '/hmms')
-        return genes
+        if parameter_dir not in self.hmm_file_genes:  # they only change when we write hmms, so only glob the first time
+            fnames = [os.path.basename(fn) for fn in glob.glob(parameter_dir + '/hmms/*.yaml')]
+            genes = set([utils.unsanitize_name(os.path.splitext(fn)[0]) for fn in fnames])
+            if len(genes) == 0:
+                raise Exception('no yamels in %s' % parameter_dir + '/hmms')
+            self.hmm_file_genes[parameter_dir] = genes
+        return self.hmm_file_genes[parameter_dir]
 
     # ----------------------------------------------------------------------------------------
     def all_regions_present(self, gene_list, skipped_gene_matches, query_name, second_query_name=None):
@@ -951,6 +1368,55 @@ class PartitionDriver(object):
 
         return True
 
+    # ----------------------------------------------------------------------------------------
+    def get_query_features(self, name, genes_with_hmm_files):
+        """ return the info from sw for query <name> that combine_queries() needs (calculated the first time, and then cached until we get new sw info or hmms) """
+        if name not in self.query_features:
+            self.cache_query_features([name, ], genes_with_hmm_files)
+        return self.query_features[name]
+
+    # ----------------------------------------------------------------------------------------
+    def cache_query_features(self, names, genes_with_hmm_files):
+        """ add the info that combine_queries() needs to <self.query_features> for any queries in <names> that aren't already there, calculating their mutation frequencies all at once """
+        names = [name for name in set(names) if name not in self.query_features]
+        names_by_length = {}  # batch hamming needs equal-length sequences (which after padding they almost always are)
+        for name in names:
+            seqlen = seqpool.seq_length(self.sw_info[name], 'naive_seq')
+            if seqlen not in names_by_length:
+                names_by_length[seqlen] = []
+            names_by_length[seqlen].append(name)
+        mut_freqs = {}
+        for length_names in names_by_length.values():  # NOTE with --compact-sequences, these come straight from the sw info's sequence pool
+            naive_seqs = seqpool.encode_line_seqs([self.sw_info[name] for name in length_names], 'naive_seq')
+            mut_freqs.update(zip(length_names, utils.hamming_fractions(naive_seqs, seqpool.encode_line_seqs([self.sw_info[name] for name in length_names], 'seqs', iseq=0))))
+
+        for name in names:
+            swfo = self.sw_info[name]
+            assert len(swfo['seqs']) == 1  # checking that when we filled in 'seqs' all was well
+
+            # work out which genes to tell the hmm to use
+            genes_to_use, skipped_genes = set(), set()
+            for region in utils.regions:  # take the best <self.args.n_max_per_region> from each region
+                n_reg_genes = 0
+                for gene in swfo['all_matches'][region]:  # ordered by sw match quality
+                    if gene not in genes_with_hmm_files:
+                        skipped_genes.add(gene)
+                        continue
+                    if n_reg_genes >= self.args.n_max_per_region[utils.regions.index(region)]:
+                        break
+                    genes_to_use.add(gene)
+                    n_reg_genes += 1
+
+            self.query_features[name] = {
+                'seq' : swfo['seqs'][0],
+                'mut_freq' : mut_freqs[name],
+                'cdr3_length' : swfo['cdr3_length'],
+                'k_v' : swfo['k_v'],
+                'k_d' : swfo['k_d'],
+                'only_genes' : genes_to_use,
+                'skipped_genes' : skipped_genes,
+            }
+
     # ----------------------------------------------------------------------------------------
     def combine_queries(self, query_names, genes_with_hmm_files, skipped_gene_matches=None):
         """ 
@@ -960,42 +1426,23 @@ class PartitionDriver(object):
         # Note that this whole thing probably ought to use cached hmm info if it's available.
         # Also, this just always uses the SW mutation rate, but I should really update it with the (multi-)hmm-derived ones (same goes for k space boundaries)
 
+        features = [self.get_query_features(name, genes_with_hmm_files) for name in query_names]
+
         combo = {}
-        combo['seqs'] = [self.sw_info[name]['seqs'][0] for name in query_names]
-        combo['mut_freq'] = numpy.mean([utils.hamming_fraction(self.sw_info[name]['naive_seq'], self.sw_info[name]['seqs'][0]) for name in query_names])
-        cdr3_lengths = [self.sw_info[name]['cdr3_length'] for name in query_names]
+        combo['seqs'] = [qfo['seq'] for qfo in features]
+        combo['mut_freq'] = numpy.mean([qfo['mut_freq'] for qfo in features])
+        cdr3_lengths = [qfo['cdr3_length'] for qfo in features]
         if cdr3_lengths.count(cdr3_lengths[0]) != len(cdr3_lengths):
             print '%s cdr3 lengths not all the same %s' % (utils.color('red', 'warning'), ' '.join([str(c) for c in cdr3_lengths]))
         combo['cdr3_length'] = cdr3_lengths[0]
 
-        combo['k_v'] = {'min' : 99999, 'max' : -1}
-        combo['k_d'] = {'min' : 99999, 'max' : -1}
-        combo['only_genes'] = []
-        for name in query_names:
-            swfo = self.sw_info[name]
-            k_v = swfo['k_v']
-            k_d = swfo['k_d']
-            assert len(swfo['seqs']) == 1  # checking that when we filled in 'seqs' all was well
-            combo['k_v']['min'] = min(k_v['min'], combo['k_v']['min'])
-            combo['k_v']['max'] = max(k_v['max'], combo['k_v']['max'])
-            combo['k_d']['min'] = min(k_d['min'], combo['k_d']['min'])
-            combo['k_d']['max'] = max(k_d['max'], combo['k_d']['max'])
-
-            # work out which genes to tell the hmm to use
-            genes_to_use = set()
-            for region in utils.regions:  # take the best <self.args.n_max_per_region> from each region
-                reg_genes = []
-                for gene in swfo['all_matches'][region]:  # ordered by sw match quality
-                    if gene not in genes_with_hmm_files:
-                        skipped_gene_matches.add(gene)
-                        continue
-                    if len(reg_genes) >= self.args.n_max_per_region[utils.regions.index(region)]:
-                        break
-                    reg_genes.append(gene)
-                genes_to_use |= set(reg_genes)
-
-            # and finally OR this query's genes into the ones from previous queries
-            combo['only_genes'] = list(set(genes_to_use) | set(combo['only_genes']))  # NOTE using the OR of all sets of genes (from all query seqs) like this *really* helps,
+        combo['k_v'] = {'min' : min([qfo['k_v']['min'] for qfo in features]), 'max' : max([qfo['k_v']['max'] for qfo in features])}
+        combo['k_d'] = {'min' : min([qfo['k_d']['min'] for qfo in features]), 'max' : max([qfo['k_d']['max'] for qfo in features])}
+        only_genes = set()
+        for qfo in features:
+            only_genes |= qfo['only_genes']  # NOTE using the OR of all sets of genes (from all query seqs) like this *really* helps,
+            skipped_gene_matches |= qfo['skipped_genes']
+        combo['only_genes'] = list(only_genes)
 
         if not self.all_regions_present(combo['only_genes'], skipped_gene_matches, query_names):
             return {}
@@ -1044,18 +1491,19 @@ class PartitionDriver(object):
 
     # ----------------------------------------------------------------------------------------
     def write_to_single_input_file(self, fname, nsets, parameter_dir, skipped_gene_matches, shuffle_input=False):
-        csvfile = opener('w')(fname)
-        header = ['names', 'k_v_min', 'k_v_max', 'k_d_min', 'k_d_max', 'mut_freq', 'cdr3_length', 'only_genes', 'seqs']
-        writer = csv.DictWriter(csvfile, header, delimiter=' ')
-        writer.writeheader()
+        """ return the bcrham input line for each cluster in <nsets>, and also write them to <fname> unless it's None """
+        input_lines = []
 
-        if shuffle_input:  # shuffle nset order (this is absolutely critical when clustering with more than one process, in order to redistribute sequences among the several processes)
+        if shuffle_input:  # shuffle nset order (this is absolutely critical when clustering with more than one process, in order to redistribute sequences among the several processes, and even without --random-redistribution it changes which clusters end up as leaders in naive_seq_glomerate())
             random.shuffle(nsets)
 
         if self.args.synthetic_distance_based_partition:
             self.write_fake_cache_file(nsets)
 
         genes_with_hmm_files = self.get_existing_hmm_files(parameter_dir)
+        if parameter_dir != self.combined_parameter_dir:  # query features depend on which genes have hmms
+            self.query_features, self.combined_records = {}, {}
+            self.combined_parameter_dir = parameter_dir
 
         glfo_genes = set([g for r in utils.regions for g in self.glfo['seqs'][r]])
         if self.args.only_genes is None and len(genes_with_hmm_files - glfo_genes) > 0:
@@ -1063,28 +1511,51 @@ class PartitionDriver(object):
         if len(glfo_genes - genes_with_hmm_files) > 0:
             print '  %s no hmm files for glfo genes %s' % (utils.color('red', 'warning'), ' '.join(glfo_genes - genes_with_hmm_files))
 
+        self.cache_query_features([qn for query_name_list in nsets for qn in query_name_list if ':'.join(query_name_list) not in self.combined_records], genes_with_hmm_files)
+        combined_records = {}  # only keep the ones for this time through (most of them will still be around next step)
         for query_name_list in nsets:  # NOTE in principle I think I should remove duplicate singleton <seed_unique_id>s here. But I think they in effect get removed 'cause in bcrham everything's stored as hash maps, so any duplicates just overwites the original upon reading its input
-            combined_query = self.combine_queries(query_name_list, genes_with_hmm_files, skipped_gene_matches=skipped_gene_matches)
-            if len(combined_query) == 0:  # didn't find all regions
+            namestr = ':'.join(query_name_list)
+            if namestr in self.combined_records:  # cluster didn't change since last time
+                row = self.combined_records[namestr]
+                if self.args.debug:
+                    for qn in query_name_list:
+                        skipped_gene_matches |= self.query_features[qn]['skipped_genes']
+            else:
+                row = None
+                combined_query = self.combine_queries(query_name_list, genes_with_hmm_files, skipped_gene_matches=skipped_gene_matches)
+                if len(combined_query) > 0:  # otherwise we didn't find all regions
+                    row = {
+                        'names' : namestr,
+                        'k_v_min' : combined_query['k_v']['min'],
+                        'k_v_max' : combined_query['k_v']['max'],
+                        'k_d_min' : combined_query['k_d']['min'],
+                        'k_d_max' : combined_query['k_d']['max'],
+                        'mut_freq' : combined_query['mut_freq'],
+                        'cdr3_length' : combined_query['cdr3_length'],
+                        'only_genes' : ':'.join(combined_query['only_genes']),
+                        'seqs' : ':'.join(combined_query['seqs'])
+                    }
+            combined_records[namestr] = row
+            if row is None:
                 continue
-            writer.writerow({
-                'names' : ':'.join([qn for qn in query_name_list]),
-                'k_v_min' : combined_query['k_v']['min'],
-                'k_v_max' : combined_query['k_v']['max'],
-                'k_d_min' : combined_query['k_d']['min'],
-                'k_d_max' : combined_query['k_d']['max'],
-                'mut_freq' : combined_query['mut_freq'],
-                'cdr3_length' : combined_query['cdr3_length'],
-                'only_genes' : ':'.join(combined_query['only_genes']),
-                'seqs' : ':'.join(combined_query['seqs'])
-            })
-
-        csvfile.close()
-
-    # ----------------------------------------------------------------------------------------
-    def write_hmm_input(self, algorithm, parameter_dir, cpath, shuffle_input=False):
-        """ Write input file for bcrham """
+            input_lines.append(row)
+        self.combined_records = combined_records
+
+        if fname is not None:
+            with opener('w')(fname) as csvfile:
+                writer = csv.DictWriter(csvfile, self.get_hmm_input_headers(), delimiter=' ', extrasaction='ignore')
+                writer.writeheader()
+                for row in input_lines:
+                    writer.writerow(row)
+
+        return input_lines
+
+    # ----------------------------------------------------------------------------------------
+    def write_hmm_input(self, algorithm, parameter_dir, cpath, shuffle_input=False, queries=None, write_file=True):
+        """ Write input file for bcrham (unless <write_file> is False), and return the input lines """
         print '    writing input'
+        if queries is None:
+            queries = self.sw_info['queries']
 
         skipped_gene_matches = set()
 
@@ -1095,13 +1566,14 @@ class PartitionDriver(object):
                 self.already_removed_unseeded_clusters = True
         else:
             if self.args.n_sets == 1:  # single (non-multi) hmm (does the same thing as the below for n=1, but is more transparent)
-                nsets = [[qn] for qn in self.sw_info['queries']]
+                nsets = [[qn] for qn in queries]
             else:
                 if self.args.all_combinations:  # run on *every* combination of queries which has length <self.args.n_sets>
-                    nsets = itertools.combinations(self.sw_info['queries'], self.args.n_sets)
+                    nsets = itertools.combinations(queries, self.args.n_sets)
                 else:  # put the first n together, and the second group of n, and so forth (note that self.sw_info['queries'] is a list)
                     nsets = []
-                    keylist = [k for k in self.input_info.keys() if k in self.sw_info['queries']]  # we want the queries from sw (to skip failures), but the order from input_info
+                    query_set = set(queries)
+                    keylist = [k for k in self.input_info.keys() if k in query_set]  # we want the queries from sw (to skip failures), but the order from input_info
                     this_set = []
                     for iquery in range(len(keylist)):
                         if iquery % self.args.n_sets == 0:  # every nth query, start a new group
@@ -1112,7 +1584,7 @@ class PartitionDriver(object):
                     if len(this_set) > 0:
                         nsets.append(this_set)
 
-        self.write_to_single_input_file(self.hmm_infname, nsets, parameter_dir, skipped_gene_matches, shuffle_input=shuffle_input)
+        hmm_input_lines = self.write_to_single_input_file(self.hmm_infname if write_file else None, nsets, parameter_dir, skipped_gene_matches, shuffle_input=shuffle_input)
 
         if self.args.debug and len(skipped_gene_matches) > 0:
             print '    not found in %s, so removing from consideration for hmm (i.e. were only the nth best, but never the best sw match for any query):' % (parameter_dir),
@@ -1121,6 +1593,8 @@ class PartitionDriver(object):
                 print '\n      %s: %s' % (region, ' '.join([utils.color_gene(gene) for gene in sorted(skipped_gene_matches) if utils.get_region(gene) == region]))
             print ''
 
+        return hmm_input_lines
+
     # ----------------------------------------------------------------------------------------
     def read_hmm_output(self, algorithm, n_procs, count_parameters, parameter_out_dir, precache_all_naive_seqs):
         cpath = None  # would be nice to figure out a cleaner way to do this
@@ -1178,32 +1652,37 @@ class PartitionDriver(object):
         """
         a.t.m. we force bcrham to give us D of length one for light chains.
         Here, we delete the dummy D base, and give it to either V, J, or the insertion.
+        NOTE works directly from the explicit info in <line> (which is what we modify), so the caller only needs to add implicit info once, afterwards.
         """
-        tmpline = copy.deepcopy(line)
-        utils.add_implicit_info(self.glfo, tmpline)
         if debug:
             print ''
             print '  dummy d hack for %s' % ' '.join(line['unique_ids'])
+            tmpline = copy.deepcopy(line)
+            utils.add_implicit_info(self.glfo, tmpline)
             utils.print_reco_event(self.glfo['seqs'], tmpline, extra_str='    ', label='before')
 
+        full_v_gl_seq = self.glfo['seqs']['v'][line['v_gene']]
         gl_v_base = None
-        if tmpline['v_3p_del'] > 0:
-            full_v_gl_seq = self.glfo['seqs']['v'][tmpline['v_gene']]
-            gl_v_base = full_v_gl_seq[tmpline['lengths']['v']]
+        if line['v_3p_del'] > 0:
+            gl_v_base = full_v_gl_seq[len(full_v_gl_seq) - line['v_3p_del']]  # first deleted base at the 3' end of v
 
         gl_j_base = None
-        if tmpline['j_5p_del'] > 0 and len(tmpline['dj_insertion']) == 0:
-            full_j_gl_seq = self.glfo['seqs']['j'][tmpline['j_gene']]
-            gl_j_base = full_j_gl_seq[tmpline['j_5p_del'] - 1]
+        if line['j_5p_del'] > 0 and len(line['dj_insertion']) == 0:
+            full_j_gl_seq = self.glfo['seqs']['j'][line['j_gene']]
+            gl_j_base = full_j_gl_seq[line['j_5p_del'] - 1]
         if debug:
             print '    gl_j_base', gl_j_base
             print '    gl_v_base', gl_v_base
 
+        # position and length of the (dummy) d match in the query sequences (same as in utils.add_qr_seqs())
+        d_start = len(line['fv_insertion']) + len(full_v_gl_seq) - line['v_5p_del'] - line['v_3p_del'] + len(line['vd_insertion'])
+        d_length = len(self.glfo['seqs']['d'][line['d_gene']]) - line['d_5p_del'] - line['d_3p_del']
+
         # take a majority vote as to whom we should give the base
         votes = {'v' : 0, 'j' : 0, 'dj_insertion' : 0}
         qr_base_votes = {n : 0 for n in utils.expected_characters}
-        for iseq in range(len(tmpline['seqs'])):
-            d_qr_base = tmpline['d_qr_seqs'][iseq]
+        for seq in line['seqs']:
+            d_qr_base = seq[d_start : d_start + d_length]
             qr_base_votes[d_qr_base] += 1
             if d_qr_base == gl_v_base:
                 votes['v'] += 1
@@ -1221,7 +1700,7 @@ class PartitionDriver(object):
             print '   ', sorted_qr_base_votes
             print '    winner', winner, qr_base_winner
 
-        line['d_5p_del'] = 1  # NOTE we don't modify tmpline, i.e. we modify the line *without* implicit info, 'cause it's simpler
+        line['d_5p_del'] = 1
         if winner == 'v':
             assert line['v_3p_del'] > 0
             line['v_3p_del'] -= 1
@@ -1231,9 +1710,9 @@ class PartitionDriver(object):
             assert winner == 'dj_insertion'
             line['dj_insertion'] = qr_base_winner + line['dj_insertion']
 
-        after_line = copy.deepcopy(line)
-        utils.add_implicit_info(self.glfo, after_line)
         if debug:
+            after_line = copy.deepcopy(line)
+            utils.add_implicit_info(self.glfo, after_line)
             utils.print_reco_event(self.glfo['seqs'], after_line, extra_str='    ', label='after')
 
     # ----------------------------------------------------------------------------------------
@@ -1247,13 +1726,15 @@ class PartitionDriver(object):
         perfplotter = PerformancePlotter('hmm') if self.args.plot_performance else None
 
         n_lines_read, n_seqs_processed, n_events_processed, n_invalid_events = 0, 0, 0, 0
-        annotations = OrderedDict()
+        annotations = OrderedDict()  # only filled if we need them all at the end (i.e. for annotation clustering), otherwise we write each one as we go
+        writers = self.init_annotation_writers(outfname) if outfname is not None else None
         errorfo = {}
         with opener('r')(annotation_fname) as hmm_csv_outfile:
             reader = csv.DictReader(hmm_csv_outfile)
             for padded_line in reader:  # line coming from hmm output is N-padded such that all the seqs are the same length
 
                 utils.process_input_line(padded_line)
+                padded_line = utils.Annotation(padded_line)  # lots less memory than a dict if we're hanging on to them, and much cheaper copies
                 n_lines_read += 1
 
                 failed = self.check_did_bcrham_fail(padded_line, errorfo)
@@ -1290,15 +1771,16 @@ class PartitionDriver(object):
                     print '      %s' % uidstr
                     self.print_hmm_output(line_to_use, print_true=True)
 
-                assert uidstr not in annotations
-                annotations[uidstr] = line_to_use
-
                 n_events_processed += 1
 
                 if pcounter is not None:
-                    pcounter.increment(line_to_use)
+                    pcounter.increment(line_to_use, multiplicities=[1 + len(self.duplicates.get(uid, [])) for uid in uids])
                 if true_pcounter is not None:
-                    true_pcounter.increment(self.reco_info[uids[0]])  # NOTE doesn't matter which id you pass it, since they all have the same reco parameters
+                    true_uids = [uids[0], ]  # NOTE doesn't matter which id you pass it, since they all have the same reco parameters
+                    if len(uids) == 1:  # ...but duplicates of a single sequence would each have been their own event (and can have different true events)
+                        true_uids += self.duplicates.get(uids[0], [])
+                    for uid in true_uids:
+                        true_pcounter.increment(self.reco_info[uid])
 
                 for iseq in range(len(uids)):
                     singlefo = utils.synthesize_single_seq_line(line_to_use, iseq)
@@ -1310,6 +1792,13 @@ class PartitionDriver(object):
                             perfplotter.evaluate(self.reco_info[uids[iseq]], singlefo, padfo=padfo)
                     n_seqs_processed += 1
 
+                # NOTE do this last, since for presto output it recalculates the implicit info in place
+                if writers is not None:
+                    self.write_annotation(writers, line_to_use)
+                if self.args.annotation_clustering is not None:
+                    assert uidstr not in annotations
+                    annotations[uidstr] = line_to_use
+
         # parameter and performance writing/plotting
         if pcounter is not None:
             if self.args.plotdir is not None:
@@ -1335,9 +1824,9 @@ class PartitionDriver(object):
             else:
                 print '          %s unknown ecode \'%s\': %s' % (utils.color('red', 'warning'), ecode, ' '.join(errorfo[ecode]))
 
-        # write output file
-        if outfname is not None:
-            self.write_annotations(annotations, outfname)  # [0] takes the best annotation... if people want other ones later it's easy to change
+        # write empty lines for failed queries, and close output file
+        if writers is not None:
+            self.finish_annotation_writers(writers, outfname)
 
         # annotation (VJ CDR3) clustering
         if self.args.annotation_clustering is not None:
@@ -1363,6 +1852,8 @@ class PartitionDriver(object):
         import annotationclustering
         for thresh in self.args.annotation_clustering_thresholds:
             partition = annotationclustering.vollmers(annotations, threshold=thresh, reco_info=self.reco_info)
+            if len(self.duplicates) > 0:
+                partition = self.expand_duplicates_in_partition(partition)
             n_clusters = len(partition)
             if outfname is not None:
                 row = {'n_clusters' : n_clusters, 'threshold' : thresh, 'partition' : utils.get_str_from_partition(partition)}
@@ -1390,61 +1881,82 @@ class PartitionDriver(object):
         # outline['padlefts']
 
     # ----------------------------------------------------------------------------------------
-    def write_annotations(self, annotations, outfname):
+    def init_annotation_writers(self, outfname):
+        """ open <outfname> for writing annotations one at a time (if --presto-output is set, the presto version goes to <outfname>, and the partis version to <outfname>.partis) """
         outpath = outfname
         if outpath[0] != '/':  # if full output path wasn't specified on the command line, write to current directory
             outpath = os.getcwd() + '/' + outpath
 
-        with open(outpath, 'w') as outfile:
-            writer = csv.DictWriter(outfile, utils.annotation_headers)
-            writer.writeheader()
-            missing_input_keys = set(self.input_info.keys())  # all the keys we originially read from the file
-            for full_line in annotations.values():
-                outline = copy.deepcopy(full_line)  # in case we modify it
-
-                self.add_sw_info_to_hmm_outline(outline)
-
-                for uid in outline['unique_ids']:  # make a note that we have an annotation for these uids (so we can see if there's any that we're missing)
-                    missing_input_keys.remove(uid)
-
-                outline = utils.get_line_for_output(outline)  # convert lists to colon-separated strings and whatnot
-                outline = {k : v for k, v in outline.items() if k in utils.annotation_headers}  # remove the columns we don't want to output
-
-                writer.writerow(outline)
-
-            # and write empty lines for seqs that failed either in sw or the hmm
-            if len(missing_input_keys) > 0:
-                print '          missing %d input keys when writing hmm output to %s' % (len(missing_input_keys), outfname)
-                for uid in missing_input_keys:
-                    col = 'unique_ids'
-                    writer.writerow({col : uid})
-
+        writers = {'seen_uids' : set()}  # keep track of which uids we've written, so we can add empty lines for the ones that are missing
+        fnames = {'partis' : outpath}
         if self.args.presto_output:
-            outstr = check_output(['mv', '-v', self.args.outfname, self.args.outfname + '.partis'])
-            print '    backing up partis output before converting to presto: %s' % outstr.strip()
-
-            prestoheader = utils.presto_headers.values()
-            with open(outpath, 'w') as outfile:
-                writer = csv.DictWriter(outfile, prestoheader)
-                writer.writeheader()
-
-                for full_line in annotations.values():
-                    outline = copy.deepcopy(full_line)  # in case we modify it
-
-                    utils.remove_all_implicit_info(outline)
-                    utils.add_implicit_info(self.glfo, outline, aligned_gl_seqs=self.aligned_gl_seqs)
-
-                    outline = utils.convert_to_presto_headers(outline)
-
-                    outline = utils.get_line_for_output(outline)  # convert lists to colon-separated strings and whatnot
-                    outline = {k : v for k, v in outline.items() if k in prestoheader}  # remove the columns we don't want to output
+            fnames = {'partis' : outpath + '.partis', 'presto' : outpath}
+            print '    writing partis-format annotations to %s before converting to presto' % fnames['partis']
+        for fmt, headers in [('partis', utils.annotation_headers), ('presto', utils.presto_headers.values())]:
+            if fmt not in fnames:
+                continue
+            outfile = open(fnames[fmt], 'w')
+            writer = csv.DictWriter(outfile, headers, extrasaction='ignore')  # ignore the columns we don't want to output
+            writer.writeheader()
+            writers[fmt] = (outfile, writer)
+        return writers
 
-                    writer.writerow(outline)
+    # ----------------------------------------------------------------------------------------
+    def expand_duplicates_in_line(self, line):
+        """
+        Return a list of lines that include the duplicates of each uid in <line> (see --collapse-duplicate-sequences): for a single-sequence line, that's
+        <line> plus a line for each duplicate, whereas for a multi-sequence line it's a single line with the per-sequence info repeated for each duplicate.
+        NOTE the new lines are shallow copies, i.e. they share values with <line>.
+        """
+        if len(line['unique_ids']) == 1:
+            duplines = []
+            for dup in self.duplicates.get(line['unique_ids'][0], []):  # identical sequence, so everything but the uid is the same
+                dupline = line.copy()
+                dupline['unique_ids'] = [dup, ]
+                duplines.append(dupline)
+            return [line] + duplines
+
+        iseqs = []  # index in <line> of the sequence to use for each sequence in the expanded line
+        for iseq in range(len(line['unique_ids'])):
+            iseqs += [iseq] * (1 + len(self.duplicates.get(line['unique_ids'][iseq], [])))
+        if len(iseqs) == len(line['unique_ids']):
+            return [line]
+        expanded_line = line.copy()
+        for key in utils.linekeys['per_seq']:
+            if key in line:
+                expanded_line[key] = [line[key][iseq] for iseq in iseqs]
+        expanded_line['unique_ids'] = [uid for original_uid in line['unique_ids'] for uid in [original_uid] + self.duplicates.get(original_uid, [])]
+        return [expanded_line]
 
-                # and write empty lines for seqs that failed either in sw or the hmm
-                if len(missing_input_keys) > 0:  # NOTE assumes it's already been set by the first loop
-                    print 'missing %d input keys' % len(missing_input_keys)
-                    for uid in missing_input_keys:
-                        col = utils.presto_headers['unique_id']
-                        writer.writerow({col : uid})
+    # ----------------------------------------------------------------------------------------
+    def write_annotation(self, writers, line):
+        """ write annotation <line> (plus any duplicates, see expand_duplicates_in_line()) to the file(s) in <writers> (from init_annotation_writers()) """
+        self.add_sw_info_to_hmm_outline(line)
+        lines = self.expand_duplicates_in_line(line) if len(self.duplicates) > 0 else [line, ]
+        for line in lines:
+            for uid in line['unique_ids']:  # make a note that we have an annotation for these uids (so we can see if there's any that we're missing)
+                writers['seen_uids'].add(uid)
+
+            writers['partis'][1].writerow(utils.get_line_for_output(line))  # convert lists to colon-separated strings and whatnot (get_line_for_output() makes a new dict, so <line> isn't modified)
+
+            if 'presto' in writers:
+                if self.args.annotation_clustering is not None or len(lines) > 1:  # we're hanging on to it (or it shares values with the other lines), so don't modify it
+                    line = copy.deepcopy(line)
+                utils.remove_all_implicit_info(line)
+                utils.add_implicit_info(self.glfo, line, aligned_gl_seqs=self.aligned_gl_seqs)
+                writers['presto'][1].writerow(utils.get_line_for_output(utils.convert_to_presto_headers(line)))
 
+    # ----------------------------------------------------------------------------------------
+    def finish_annotation_writers(self, writers, outfname):
+        """ write empty lines for seqs that failed either in sw or the hmm, and close the file(s) """
+        missing_input_keys = [uid for uid in self.input_info if uid not in writers['seen_uids']]
+        missing_input_keys += [dup for uid in missing_input_keys for dup in self.duplicates.get(uid, [])]
+        if len(missing_input_keys) > 0:
+            print '          missing %d input keys when writing hmm output to %s' % (len(missing_input_keys), outfname)
+        for fmt, uid_col in [('partis', 'unique_ids'), ('presto', utils.presto_headers['unique_ids'])]:
+            if fmt not in writers:
+                continue
+            outfile, writer = writers[fmt]
+            for uid in missing_input_keys:
+                writer.writerow({uid_col : uid})
+            outfile.close()
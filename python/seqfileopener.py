@@ -37,6 +37,30 @@ def abbreviate(used_names, potential_names, unique_id):
     used_names.add(new_id)
     return new_id
 
+# ----------------------------------------------------------------------------------------
+def collapse_duplicate_sequences(input_info, seed_unique_id=None):
+    """
+    Remove from <input_info> every sequence that's identical to another one, keeping only one representative for each set of identical sequences (the first one, or the seed).
+    Returns an OrderedDict mapping each representative that had duplicates to the list of uids that were collapsed into it.
+    """
+    seq_uids = OrderedDict()
+    for uid, info in input_info.items():
+        seq = info['seqs'][0]
+        if seq not in seq_uids:
+            seq_uids[seq] = []
+        seq_uids[seq].append(uid)
+
+    duplicates = OrderedDict()
+    for uids in seq_uids.values():
+        if len(uids) == 1:
+            continue
+        rep = seed_unique_id if seed_unique_id in uids else uids[0]
+        duplicates[rep] = [uid for uid in uids if uid != rep]
+        for uid in duplicates[rep]:
+            del input_info[uid]
+
+    return duplicates
+
 # ----------------------------------------------------------------------------------------
 def get_seqfile_info(infname, is_data, n_max_queries=-1, args=None, glfo=None, simglfo=None):
     """ return list of sequence info from files of several types """
@@ -115,6 +139,7 @@ def get_seqfile_info(infname, is_data, n_max_queries=-1, args=None, glfo=None, s
 
         if args is not None and args.abbreviate:
             unique_id = abbreviate(used_names, potential_names, unique_id)
+        unique_id = intern(unique_id)  # see utils.intern_uids()
 
         # if command line specified query or reco ids, skip other ones
         if args is not None:
@@ -0,0 +1,275 @@
+import array
+import itertools
+import collections
+import numpy
+
+import utils
+
+# ----------------------------------------------------------------------------------------
+# lookup tables for packing four bases into each byte
+quads = [''.join(q) for q in itertools.product(utils.nukes, repeat=4)]
+quad_to_byte = {quad : ibyte for ibyte, quad in enumerate(quads)}
+byte_to_codes = numpy.array([[ord(base) for base in quad] for quad in quads], dtype=numpy.uint8)  # character codes of the four bases in each packed byte (for encode())
+
+# keys in annotation lines that get stored in the pool (see PooledLine)
+pooled_keys = ['naive_seq', ] + [r + '_gl_seq' for r in utils.regions]  # single sequence per line, and frequently the same between lines, so we look for duplicates
+pooled_list_keys = ['seqs', ] + [r + '_qr_seqs' for r in utils.regions] + ['aligned_' + r + '_seqs' for r in utils.regions]  # one sequence per sequence in the line
+
+# ----------------------------------------------------------------------------------------
+class SeqPool(object):
+    """
+    Append-only store for lots of sequences, which uses much less memory than keeping them as python strings.
+    Sequences consisting only of ACGT are packed with two bits per base, while anything else (N, gaps...) is stored with one byte per character.
+    Each sequence is identified by its index in the pool, and is only turned back into a string when you ask for it.
+    """
+    def __init__(self):
+        self.packed = bytearray()  # two-bit sequences, four bases per byte
+        self.raw = bytearray()  # everybody else
+        self.starts = array.array('L')  # index in <self.packed> or <self.raw> at which each sequence starts
+        self.lengths = array.array('L')  # length (in bases) of each sequence
+        self.is_packed = bytearray()  # whether each sequence is in <self.packed> or <self.raw>
+        self.dedup_indices = {}  # map from hash of sequence to its index, for sequences added with dedup=True
+
+    # ----------------------------------------------------------------------------------------
+    def __len__(self):
+        return len(self.lengths)
+
+    # ----------------------------------------------------------------------------------------
+    def __deepcopy__(self, memo):  # it's append-only, so there's no reason to ever copy it
+        return self
+
+    # ----------------------------------------------------------------------------------------
+    def n_bytes(self):
+        """ approximate memory used by the pool (not including the dedup index) """
+        return len(self.packed) + len(self.raw) + len(self.is_packed) + (self.starts.itemsize + self.lengths.itemsize) * len(self)
+
+    # ----------------------------------------------------------------------------------------
+    def pack(self, seq):
+        """ return two-bit bytearray for <seq>, or None if it has anything other than ACGT """
+        tail = len(seq) % 4
+        if tail > 0:
+            seq += utils.nukes[0] * (4 - tail)  # pad out to a full byte (we keep track of the true length separately)
+        try:
+            return bytearray([quad_to_byte[seq[i : i + 4]] for i in range(0, len(seq), 4)])
+        except KeyError:
+            return None
+
+    # ----------------------------------------------------------------------------------------
+    def add(self, seq, dedup=False):
+        """ add <seq> to the pool and return its index (if <dedup> is set, return the index of an identical sequence that was also added with dedup=True, if there is one) """
+        if dedup:
+            seqhash = hash(seq)
+            if seqhash in self.dedup_indices and self.get(self.dedup_indices[seqhash]) == seq:
+                return self.dedup_indices[seqhash]
+
+        packed_seq = self.pack(seq)
+        if packed_seq is not None:
+            self.starts.append(len(self.packed))
+            self.packed.extend(packed_seq)
+            self.is_packed.append(1)
+        else:
+            self.starts.append(len(self.raw))
+            self.raw.extend(seq)
+            self.is_packed.append(0)
+        self.lengths.append(len(seq))
+
+        index = len(self) - 1
+        if dedup and seqhash not in self.dedup_indices:
+            self.dedup_indices[seqhash] = index
+        return index
+
+    # ----------------------------------------------------------------------------------------
+    def get(self, index):
+        """ return the sequence at <index> as a string """
+        start, length = self.starts[index], self.lengths[index]
+        if self.is_packed[index]:
+            return ''.join([quads[b] for b in self.packed[start : start + (length + 3) // 4]])[ : length]
+        else:
+            return str(self.raw[start : start + length])
+
+    # ----------------------------------------------------------------------------------------
+    def encode(self, indices, extra_bases=None):
+        """ return the (equal-length) sequences at <indices> as the rows of a uint8 array, the same as utils.encode_seqs(), but going straight from the packed bytes rather than through strings """
+        lengths = set([self.lengths[index] for index in indices])
+        if len(lengths) > 1:
+            raise Exception('unequal length sequences in SeqPool.encode(): %s' % ' '.join([str(l) for l in sorted(lengths)]))
+        length = lengths.pop() if len(lengths) > 0 else 0
+        encoded = numpy.zeros((len(indices), length), dtype=numpy.uint8)
+
+        ipacked = [irow for irow in range(len(indices)) if self.is_packed[indices[irow]]]
+        if len(ipacked) > 0 and length > 0:
+            n_bytes = (length + 3) // 4
+            packed = numpy.frombuffer(self.packed, dtype=numpy.uint8)  # NOTE this is a view, so <self.packed> can't be resized until it goes away
+            byte_indices = numpy.array([self.starts[indices[irow]] for irow in ipacked]).reshape(-1, 1) + numpy.arange(n_bytes)
+            encoded[ipacked] = byte_to_codes[packed[byte_indices]].reshape(len(ipacked), 4 * n_bytes)[:, : length]
+            del packed
+
+        iraw = [irow for irow in range(len(indices)) if not self.is_packed[indices[irow]]]
+        if len(iraw) > 0:  # these are the ones with non-ACGT characters, so they need to go through the alphabet check
+            encoded[iraw] = utils.encode_seqs([self.get(indices[irow]) for irow in iraw], extra_bases=extra_bases)
+        return encoded
+
+# ----------------------------------------------------------------------------------------
+class PooledSeqList(list):
+    """ list of sequences from a PooledLine, which puts itself back into the line whenever it's modified (so things like line['seqs'][0] = newseq work) """
+    __slots__ = ('line', 'key')
+    def __init__(self, line, key, seqs):
+        list.__init__(self, seqs)
+        self.line = line
+        self.key = key
+
+    def __reduce__(self):  # copies are regular lists
+        return (list, (list(self), ))
+
+def _write_back(name):
+    list_method = getattr(list, name)
+    def method(self, *args, **kwargs):
+        retval = list_method(self, *args, **kwargs)
+        self.line[self.key] = self
+        return retval
+    method.__name__ = name
+    return method
+
+for _name in ['__setitem__', '__delitem__', '__setslice__', '__delslice__', '__iadd__', '__imul__', 'append', 'extend', 'insert', 'pop', 'remove', 'reverse', 'sort']:
+    setattr(PooledSeqList, _name, _write_back(_name))
+
+# ----------------------------------------------------------------------------------------
+class PooledLine(object):
+    """
+    Annotation line, with the same dict-style interface as a regular line, that keeps its sequences (<pooled_keys> and <pooled_list_keys>) in a SeqPool,
+    and only turns them back into strings when they're accessed.
+    NOTE it's not a dict subclass (isinstance(line, dict) is False, although it's registered as a collections.MutableMapping), since then dict(line), {}.update(line), etc. would
+    skip our __getitem__ and give you the pool indices. Anything that goes through keys() and [], including dict(line), gets the sequences.
+    Accessing a list of sequences gives you a new list each time, which is only written back to the line if you modify it directly (e.g. line['seqs'][0] = ...),
+    and copies (.copy(), copy.deepcopy(), pickling) are regular dicts with string sequences.
+    """
+    __slots__ = ('pool', 'line')
+    def __init__(self, pool, line):
+        self.pool = pool
+        self.line = {}  # same as a regular line, except with pool indices instead of sequences
+        self.update(line)
+
+    # ----------------------------------------------------------------------------------------
+    def __setitem__(self, key, value):
+        if key in pooled_keys and isinstance(value, basestring):
+            value = self.pool.add(value, dedup=True)
+        elif key in pooled_list_keys and isinstance(value, list) and all([isinstance(v, basestring) for v in value]):
+            value = array.array('L', [self.pool.add(v) for v in value])
+        self.line[key] = value
+
+    def pool_index(self, key, iseq=None):
+        """ index in the pool of sequence <key> (or, for keys with a list of sequences, its <iseq>th sequence), or None if it isn't in the pool """
+        value = self.line[key]
+        if key in pooled_keys and iseq is None and isinstance(value, (int, long)):
+            return value
+        elif key in pooled_list_keys and iseq is not None and isinstance(value, array.array):
+            return value[iseq]
+        return None
+
+    def __getitem__(self, key):
+        value = self.line[key]
+        if key in pooled_keys and isinstance(value, (int, long)):
+            return self.pool.get(value)
+        elif key in pooled_list_keys and isinstance(value, array.array):
+            return PooledSeqList(self, key, [self.pool.get(i) for i in value])
+        return value
+
+    def __delitem__(self, key):
+        del self.line[key]
+
+    def __contains__(self, key):
+        return key in self.line
+
+    def __iter__(self):
+        return iter(self.line)
+
+    def __len__(self):
+        return len(self.line)
+
+    # ----------------------------------------------------------------------------------------
+    def has_key(self, key):
+        return key in self.line
+
+    def keys(self):
+        return self.line.keys()
+
+    def iterkeys(self):
+        return iter(self.line)
+
+    def items(self):
+        return [(key, self[key]) for key in self.line]
+
+    def iteritems(self):
+        return ((key, self[key]) for key in self.line)
+
+    def values(self):
+        return [self[key] for key in self.line]
+
+    def itervalues(self):
+        return (self[key] for key in self.line)
+
+    def get(self, key, default=None):
+        return self[key] if key in self.line else default
+
+    def pop(self, key, *default):
+        if key not in self.line:
+            return self.line.pop(key, *default)
+        value = self[key]
+        del self.line[key]
+        return value
+
+    def setdefault(self, key, default=None):
+        if key not in self.line:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for other in list(args) + [kwargs, ]:
+            for key, value in (other.items() if hasattr(other, 'items') else other):
+                self[key] = value
+
+    # ----------------------------------------------------------------------------------------
+    def copy(self):
+        return {key : (list(value) if isinstance(value, PooledSeqList) else value) for key, value in self.iteritems()}
+
+    def __reduce__(self):  # deepcopy and pickle give you a regular dict
+        return (dict, (self.copy(), ))
+
+    def __eq__(self, other):
+        return self.copy() == (dict(other.items()) if hasattr(other, 'items') else other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None  # mutable, same as dicts
+
+    def __repr__(self):
+        return repr(self.copy())
+
+collections.MutableMapping.register(PooledLine)
+
+# ----------------------------------------------------------------------------------------
+def get_pool_indices(lines, key, iseq=None):
+    """ pool indices of sequence <key> (see PooledLine.pool_index()) in each of <lines>, or None unless they're all PooledLines from the same pool """
+    if len(lines) == 0 or not all([isinstance(line, PooledLine) and line.pool is lines[0].pool for line in lines]):
+        return None
+    indices = [line.pool_index(key, iseq=iseq) for line in lines]
+    if None in indices:
+        return None
+    return indices
+
+# ----------------------------------------------------------------------------------------
+def seq_length(line, key, iseq=None):
+    """ length of sequence <key> (or its <iseq>th sequence) in <line>, without making the string if it's in a pool """
+    index = line.pool_index(key, iseq=iseq) if isinstance(line, PooledLine) else None
+    if index is not None:
+        return line.pool.lengths[index]
+    return len(line[key] if iseq is None else line[key][iseq])
+
+# ----------------------------------------------------------------------------------------
+def encode_line_seqs(lines, key, iseq=None, extra_bases=None):
+    """ encode sequence <key> (or its <iseq>th sequence) from each of <lines> for the batch hamming functions in utils, going straight from the pool if they're PooledLines """
+    indices = get_pool_indices(lines, key, iseq=iseq)
+    if indices is not None:
+        return lines[0].pool.encode(indices, extra_bases=extra_bases)
+    return utils.encode_seqs([line[key] if iseq is None else line[key][iseq] for line in lines], extra_bases=extra_bases)
@@ -6,10 +6,15 @@ import ast
 import math
 import glob
 from collections import OrderedDict
+import collections
 import csv
-from subprocess import check_output, CalledProcessError, Popen
+from subprocess import check_output, CalledProcessError, Popen, PIPE
 import multiprocessing
 import copy
+import select
+import signal
+import shutil
+import numpy
 
 from opener import opener
 import seqfileopener
@@ -212,6 +217,198 @@ annotation_headers = ['unique_ids', 'v_gene', 'd_gene', 'j_gene', 'cdr3_length',
                      + functional_columns
 sw_cache_headers = ['k_v', 'k_d', 'padlefts', 'padrights', 'all_matches', 'mut_freqs']
 partition_cachefile_headers = ('unique_ids', 'logprob', 'naive_seq', 'naive_hfrac', 'errors')  # these have to match whatever bcrham is expecting
+hmm_input_headers = ('names', 'k_v_min', 'k_v_max', 'k_d_min', 'k_d_max', 'mut_freq', 'cdr3_length', 'only_genes', 'seqs')  # same here (and bcrham wants them space-delimited)
+
+# ----------------------------------------------------------------------------------------
+annotation_keys = sorted(all_linekeys | implicit_linekeys | set(annotation_headers + sw_cache_headers))
+immutable_types = (basestring, int, long, float, bool, tuple, type(None))
+
+def copy_annotation_value(value):
+    """ copy <value> so it doesn't share anything mutable with the original (shallow if that's enough, since it's much faster) """
+    if isinstance(value, list) and all([isinstance(v, immutable_types) for v in value]):
+        return list(value)
+    elif isinstance(value, dict) and all([isinstance(v, immutable_types) for v in value.values()]):
+        return copy.copy(value)  # keeps OrderedDicts ordered
+    return copy.deepcopy(value)
+
+# ----------------------------------------------------------------------------------------
+class Annotation(object):
+    """
+    Annotation line, with the same dict-style interface as the plain dicts we use everywhere else (line['seqs'], line.get('k_v'), 'naive_seq' in line, etc.),
+    but with the usual keys (<annotation_keys>) stored in __slots__ rather than a per-line hash table. Any other keys go in <self._extra>.
+    NOTE it's not actually a dict, so isinstance(line, dict) is False (it's registered as a collections.MutableMapping, though).
+    .copy() is shallow and copy.deepcopy() is deep, same as for dicts. If you want something cheaper, cow_copy() gives you a copy-on-write copy: the original and the copy
+    share their values, and whichever one next accesses a mutable value (list, dict...) gets its own copy of that value first.
+    But any reference to one of the original's mutable values that you got *before* the copy still points to the shared value, so only use it where nobody's holding on to those (see cow_copy() below).
+    """
+    __slots__ = annotation_keys + ['_extra', '_shared']
+    key_set = set(annotation_keys)
+
+    def __init__(self, line=None):
+        self._extra = None  # dict with any keys that aren't in <annotation_keys>
+        self._shared = None  # set of keys whose (mutable) values we share with another Annotation, and which we therefore need to copy before handing out
+        if line is not None:
+            self.update(line)
+
+    # ----------------------------------------------------------------------------------------
+    def get_raw(self, key):  # NOTE doesn't copy shared values
+        if key in self.key_set:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        if self._extra is None or key not in self._extra:
+            raise KeyError(key)
+        return self._extra[key]
+
+    # ----------------------------------------------------------------------------------------
+    def __getitem__(self, key):
+        value = self.get_raw(key)
+        if self._shared is not None and key in self._shared:
+            value = copy_annotation_value(value)
+            self[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        if key in self.key_set:
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+        if self._shared is not None:
+            self._shared.discard(key)
+
+    def __delitem__(self, key):
+        if key in self.key_set:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        else:
+            if self._extra is None or key not in self._extra:
+                raise KeyError(key)
+            del self._extra[key]
+        if self._shared is not None:
+            self._shared.discard(key)
+
+    def __contains__(self, key):
+        if key in self.key_set:
+            return hasattr(self, key)
+        return self._extra is not None and key in self._extra
+
+    def __iter__(self):
+        for key in annotation_keys:
+            if hasattr(self, key):
+                yield key
+        if self._extra is not None:
+            for key in self._extra.keys():
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    # ----------------------------------------------------------------------------------------
+    def has_key(self, key):
+        return key in self
+
+    def keys(self):
+        return [key for key in self]
+
+    def iterkeys(self):
+        return iter(self)
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def itervalues(self):
+        return iter(self.values())
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def pop(self, key, *default):
+        if key not in self:
+            if len(default) > 0:
+                return default[0]
+            raise KeyError(key)
+        value = self[key]
+        del self[key]
+        return value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for other in list(args) + [kwargs, ]:
+            for key, value in (other.items() if hasattr(other, 'items') else other):
+                self[key] = value
+
+    # ----------------------------------------------------------------------------------------
+    def copy(self):
+        """ shallow copy, i.e. same as dict.copy() """
+        newline = Annotation()
+        for key in self.keys():
+            newline[key] = self[key]
+        return newline
+
+    def cow_copy(self):
+        """ copy-on-write copy (see class docstring) """
+        newline = Annotation()
+        shared_keys = set()
+        for key in self.keys():
+            value = self.get_raw(key)
+            newline[key] = value
+            if not isinstance(value, immutable_types):
+                shared_keys.add(key)
+        if len(shared_keys) > 0:
+            self._shared = shared_keys if self._shared is None else (self._shared | shared_keys)
+            newline._shared = set(shared_keys)
+        return newline
+
+    def __copy__(self):
+        return self.copy()
+
+    def __deepcopy__(self, memo):
+        newline = Annotation()
+        memo[id(self)] = newline
+        for key in self.keys():
+            newline[key] = copy.deepcopy(self.get_raw(key), memo)  # NOTE shared values are fine to copy, since we're not sharing the new ones with anybody
+        return newline
+
+    def __getstate__(self):  # for pickling, since we don't have a __dict__
+        return dict(self.items())
+
+    def __setstate__(self, state):
+        self._extra, self._shared = None, None
+        self.update(state)
+
+    def __eq__(self, other):
+        return dict(self.items()) == (dict(other.items()) if hasattr(other, 'items') else other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None  # mutable, same as dicts
+
+    def __repr__(self):
+        return 'Annotation(%s)' % repr(dict(self.items()))
+
+collections.MutableMapping.register(Annotation)
+
+def cow_copy(line):
+    """ copy of <line> that we can modify without changing <line>: copy-on-write if it's an Annotation, otherwise a deep copy. NOTE only use this if nobody's hanging on to any of <line>'s mutable values (see Annotation) """
+    if isinstance(line, Annotation):
+        return line.cow_copy()
+    return copy.deepcopy(line)
 
 # ----------------------------------------------------------------------------------------
 def generate_dummy_v(d_gene):
@@ -622,7 +819,7 @@ def reset_effective_erosions_and_effective_insertions(glfo, padded_line, aligned
     the hmm yaml files.
     """
 
-    line = copy.deepcopy(padded_line)
+    line = cow_copy(padded_line)
     remove_all_implicit_info(line)
 
     assert line['v_5p_del'] == 0  # just to be safe
@@ -764,21 +961,24 @@ def process_per_gene_support(line, debug=False):
         line[region + '_per_gene_support'] = support
 
 # ----------------------------------------------------------------------------------------
-def add_implicit_info(glfo, line, existing_implicit_keys=None, aligned_gl_seqs=None):
-    """ Add to <line> a bunch of things that are initially only implicit. """
+germline_implicit_info_cache = {}  # cache for get_germline_implicit_info()
+max_germline_implicit_info_cache_size = 10000
 
-    # check for existing and unexpected keys
-    if existing_implicit_keys is not None:  # remove any existing implicit keys, keeping track of their values to make sure they're the same afterwards
-        pre_existing_info = {}
-        for ekey in existing_implicit_keys:
-            pre_existing_info[ekey] = copy.deepcopy(line[ekey])
-            del line[ekey]
-    initial_keys = set(line.keys())  # keep track of the keys that are in <line> to start with (so we know which ones we added)
-    if len(initial_keys - all_linekeys) > 0:  # make sure there aren't any extra keys to start with
-        raise Exception('unexpected keys %s' % ' '.join(initial_keys - all_linekeys))
+# ----------------------------------------------------------------------------------------
+def get_germline_implicit_info(glfo, line):
+    """
+    Return the parts of add_implicit_info() that depend only on the germline info, i.e. the genes, deletions, and insertions.
+    Lots of lines share these (e.g. every line from the same rearrangement event), so we cache them, keyed by the germline seqs and codon positions themselves (rather than the gene names) so it doesn't matter if glfo changes.
+    NOTE the returned dicts are shared between lines, so make copies before putting them in a line.
+    """
+    cache_key = tuple([glfo['chain']] + [glfo['seqs'][r][line[r + '_gene']] for r in regions] + [glfo[codon + '-positions'][line[region + '_gene']] for region, codon in sorted(conserved_codons[glfo['chain']].items())] + [line[col] for col in index_columns])
+    if cache_key in germline_implicit_info_cache:
+        return germline_implicit_info_cache[cache_key]
+
+    gl_info = {}
 
     # add the regional germline seqs and their lengths
-    line['lengths'] = {}  # length of each match (including erosion)
+    gl_info['lengths'] = {}  # length of each match (including erosion)
     for region in regions:
         uneroded_gl_seq = glfo['seqs'][region][line[region + '_gene']]
         del_5p = line[region + '_5p_del']
@@ -786,39 +986,70 @@ def add_implicit_info(glfo, line, existing_implicit_keys=None, aligned_gl_seqs=N
         length = len(uneroded_gl_seq) - del_5p - del_3p  # eroded length
         if length < 0:
             raise Exception('invalid %s lengths passed to add_implicit_info()\n    gl seq: %d  5p: %d  3p: %d' % (region, len(uneroded_gl_seq), del_5p, del_3p))
-        line[region + '_gl_seq'] = uneroded_gl_seq[del_5p : del_5p + length]
-        line['lengths'][region] = length
+        gl_info[region + '_gl_seq'] = uneroded_gl_seq[del_5p : del_5p + length]
+        gl_info['lengths'][region] = length
 
     # add codon-related stuff
-    line['codon_positions'] = {}
+    gl_info['codon_positions'] = {}
     for region, codon in conserved_codons[glfo['chain']].items():
         eroded_gl_pos = glfo[codon + '-positions'][line[region + '_gene']] - line[region + '_5p_del']
         if region == 'v':
-            line['codon_positions'][region] = eroded_gl_pos + len(line['f' + region + '_insertion'])
+            gl_info['codon_positions'][region] = eroded_gl_pos + len(line['f' + region + '_insertion'])
         elif region == 'j':
-            line['codon_positions'][region] = eroded_gl_pos + len(line['fv_insertion']) + line['lengths']['v'] + len(line['vd_insertion']) + line['lengths']['d'] + len(line['dj_insertion'])
+            gl_info['codon_positions'][region] = eroded_gl_pos + len(line['fv_insertion']) + gl_info['lengths']['v'] + len(line['vd_insertion']) + gl_info['lengths']['d'] + len(line['dj_insertion'])
         else:
             assert False
-    line['cdr3_length'] = line['codon_positions']['j'] - line['codon_positions']['v'] + 3  # i.e. first base of cysteine to last base of tryptophan inclusive
+    gl_info['cdr3_length'] = gl_info['codon_positions']['j'] - gl_info['codon_positions']['v'] + 3  # i.e. first base of cysteine to last base of tryptophan inclusive
 
     # add naive seq stuff
-    line['naive_seq'] = line['fv_insertion'] + line['v_gl_seq'] + line['vd_insertion'] + line['d_gl_seq'] + line['dj_insertion'] + line['j_gl_seq'] + line['jf_insertion']
+    gl_info['naive_seq'] = line['fv_insertion'] + gl_info['v_gl_seq'] + line['vd_insertion'] + gl_info['d_gl_seq'] + line['dj_insertion'] + gl_info['j_gl_seq'] + line['jf_insertion']
 
     start, end = {}, {}  # add naive seq bounds for each region (could stand to make this more concise)
     start['v'] = len(line['fv_insertion'])  # NOTE this duplicates code in add_qr_seqs()
-    end['v'] = start['v'] + len(line['v_gl_seq'])  # base just after the end of v
+    end['v'] = start['v'] + len(gl_info['v_gl_seq'])  # base just after the end of v
     start['d'] = end['v'] + len(line['vd_insertion'])
-    end['d'] = start['d'] + len(line['d_gl_seq'])
+    end['d'] = start['d'] + len(gl_info['d_gl_seq'])
     start['j'] = end['d'] + len(line['dj_insertion'])
-    end['j'] = start['j'] + len(line['j_gl_seq'])
-    line['regional_bounds'] = {r : (start[r], end[r]) for r in regions}
+    end['j'] = start['j'] + len(gl_info['j_gl_seq'])
+    gl_info['regional_bounds'] = {r : (start[r], end[r]) for r in regions}
+
+    if len(germline_implicit_info_cache) >= max_germline_implicit_info_cache_size:
+        germline_implicit_info_cache.clear()
+    germline_implicit_info_cache[cache_key] = gl_info
+    return gl_info
+
+# ----------------------------------------------------------------------------------------
+def add_implicit_info(glfo, line, existing_implicit_keys=None, aligned_gl_seqs=None):
+    """ Add to <line> a bunch of things that are initially only implicit. """
+
+    # check for existing and unexpected keys
+    if existing_implicit_keys is not None:  # remove any existing implicit keys, keeping track of their values to make sure they're the same afterwards
+        pre_existing_info = {}
+        for ekey in existing_implicit_keys:
+            pre_existing_info[ekey] = copy.deepcopy(line[ekey])
+            del line[ekey]
+    initial_keys = set(line.keys())  # keep track of the keys that are in <line> to start with (so we know which ones we added)
+    if len(initial_keys - all_linekeys) > 0:  # make sure there aren't any extra keys to start with
+        raise Exception('unexpected keys %s' % ' '.join(initial_keys - all_linekeys))
+
+    # add the germline-only stuff (regional germline seqs and their lengths, codon positions, naive seq and regional bounds)
+    gl_info = get_germline_implicit_info(glfo, line)
+    line['lengths'] = dict(gl_info['lengths'])  # copy the dicts, since people modify them (e.g. padding)
+    for region in regions:
+        line[region + '_gl_seq'] = gl_info[region + '_gl_seq']
+    line['codon_positions'] = dict(gl_info['codon_positions'])
+    line['cdr3_length'] = gl_info['cdr3_length']
+    line['naive_seq'] = gl_info['naive_seq']
+    line['regional_bounds'] = dict(gl_info['regional_bounds'])
+    start = {r : line['regional_bounds'][r][0] for r in regions}
+    end = {r : line['regional_bounds'][r][1] for r in regions}
 
     # add regional query seqs
     add_qr_seqs(line)
 
     add_functional_info(glfo['chain'], line)
 
-    line['mut_freqs'] = [hamming_fraction(line['naive_seq'], mature_seq) for mature_seq in line['seqs']]
+    line['mut_freqs'] = hamming_fractions(line['naive_seq'], line['seqs'])
 
     # set validity (alignment addition [below] can also set invalid)  # TODO clean up this checking stuff
     line['invalid'] = False
@@ -897,7 +1128,7 @@ def print_seq_in_reco_event(germlines, original_line, iseq, extra_str='', label=
     Print ascii summary of recombination event and mutation.
     If <one_line>, then skip the germline lines, and only print the final_seq line.
     """
-    line = copy.deepcopy(original_line)  # copy that we can modify without changing <line>
+    line = cow_copy(original_line)  # copy that we can modify without changing <line>
 
     lseq = line['seqs'][iseq]
     indelfo = None if line['indelfos'][iseq]['reversed_seq'] == '' else line['indelfos'][iseq]
@@ -1379,6 +1610,79 @@ def hamming_fraction(seq1, seq2, extra_bases=None):
         fraction = distance / float(len_excluding_ambig)
     return fraction
 
+# ----------------------------------------------------------------------------------------
+def get_base_table(bases):
+    """ boolean lookup table, indexed by uint8 character code, that's True for the characters in <bases> """
+    table = numpy.zeros(256, dtype=bool)
+    for base in bases:
+        table[ord(base)] = True
+    return table
+
+hamming_alphabet_table = get_base_table(nukes + ambiguous_bases)  # see hamming_distance()
+ambiguous_base_table = get_base_table(ambiguous_bases)
+
+# ----------------------------------------------------------------------------------------
+def encode_seqs(seqs, extra_bases=None):
+    """
+    Encode the equal-length sequences in <seqs> as the rows of a two-dimensional uint8 numpy array, for the batch hamming functions below (which also accept an already-encoded array, so you only need to encode each sequence once).
+    Checks that all characters are in the same alphabet as hamming_distance().
+    """
+    if isinstance(seqs, numpy.ndarray):
+        return seqs
+    seqlen = len(seqs[0]) if len(seqs) > 0 else 0
+    if any([len(seq) != seqlen for seq in seqs]):
+        raise Exception('unequal length sequences in encode_seqs(): %s' % ' '.join([str(len(seq)) for seq in seqs]))
+    encoded = numpy.frombuffer(str(''.join(seqs)), dtype=numpy.uint8).reshape(len(seqs), seqlen)
+
+    alphabet_table = hamming_alphabet_table
+    if extra_bases is not None:
+        alphabet_table = alphabet_table | get_base_table(extra_bases)
+    bad_chars = ~alphabet_table[encoded]
+    if bad_chars.any():
+        iseq, ich = [i[0] for i in numpy.nonzero(bad_chars)]
+        raise Exception('unexpected character \'%s\' not among %s in encode_seqs() with input:\n  %s' % (seqs[iseq][ich], nukes + ambiguous_bases + ([] if extra_bases is None else list(extra_bases)), seqs[iseq]))
+
+    return encoded
+
+# ----------------------------------------------------------------------------------------
+def hamming_distances(seq, seqs, extra_bases=None):
+    """
+    Batch version of hamming_distance(..., return_len_excluding_ambig=True) between <seq> and each of <seqs>, i.e. returns numpy arrays (distances, lengths excluding ambiguous bases).
+    <seq> can be a string or an encoded sequence (i.e. a row from encode_seqs()), and <seqs> a list of strings or a two-dimensional encoded array.
+    If <seq> is instead a two-dimensional encoded array with the same number of rows as <seqs>, we compare them row by row.
+    """
+    if isinstance(seq, numpy.ndarray):
+        if seq.ndim == 1:
+            seq = seq.reshape(1, -1)
+    else:
+        seq = encode_seqs([seq, ], extra_bases=extra_bases)
+    seqs = encode_seqs(seqs, extra_bases=extra_bases)
+    if seqs.shape[1] != seq.shape[1]:
+        raise Exception('unequal length sequences %d %d in hamming_distances()' % (seq.shape[1], seqs.shape[1]))
+    if len(seq) != 1 and len(seq) != len(seqs):
+        raise Exception('different numbers of sequences %d %d in hamming_distances()' % (len(seq), len(seqs)))
+    unambiguous = ~(ambiguous_base_table[seq] | ambiguous_base_table[seqs])
+    distances = ((seqs != seq) & unambiguous).sum(axis=1)
+    return distances, unambiguous.sum(axis=1)
+
+# ----------------------------------------------------------------------------------------
+def hamming_fractions(seq, seqs, extra_bases=None):
+    """ batch version of hamming_fraction() between <seq> and each of <seqs> (see hamming_distances()), returned as a list of floats """
+    distances, lengths = hamming_distances(seq, seqs, extra_bases=extra_bases)
+    return [float(d) / l if l > 0 else 0. for d, l in zip(distances.tolist(), lengths.tolist())]
+
+# ----------------------------------------------------------------------------------------
+def hamming_fraction_matrix(seqs, extra_bases=None):
+    """ return a symmetric numpy array with the hamming fraction between each pair of <seqs> (a list of strings or an encoded array) """
+    seqs = encode_seqs(seqs, extra_bases=extra_bases)
+    matrix = numpy.zeros((len(seqs), len(seqs)))
+    for iseq in range(len(seqs) - 1):  # one row at a time, so we don't need n^2 * length memory
+        distances, lengths = hamming_distances(seqs[iseq], seqs[iseq + 1 :])
+        fractions = numpy.where(lengths > 0, distances / numpy.maximum(lengths, 1).astype(float), 0.)
+        matrix[iseq, iseq + 1 :] = fractions
+        matrix[iseq + 1 :, iseq] = fractions
+    return matrix
+
 # ----------------------------------------------------------------------------------------
 def subset_sequences(line, iseq, restrict_to_region):
     naive_seq = line['naive_seq']  # NOTE this includes the fv and jf insertions
@@ -1456,62 +1760,104 @@ def useful_bool(bool_str):
         raise Exception('couldn\'t convert \'%s\' to bool' % bool_str)
 
 # ----------------------------------------------------------------------------------------
-def process_input_line(info):
+def intern_uids(uids):
     """
-    Attempt to convert all the keys and values in <info> according to the specifications in <column_configs> (e.g. splitting lists, casting to int/float, etc).
+    Intern each uid in list <uids> (in place), and return the list.
+    We read the same uids over and over (from the input file, sw, bcrham output, partition strings, cache files...) and use them as dict keys and set members, so having only one copy of each saves memory and makes hashing and comparisons cheaper.
     """
+    for iu in range(len(uids)):
+        uids[iu] = intern(uids[iu])
+    return uids
 
-    ccfg = column_configs  # shorten the name a bit
+# ----------------------------------------------------------------------------------------
+def splitstrpair(pairstr):
+    pairlist = pairstr.split(':')
+    if len(pairlist) != 2:
+        raise Exception('couldn\'t split %s into two pieces with \':\'' % (pairstr))
+    return (pairlist[0], float(pairlist[1]))
 
-    for key in info:
-        if key is None:
-            raise Exception('none type key')
-        if info[key] == '':
-            if key in ccfg['lists']:
-                info[key] = ['', ]
-            continue
+# ----------------------------------------------------------------------------------------
+def build_input_converter(key):
+    """ return a function that converts the string for column <key> according to the specifications in <column_configs> (e.g. splitting lists, casting to int/float, etc) """
+    ccfg = column_configs  # shorten the name a bit
 
-        convert_fcn = pass_fcn  # dummy fcn, just returns the argument
-        if key in ccfg['ints']:
-            convert_fcn = int
-        elif key in ccfg['floats']:
-            convert_fcn = float
-        elif key in ccfg['bools']:
-            convert_fcn = useful_bool
-        elif key in ccfg['literals']:
-            convert_fcn = ast.literal_eval
-
-        if key in ccfg['lists']:
-            if key in ccfg['lists-of-string-float-pairs']:  # ok, that's getting a little hackey
-
-                def splitstrpair(pairstr):
-                    pairlist = pairstr.split(':')
-                    if len(pairlist) != 2:
-                        raise Exception('couldn\'t split %s into two pieces with \':\'' % (pairstr))
-                    return (pairlist[0], float(pairlist[1]))
-
-                info[key] = [convert_fcn(val) for val in info[key].split(';')]
-                info[key] = OrderedDict(splitstrpair(pairstr) for pairstr in info[key])
-            else:
-                info[key] = [convert_fcn(val) for val in info[key].split(':')]
+    convert_fcn = None  # None means leave it as a string
+    if key in ccfg['ints']:
+        convert_fcn = int
+    elif key in ccfg['floats']:
+        convert_fcn = float
+    elif key in ccfg['bools']:
+        convert_fcn = useful_bool
+    elif key in ccfg['literals']:
+        convert_fcn = ast.literal_eval
+
+    if key in ccfg['lists-of-string-float-pairs']:  # ok, that's getting a little hackey
+        def convert(valstr):
+            if valstr == '':
+                return ['', ]
+            return OrderedDict(splitstrpair(pairstr) for pairstr in valstr.split(';'))
+    elif key in ccfg['lists']:
+        if key == 'unique_ids':
+            def convert(valstr):
+                return intern_uids(valstr.split(':'))
+        elif convert_fcn is None:
+            def convert(valstr):
+                return valstr.split(':')
         else:
-            info[key] = convert_fcn(info[key])
+            def convert(valstr):
+                if valstr == '':
+                    return ['', ]
+                return map(convert_fcn, valstr.split(':'))
+    elif convert_fcn is None:
+        convert = pass_fcn
+    else:
+        def convert(valstr):
+            if valstr == '':
+                return valstr
+            return convert_fcn(valstr)
+
+    return convert
+
+# ----------------------------------------------------------------------------------------
+def build_output_converter(key):
+    """ return a function that reverses the action of build_input_converter(key) """
+    str_fcn = str
+    if key in column_configs['floats']:
+        str_fcn = repr  # keeps it from losing precision (we only care because we want it to match expectation if we read it back in)
+
+    if key in column_configs['lists-of-string-float-pairs']:  # ok, that's getting a little hackey
+        def convert(val):
+            return ';'.join([k + ':' + str_fcn(v) for k, v in val.items()])
+    elif key in column_configs['lists']:
+        def convert(val):
+            return ':'.join(map(str_fcn, val))
+    else:
+        convert = str_fcn
+
+    return convert
+
+input_converters, output_converters = {}, {}  # the conversion function for each column (we only build them once, since process_input_line() and get_line_for_output() run on every line of every file we read or write)
+
+# ----------------------------------------------------------------------------------------
+def process_input_line(info):
+    """
+    Attempt to convert all the keys and values in <info> according to the specifications in <column_configs> (e.g. splitting lists, casting to int/float, etc).
+    """
+    for key, valstr in info.items():
+        if key not in input_converters:
+            if key is None:
+                raise Exception('none type key')
+            input_converters[key] = build_input_converter(key)
+        info[key] = input_converters[key](valstr)
 
 # ----------------------------------------------------------------------------------------
 def get_line_for_output(info):
     """ Reverse the action of process_input_line() """
     outfo = {}
-    for key in info:
-        str_fcn = str
-        if key in column_configs['floats']:
-            str_fcn = repr  # keeps it from losing precision (we only care because we want it to match expectation if we read it back in)
-        if key in column_configs['lists']:
-            if key in column_configs['lists-of-string-float-pairs']:  # ok, that's getting a little hackey
-                outfo[key] = ';'.join([k + ':' + str_fcn(v) for k, v in info[key].items()])
-            else:
-                outfo[key] = ':'.join([str_fcn(v) for v in info[key]])
-        else:
-            outfo[key] = str_fcn(info[key])
+    for key, val in info.items():
+        if key not in output_converters:
+            output_converters[key] = build_output_converter(key)
+        outfo[key] = output_converters[key](val)
     return outfo
 
 # ----------------------------------------------------------------------------------------
@@ -1542,66 +1888,385 @@ def merge_csvs(outfname, csv_list, cleanup=True):
             writer.writerow(line)
 
 # ----------------------------------------------------------------------------------------
-def run_cmd(cmd_str, workdir):
-    # print cmd_str
-    # sys.exit()
-    if not os.path.exists(workdir):
-        os.makedirs(workdir)
-    proc = Popen(cmd_str + ' 1>' + workdir + '/out' + ' 2>' + workdir + '/err', shell=True)
-    return proc
-
-# ----------------------------------------------------------------------------------------
-def run_cmds(cmdfos, debug=None):
-    for iproc in range(len(cmdfos)):
-        if 'logdir' not in cmdfos[iproc]:
-            cmdfos[iproc]['logdir'] = cmdfos[iproc]['workdir']
-        if 'dbgfo' not in cmdfos[iproc]:
-            cmdfos[iproc]['dbgfo'] = None
-
-    procs, n_tries = [], []
-    for iproc in range(len(cmdfos)):
-        procs.append(run_cmd(cmdfos[iproc]['cmd_str'], cmdfos[iproc]['logdir']))
-        n_tries.append(1)
-        time.sleep(0.01)
-    while procs.count(None) != len(procs):  # we set each proc to None when it finishes
-        for iproc in range(len(cmdfos)):
-            if procs[iproc] is None:  # already finished
+class PipePoller(object):
+    """
+    Pipe handling shared by CmdExecutor and WorkerPool: watch the stdout and stderr of a bunch of processes, collecting their output as it arrives.
+    Each process has a dict <fo> (e.g. a cmdfo), into whose fo['output']['out'] and fo['output']['err'] lists we append what we read.
+    """
+    def __init__(self):
+        self.poller = select.poll()
+        self.fdinfo = {}  # map from each open pipe's file descriptor to (fo, 'out' or 'err')
+
+    # ----------------------------------------------------------------------------------------
+    def register_pipes(self, fo, proc):
+        fo['n_open_pipes'] = 2
+        for fdtype, pipe in (('out', proc.stdout), ('err', proc.stderr)):
+            self.fdinfo[pipe.fileno()] = (fo, fdtype)
+            self.poller.register(pipe.fileno(), select.POLLIN | select.POLLPRI | select.POLLHUP | select.POLLERR)
+
+    # ----------------------------------------------------------------------------------------
+    def read_pipes(self, timeout=None):
+        """
+        Block (for up to <timeout> ms) until at least one of the pipes has something for us, and return a list of (fo, 'out' or 'err', chunk) for each (non-empty) read,
+        and a list of the fos that have closed both their pipes (i.e. that have, probably, exited).
+        """
+        chunks, closed = [], []
+        for fd, _ in self.poller.poll(timeout):
+            fo, fdtype = self.fdinfo[fd]
+            chunk = os.read(fd, 65536)
+            if chunk != '':
+                fo['output'][fdtype].append(chunk)
+                chunks.append((fo, fdtype, chunk))
                 continue
-            if procs[iproc].poll() is not None:  # it just finished
-                finish_process(iproc, procs, n_tries, cmdfos[iproc]['workdir'], cmdfos[iproc]['logdir'], cmdfos[iproc]['outfname'], cmdfos[iproc]['cmd_str'], dbgfo=cmdfos[iproc]['dbgfo'], debug=debug)
+            self.poller.unregister(fd)  # end of file
+            del self.fdinfo[fd]
+            fo['n_open_pipes'] -= 1
+            if fo['n_open_pipes'] == 0:
+                closed.append(fo)
+        return chunks, closed
+
+    # ----------------------------------------------------------------------------------------
+    def read_available(self, fo, fdtype, pipe):
+        """ read whatever's already waiting in <pipe> (without blocking) """
+        while pipe.fileno() in self.fdinfo and len(select.select([pipe], [], [], 0)[0]) > 0:
+            chunk = os.read(pipe.fileno(), 65536)
+            if chunk == '':
+                break
+            fo['output'][fdtype].append(chunk)
+
+    # ----------------------------------------------------------------------------------------
+    def close_pipes(self, proc):
+        """ stop watching <proc>'s pipes (if we still are), and close them """
+        for pipe in (proc.stdout, proc.stderr):
+            if pipe.fileno() in self.fdinfo:
+                self.poller.unregister(pipe.fileno())
+                del self.fdinfo[pipe.fileno()]
+            pipe.close()
+
+# ----------------------------------------------------------------------------------------
+class CmdExecutor(PipePoller):
+    """
+    Run shell commands as subprocesses, with their stdout and stderr coming back through pipes.
+    Rather than sleeping and polling, we block in select.poll() on all the pipes at once, so we deal with each command (checking its output, and rerunning it if it failed) as soon as it exits.
+    Usage: submit() each command, then wait() for them all to finish.
+
+    If <straggler_factor> is set, once at least half the commands have finished, any command that's been running for more than <straggler_factor> times the median
+    run time (and at least <min_straggler_time> seconds) gets a speculative duplicate in a copy of its workdir. Whichever finishes first wins, and the other is killed.
+    NOTE this assumes that the command reads and writes files only in its workdir (except for read-only files elsewhere).
+    """
+    def __init__(self, debug=None, n_max_tries=5, straggler_factor=None, min_straggler_time=30.):
+        super(CmdExecutor, self).__init__()
+        self.debug = debug  # None, 'print', or 'write' (see process_out_err())
+        self.n_max_tries = n_max_tries
+        self.straggler_factor = straggler_factor
+        self.min_straggler_time = min_straggler_time
+        self.cmdfos = []  # everything that's been submitted
+        self.running = []  # everything that's currently running
+        self.run_times = []  # for successful commands
+        self.n_speculative, self.n_speculative_wins = 0, 0
+
+    # ----------------------------------------------------------------------------------------
+    def submit(self, cmdfo):
+        """
+        Start running <cmdfo>, a dict with keys 'cmd_str' and 'workdir', and optionally 'logdir' (defaults to 'workdir'), 'outfname' (the command is only considered to have succeeded if this exists when it finishes), and 'dbgfo' (see process_out_err()).
+        """
+        if 'logdir' not in cmdfo:
+            cmdfo['logdir'] = cmdfo['workdir']
+        if 'outfname' not in cmdfo:
+            cmdfo['outfname'] = None
+        if 'dbgfo' not in cmdfo:
+            cmdfo['dbgfo'] = None
+        cmdfo['iproc'] = len(self.cmdfos)
+        cmdfo['n_tries'] = 0
+        cmdfo['duplicate'] = None  # speculative copy of this command, if we launch one
+        cmdfo['original'] = None  # if this *is* a speculative copy, the command of which it's a copy
+        if self.straggler_factor is not None:  # remember which files are there to start with, so we know what to copy if we need a duplicate
+            cmdfo['input_fnames'] = os.listdir(cmdfo['workdir']) if os.path.exists(cmdfo['workdir']) else []
+        self.cmdfos.append(cmdfo)
+        self.start(cmdfo)
+
+    # ----------------------------------------------------------------------------------------
+    def start(self, cmdfo):
+        if not os.path.exists(cmdfo['logdir']):
+            os.makedirs(cmdfo['logdir'])
+        preexec_fn = os.setsid if self.straggler_factor is not None else None  # put it in its own process group, so we can kill the whole thing (shell, srun, and all) if it loses to a duplicate
+        proc = Popen(cmdfo['cmd_str'], shell=True, stdout=PIPE, stderr=PIPE, close_fds=True, preexec_fn=preexec_fn)
+        cmdfo['proc'] = proc
+        cmdfo['start_time'] = time.time()
+        cmdfo['n_tries'] += 1
+        cmdfo['output'] = {'out' : [], 'err' : []}
+        self.register_pipes(cmdfo, proc)
+        self.running.append(cmdfo)
+
+    # ----------------------------------------------------------------------------------------
+    def wait(self):
+        """ wait for everything that's been submitted to finish successfully """
+        while len(self.running) > 0:
+            timeout = None if self.straggler_factor is None else 1000  # if we're looking for stragglers, check at least once a second (in ms)
+            _, finished = self.read_pipes(timeout)  # NOTE don't finish() anything until we're through this batch of events, since finishing can start or kill processes (which changes the file descriptors)
+            for cmdfo in finished:
+                if cmdfo['proc'] is not None:  # i.e. unless we just killed it
+                    self.finish(cmdfo)
+            if self.straggler_factor is not None:
+                self.check_for_stragglers()
         sys.stdout.flush()
-        time.sleep(0.1)
+
+    # ----------------------------------------------------------------------------------------
+    def check_for_stragglers(self):
+        if len(self.run_times) < 0.5 * len(self.cmdfos):
+            return
+        time_limit = max(self.min_straggler_time, self.straggler_factor * numpy.median(self.run_times))
+        for cmdfo in list(self.running):
+            if cmdfo['original'] is not None or cmdfo['duplicate'] is not None:  # only ever one duplicate per command
+                continue
+            if time.time() - cmdfo['start_time'] > time_limit:
+                self.launch_duplicate(cmdfo, time_limit)
+
+    # ----------------------------------------------------------------------------------------
+    def launch_duplicate(self, cmdfo, time_limit):
+        specdir = cmdfo['workdir'] + '-spec'
+        print '    proc %d has been running for %.0fs (limit %.0fs), launching a speculative duplicate in %s' % (cmdfo['iproc'], time.time() - cmdfo['start_time'], time_limit, specdir)
+        if os.path.exists(specdir):
+            shutil.rmtree(specdir)
+        os.makedirs(specdir)
+        for fname in cmdfo['input_fnames']:
+            if os.path.isfile(cmdfo['workdir'] + '/' + fname):
+                shutil.copy(cmdfo['workdir'] + '/' + fname, specdir + '/')
+        dupfo = {'cmd_str' : cmdfo['cmd_str'].replace(cmdfo['workdir'] + '/', specdir + '/'),
+                 'workdir' : specdir,
+                 'logdir' : specdir,
+                 'outfname' : None if cmdfo['outfname'] is None else cmdfo['outfname'].replace(cmdfo['workdir'] + '/', specdir + '/'),
+                 'dbgfo' : None if cmdfo['dbgfo'] is None else {},  # its own, so we only pass on the winner's (see finish())
+                 'iproc' : cmdfo['iproc'],
+                 'n_tries' : self.n_max_tries,  # don't rerun duplicates
+                 'duplicate' : None,
+                 'original' : cmdfo}
+        cmdfo['duplicate'] = dupfo
+        self.n_speculative += 1
+        self.start(dupfo)
+
+    # ----------------------------------------------------------------------------------------
+    def kill(self, cmdfo, timeout=10.):
+        """
+        kill a command that lost the race with its duplicate (or original).
+        We send SIGTERM to the whole process group first, since with --slurm the process is srun, which needs to be able to pass it on to the job step (SIGKILL would leave the job running).
+        Only if something in the group is still around after <timeout> seconds do we SIGKILL it.
+        """
+        proc = cmdfo['proc']
+        def group_is_alive():
+            proc.poll()  # reap the shell if it's finished, so its zombie doesn't count
+            try:
+                os.killpg(proc.pid, 0)
+                return True
+            except OSError:
+                return False
+        for sig in (signal.SIGTERM, signal.SIGKILL):
+            try:
+                os.killpg(proc.pid, sig)
+            except OSError:  # already finished
+                break
+            start = time.time()
+            while group_is_alive() and time.time() - start < timeout:
+                time.sleep(0.1)
+            if not group_is_alive():
+                break
+        proc.wait()
+        self.close_pipes(proc)
+        self.running.remove(cmdfo)
+        cmdfo['proc'] = None
+        if cmdfo['original'] is not None:
+            shutil.rmtree(cmdfo['workdir'])
+
+    # ----------------------------------------------------------------------------------------
+    def finish(self, cmdfo):
+        """ deal with a process once it's closed its output (i.e. check if it failed, and restart if so) """
+        proc = cmdfo['proc']
+        proc.wait()
+        self.close_pipes(proc)
+        self.running.remove(cmdfo)
+        outfname = cmdfo['outfname']
+        succeeded = proc.returncode == 0 and (outfname is None or os.path.exists(outfname))  # TODO also check cachefile, if necessary
+        if succeeded or cmdfo['original'] is None:  # a failed duplicate's output is of no interest (and wouldn't have the dbg info we look for)
+            out, err = ''.join(cmdfo['output']['out']), ''.join(cmdfo['output']['err'])
+            process_out_err(out, err, extra_str='' if len(self.cmdfos) == 1 else str(cmdfo['iproc']), dbgfo=cmdfo['dbgfo'], logdir=cmdfo['logdir'], debug=self.debug)
+        if succeeded:
+            cmdfo['proc'] = None  # job succeeded
+            self.run_times.append(time.time() - cmdfo['start_time'])
+            if cmdfo['original'] is not None:  # we're a speculative duplicate that beat the original, so kill it and move our files to where it would've put them
+                original = cmdfo['original']
+                if original['proc'] is not None:
+                    self.kill(original)
+                if original['dbgfo'] is not None:  # the winner's dbg info is the one that counts
+                    original['dbgfo'].clear()
+                    original['dbgfo'].update(cmdfo['dbgfo'])
+                for fname in os.listdir(cmdfo['workdir']):
+                    os.rename(cmdfo['workdir'] + '/' + fname, original['workdir'] + '/' + fname)
+                os.rmdir(cmdfo['workdir'])
+                self.n_speculative_wins += 1
+            elif cmdfo['duplicate'] is not None and cmdfo['duplicate']['proc'] is not None:  # the original won, so kill the duplicate
+                self.kill(cmdfo['duplicate'])
+        elif cmdfo['original'] is not None:  # failed duplicate: give up on it, and let the original keep going
+            print '    speculative duplicate of proc %d failed (exited with %d)' % (cmdfo['iproc'], proc.returncode)
+            cmdfo['proc'] = None
+            shutil.rmtree(cmdfo['workdir'])
+        elif cmdfo['n_tries'] > self.n_max_tries:
+            raise Exception('exceeded max number of tries for command\n    %s\nlook for output in %s and %s' % (cmdfo['cmd_str'], cmdfo['workdir'], cmdfo['logdir']))
+        else:
+            print '    rerunning proc %d (exited with %d' % (cmdfo['iproc'], proc.returncode),
+            if outfname is not None and not os.path.exists(outfname):
+                print ', output %s d.n.e.' % outfname,
+            print ')'
+            self.start(cmdfo)
 
 # ----------------------------------------------------------------------------------------
-# deal with a process once it's finished (i.e. check if it failed, and restart if so)
-def finish_process(iproc, procs, n_tries, workdir, logdir, outfname, cmd_str, dbgfo=None, debug=None):
-    procs[iproc].communicate()
-    process_out_err('', '', extra_str='' if len(procs) == 1 else str(iproc), dbgfo=dbgfo, logdir=logdir, debug=debug)
-    if procs[iproc].returncode == 0 and os.path.exists(outfname):  # TODO also check cachefile, if necessary
-        procs[iproc] = None  # job succeeded
-    elif n_tries[iproc] > 5:
-        raise Exception('exceeded max number of tries for command\n    %s\nlook for output in %s and %s' % (cmd_str, workdir, logdir))
-    else:
-        print '    rerunning proc %d (exited with %d' % (iproc, procs[iproc].returncode),
-        if not os.path.exists(outfname):
-            print ', output %s d.n.e.' % outfname,
-        print ')'
-        procs[iproc] = run_cmd(cmd_str, workdir)
-        n_tries[iproc] += 1
+def run_cmds(cmdfos, debug=None, straggler_factor=None):
+    """ run each command in <cmdfos> (see CmdExecutor.submit()), wait for them all to finish, and return the executor (e.g. for its speculative execution counts) """
+    executor = CmdExecutor(debug=debug, straggler_factor=straggler_factor)
+    for cmdfo in cmdfos:
+        executor.submit(cmdfo)
+    executor.wait()
+    return executor
 
 # ----------------------------------------------------------------------------------------
-def process_out_err(out, err, extra_str='', dbgfo=None, logdir=None, debug=None):
-    """ NOTE something in this chain seems to block or truncate or some such nonsense if you make it too big """
-    if logdir is not None:
-        def readfile(fname):
-            ftmp = open(fname)
-            fstr = ''.join(ftmp.readlines())
-            ftmp.close()
-            os.remove(fname)
-            return fstr
-        out = readfile(logdir + '/out')
-        err = readfile(logdir + '/err')
+class WorkerPool(PipePoller):
+    """
+    Keep long-lived worker processes (i.e. bcrham --worker) around between batches of commands, so they only do their setup (reading germline info and hmms) once, rather than once per batch.
+    Each command is a cmdfo as for CmdExecutor.submit(), plus 'job_str': the end of 'cmd_str' with the arguments that change from job to job.
+    A new worker is started with 'cmd_str' plus <worker_flag>, and after that gets each job's 'job_str' as a line on its stdin. It writes <done_str> to stdout after each job, and exits when its stdin is closed.
+    If a worker dies, we start a new one with the job's full command (and if the job's 'outfname' doesn't show up, we send the job again), up to <n_max_tries> times.
+    Usage: run() each batch (the <i>th command goes to the <i>th worker), then close() at the end.
+    NOTE no speculative duplicates here, since they'd need a second worker.
+    """
+    def __init__(self, worker_flag, done_str, debug=None, n_max_tries=5):
+        super(WorkerPool, self).__init__()
+        self.worker_flag = worker_flag
+        self.done_str = done_str
+        self.debug = debug  # None, 'print', or 'write' (see process_out_err())
+        self.n_max_tries = n_max_tries
+        self.workers = []  # the <i>th worker runs the <i>th command in each batch (None if it died)
+        self.n_workers_started = 0
+
+    # ----------------------------------------------------------------------------------------
+    def run(self, cmdfos):
+        """ run the commands in <cmdfos> (one per worker), and wait for them all to finish successfully """
+        while len(self.workers) > len(cmdfos):  # fewer procs than last time
+            self.stop(self.workers.pop())
+        running = []
+        for iproc, cmdfo in enumerate(cmdfos):
+            if 'logdir' not in cmdfo:
+                cmdfo['logdir'] = cmdfo['workdir']
+            if 'outfname' not in cmdfo:
+                cmdfo['outfname'] = None
+            if 'dbgfo' not in cmdfo:
+                cmdfo['dbgfo'] = None
+            if not cmdfo['cmd_str'].endswith(cmdfo['job_str']):
+                raise Exception('job str \'%s\' isn\'t the end of command \'%s\'' % (cmdfo['job_str'], cmdfo['cmd_str']))
+            cmdfo['iproc'] = iproc
+            cmdfo['n_tries'] = 0
+            running.append(self.start_job(iproc, cmdfo))
+
+        while len(running) > 0:
+            chunks, died = self.read_pipes()  # NOTE don't deal with anything until we're through this batch of events, since that can start or stop workers (which changes the file descriptors). Also, closing its pipes means a worker died (since we haven't closed its stdin)
+            finished = []
+            for worker, fdtype, chunk in chunks:
+                if fdtype == 'out' and chunk.endswith('\n') and ''.join(worker['output']['out']).endswith(self.done_str + '\n') and worker not in finished:  # the marker is the last thing it writes before waiting for the next job
+                    finished.append(worker)
+            for worker in finished:
+                if worker in died:  # wrote the marker, but then died before we got to it (it's probably crashing on the way out, so we don't trust the output)
+                    continue
+                running.remove(worker)
+                cmdfo = self.finish_job(worker)
+                if cmdfo is not None:  # failed, so rerun it
+                    running.append(self.start_job(cmdfo['iproc'], cmdfo))
+            for worker in died:
+                if worker not in running:  # died after finishing its job, so just get rid of it (we'll start a new one for the next batch)
+                    self.stop(worker)
+                    self.workers[self.workers.index(worker)] = None
+                    continue
+                running.remove(worker)
+                cmdfo = self.finish_job(worker, died=True)
+                running.append(self.start_job(cmdfo['iproc'], cmdfo))
+        sys.stdout.flush()
+
+    # ----------------------------------------------------------------------------------------
+    def start_job(self, iproc, cmdfo):
+        """ send <cmdfo> to the <iproc>th worker (starting it first if it isn't running or was started with a different command prefix, e.g. without srun) """
+        if not os.path.exists(cmdfo['logdir']):
+            os.makedirs(cmdfo['logdir'])
+        cmd_prefix = cmdfo['cmd_str'][ : len(cmdfo['cmd_str']) - len(cmdfo['job_str'])]
+        while len(self.workers) <= iproc:
+            self.workers.append(None)
+        worker = self.workers[iproc]
+        if worker is not None and worker['cmd_prefix'] != cmd_prefix:
+            self.stop(worker)
+            worker = None
+        if worker is not None:
+            try:
+                worker['proc'].stdin.write(cmdfo['job_str'] + '\n')
+                worker['proc'].stdin.flush()
+            except IOError:  # it died while we weren't listening
+                self.stop(worker)
+                worker = None
+        if worker is None:
+            worker = self.start_worker(cmdfo['cmd_str'] + ' ' + self.worker_flag)
+            worker['cmd_prefix'] = cmd_prefix
+            self.workers[iproc] = worker
+        worker['cmdfo'] = cmdfo
+        worker['output'] = {'out' : [], 'err' : []}
+        cmdfo['n_tries'] += 1
+        return worker
+
+    # ----------------------------------------------------------------------------------------
+    def start_worker(self, cmd_str):
+        proc = Popen(cmd_str, shell=True, stdin=PIPE, stdout=PIPE, stderr=PIPE, close_fds=True)
+        worker = {'proc' : proc, 'output' : {'out' : [], 'err' : []}}
+        self.register_pipes(worker, proc)
+        self.n_workers_started += 1
+        return worker
+
+    # ----------------------------------------------------------------------------------------
+    def finish_job(self, worker, died=False):
+        """ deal with the output from <worker>'s current job, returning the job's cmdfo if it needs to be rerun (and None if it succeeded) """
+        cmdfo = worker['cmdfo']
+        if died:
+            self.stop(worker)
+            self.workers[cmdfo['iproc']] = None
+        else:  # it wrote to stderr before the marker, but we may not have read it yet
+            self.read_available(worker, 'err', worker['proc'].stderr)
+        out, err = ''.join(worker['output']['out']), ''.join(worker['output']['err'])
+        if not died:
+            out = out[ : len(out) - len(self.done_str + '\n')]
+        outfname = cmdfo['outfname']
+        if not died and (outfname is None or os.path.exists(outfname)):
+            process_out_err(out, err, extra_str='' if len(self.workers) == 1 else str(cmdfo['iproc']), dbgfo=cmdfo['dbgfo'], logdir=cmdfo['logdir'], debug=self.debug)
+            return None
+        if cmdfo['n_tries'] >= self.n_max_tries:
+            raise Exception('exceeded max number of tries for worker command\n    %s\nstdout:\n%s\nstderr:\n%s' % (cmdfo['cmd_str'], out, err))
+        reason = ('worker exited with %d' % worker['proc'].returncode) if died else ('output %s d.n.e.' % outfname)
+        print '    rerunning proc %d (%s)' % (cmdfo['iproc'], reason)
+        return cmdfo
+
+    # ----------------------------------------------------------------------------------------
+    def stop(self, worker):
+        """ close <worker>'s stdin (which tells it to exit), and wait for it """
+        if worker is None:
+            return
+        proc = worker['proc']
+        try:
+            proc.stdin.close()
+        except IOError:  # already dead
+            pass
+        proc.wait()
+        self.close_pipes(proc)
 
+    # ----------------------------------------------------------------------------------------
+    def close(self):
+        while len(self.workers) > 0:
+            self.stop(self.workers.pop())
+
+# ----------------------------------------------------------------------------------------
+def process_out_err(out, err, extra_str='', dbgfo=None, logdir=None, debug=None):
+    """ filter and print (or write to <logdir>/log) a finished process's stdout <out> and stderr <err>, and pull out any bcrham calculation/timing info into <dbgfo> """
     print_str = ''
     for line in err.split('\n'):
         if 'stty: standard input: Inappropriate ioctl for device' in line:
@@ -2083,26 +2748,30 @@ def print_heapy(extrastr, heap):
     print 'mem total %.3f MB    %s' % (float(total) / 1e6, extrastr)
 
 # ----------------------------------------------------------------------------------------
+slurm_info = {}  # cache for auto_slurm(), so we don't fork off a 'which' and re-count cpus every time we build a command string
 def auto_slurm(n_procs):
     """ Return true if we want to force slurm usage, e.g. if there's more processes than cores """
 
     def slurm_exists():
-        try:
-            fnull = open(os.devnull, 'w')
-            check_output(['which', 'srun'], stderr=fnull, close_fds=True)
-            return True
-        except CalledProcessError:
-            return False
-
-    ncpu = multiprocessing.cpu_count()
-    if n_procs > ncpu and slurm_exists():
+        if 'exists' not in slurm_info:
+            try:
+                fnull = open(os.devnull, 'w')
+                check_output(['which', 'srun'], stderr=fnull, close_fds=True)
+                slurm_info['exists'] = True
+            except CalledProcessError:
+                slurm_info['exists'] = False
+        return slurm_info['exists']
+
+    if 'ncpu' not in slurm_info:
+        slurm_info['ncpu'] = multiprocessing.cpu_count()
+    if n_procs > slurm_info['ncpu'] and slurm_exists():
         return True
     return False
 
 # ----------------------------------------------------------------------------------------
 def synthesize_single_seq_line(line, iseq):
     """ without modifying <line>, make a copy of it corresponding to a single-sequence event with the <iseq>th sequence """
-    hmminfo = copy.deepcopy(line)  # make a copy of the info, into which we'll insert the sequence-specific stuff
+    hmminfo = cow_copy(line)  # make a copy of the info, into which we'll insert the sequence-specific stuff
     for col in linekeys['per_seq']:
         hmminfo[col] = [hmminfo[col][iseq], ]
     return hmminfo
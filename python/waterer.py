@@ -10,6 +10,11 @@ import pysam
 import contextlib
 from collections import OrderedDict
 import csv
+import hashlib
+import cPickle
+import threading
+import multiprocessing
+from subprocess import Popen, PIPE
 
 import utils
 import glutils
@@ -18,17 +23,61 @@ from parametercounter import ParameterCounter
 from performanceplotter import PerformancePlotter
 from allelefinder import AlleleFinder
 from alleleremover import AlleleRemover
+import partitioncache
+import seqpool
+
+binary_cache_format_version = 2  # increment this whenever the layout of binary (.pickle) sw cache files changes (version 1 was a bare list of lines)
+
+# ----------------------------------------------------------------------------------------
+class SamRead(object):
+    """ minimal stand-in for pysam's aligned read, parsed from a line of (ig-sw's) text sam output (see Waterer.stream_ig_sw()) """
+    __slots__ = ('qname', 'is_secondary', 'tid', 'pos', 'aend', 'qstart', 'qend', 'cigarstring', 'seq', 'tags')
+    def __init__(self, line, reference_indices):
+        fields = line.split('\t')
+        self.qname = fields[0]
+        self.is_secondary = bool(int(fields[1]) & 256)
+        self.tid = reference_indices.get(fields[2], -1)
+        self.pos = int(fields[3]) - 1  # sam is 1-based
+        self.cigarstring = fields[5]
+        self.seq = fields[9] if fields[9] != '*' else None
+        self.tags = []
+        for tagstr in fields[11:]:
+            name, tagtype, value = tagstr.split(':', 2)
+            self.tags.append((name, int(value) if tagtype == 'i' else value))
+
+        # query and reference bounds of the aligned part (i.e. excluding soft clips), as in pysam's qstart, qend, and aend
+        self.qstart, qlength, rlength = 0, 0, 0
+        for length, code in re.findall('([0-9][0-9]*)([A-Z=])', self.cigarstring):
+            length = int(length)
+            if code == 'S' and qlength == 0:
+                self.qstart = length
+            if code in 'MI=X':
+                qlength += length
+            if code in 'MDN=X':
+                rlength += length
+        self.qend = self.qstart + qlength
+        self.aend = self.pos + rlength
+
+# ----------------------------------------------------------------------------------------
+pool_waterer = None  # Waterer whose sam output the pool worker processes are summarizing (see Waterer.start_pool()), which they get a copy of when they're forked
+
+def summarize_sam_file_in_worker(fname):
+    return pool_waterer.summarize_sam_file(fname)
+
+def summarize_sam_lines_in_worker(references, lines):
+    return pool_waterer.summarize_sam_lines(references, lines)
 
 # ----------------------------------------------------------------------------------------
 class Waterer(object):
     """ Run smith-waterman on the query sequences in <infname> """
-    def __init__(self, args, input_info, reco_info, glfo, count_parameters=False, parameter_out_dir=None, remove_less_likely_alleles=False, find_new_alleles=False, plot_performance=False, simglfo=None, itry=None):
+    def __init__(self, args, input_info, reco_info, glfo, count_parameters=False, parameter_out_dir=None, remove_less_likely_alleles=False, find_new_alleles=False, plot_performance=False, simglfo=None, itry=None, duplicates=None):
         self.args = args
         self.input_info = input_info
         self.reco_info = reco_info
         self.glfo = glfo
         self.simglfo = simglfo
         self.parameter_out_dir = parameter_out_dir
+        self.duplicates = {} if duplicates is None else duplicates  # map from each representative uid to the uids that were collapsed into it (see --collapse-duplicate-sequences), so we can weight the parameter counts
         self.debug = self.args.debug if self.args.sw_debug is None else self.args.sw_debug
 
         self.max_insertion_length = 35  # if vdjalign reports an insertion longer than this, rerun the query (typically with different match/mismatch ratio)
@@ -46,10 +95,14 @@ class Waterer(object):
         self.info['all_matches'] = {r : set() for r in utils.regions}  # every gene that was *any* match for at least one query
         self.info['indels'] = {}  # NOTE if we find shm indels in a sequence, we store the indel info in here, and rerun sw with the reversed sequence (i.e. <self.info> contains the sw inference on the reversed sequence -- if you want the original sequence, get that from <self.input_info>)
 
+        self.seqpool = seqpool.SeqPool() if self.args.compact_sequences else None  # if set, we keep the sequences in self.info in here (see seqpool.PooledLine)
+
         self.nth_try = 1
         self.unproductive_queries = set()
+        self.sam_batch_size = 500  # when streaming ig-sw output, summarize this many queries at a time (see add_sam_lines())
 
         self.my_gldir = self.args.workdir + '/' + glutils.glfo_dir
+        self.sw_store_key_base = None  # germline set and sw parameter part of the --sw-store key (see get_sw_store_key())
 
         self.alremover, self.alfinder, self.pcounter, self.true_pcounter, self.perfplotter = None, None, None, None, None
         if remove_less_likely_alleles:
@@ -73,18 +126,29 @@ class Waterer(object):
         base_outfname = 'query-seqs.sam'
         sys.stdout.flush()
 
-        n_procs = self.args.n_fewer_procs
+        queries_from_store = set()
+        if self.args.sw_store is not None:
+            queries_from_store = self.read_sw_store()
+
+        n_procs = max(1, min(self.args.n_fewer_procs, len(self.remaining_queries)))
         initial_queries_per_proc = float(len(self.remaining_queries)) / n_procs
         while len(self.remaining_queries) > 0:  # we remove queries from <self.remaining_queries> as we're satisfied with their output
             if self.nth_try > 1 and float(len(self.remaining_queries)) / n_procs < initial_queries_per_proc:
                 n_procs = int(max(1., float(len(self.remaining_queries)) / initial_queries_per_proc))
-            self.write_vdjalign_input(base_infname, n_procs)
-            self.execute_commands(base_infname, base_outfname, n_procs)
-            self.read_output(base_outfname, n_procs)
+            query_chunks = self.split_queries(n_procs)
+            if self.args.slurm or utils.auto_slurm(n_procs):  # srun'd processes have to go through files in the workdir
+                self.write_vdjalign_input(base_infname, query_chunks)
+                self.execute_commands(base_infname, base_outfname, n_procs)
+                self.read_output(base_outfname, n_procs)
+            else:
+                self.stream_ig_sw(query_chunks)
             if self.nth_try > 3:
                 break
             self.nth_try += 1  # it's set to 1 before we begin the first try, and increases to 2 just before we start the second try
 
+        if self.args.sw_store is not None:
+            self.write_sw_store([q for q in self.info['queries'] if q not in queries_from_store])  # NOTE has to happen before finalize(), since we want the info from before padding (which depends on all the other sequences)
+
         self.finalize(cachefname)
         print '        water time: %.1f' % (time.time()-start)
 
@@ -92,25 +156,152 @@ class Waterer(object):
     def read_cachefile(self, cachefname):
         print '        reading sw results from %s' % cachefname
 
-        if os.path.exists(cachefname.replace('.csv', '-glfo')):
-            self.glfo = glutils.read_glfo(cachefname.replace('.csv', '-glfo'), self.args.chain)
+        if os.path.exists(self.get_cache_glfo_dir(cachefname)):
+            self.glfo = glutils.read_glfo(self.get_cache_glfo_dir(cachefname), self.args.chain)
         else:
             print '    %s didn\'t find a germline info dir along with sw cache file, but trying to read it anyway' % utils.color('red', 'warning')
 
-        with open(cachefname) as cachefile:
-            reader = csv.DictReader(cachefile)
-            for line in reader:
-                utils.process_input_line(line)
-                assert len(line['unique_ids']) == 1
-                for region in utils.regions:  # uh... should do this more cleanly at some point
-                    del line[region + '_per_gene_support']
-                utils.add_implicit_info(self.glfo, line, existing_implicit_keys=['cdr3_length', 'naive_seq', 'mut_freqs'] + utils.functional_columns + ['aligned_' + r + '_seqs' for r in utils.regions])
-                self.add_to_info(line)
-                if line['indelfos'][0]['reversed_seq'] != '':
-                    self.info['indels'][line['unique_ids'][0]] = line['indelfos'][0]
+        if self.binary_cachefile(cachefname):
+            with open(cachefname, 'rb') as cachefile:
+                unpickler = cPickle.Unpickler(cachefile)
+                unpickler.find_global = None  # only allow builtin types (dicts, lists, strings, numbers...), i.e. don't let the file import (and then call) anything
+                try:
+                    cachefo = unpickler.load()
+                except cPickle.UnpicklingError as err:
+                    raise Exception('couldn\'t read binary sw cache file %s (%s) -- it may be from an older version, in which case you should remove it and rerun' % (cachefname, err))
+            if not isinstance(cachefo, dict) or cachefo.get('format-version') != binary_cache_format_version:
+                raise Exception('binary sw cache file %s has format version %s, but we need %d (remove it and rerun)' % (cachefname, cachefo.get('format-version') if isinstance(cachefo, dict) else None, binary_cache_format_version))
+            if cachefo['glfo-hash'] != self.get_glfo_hash():
+                raise Exception('germline set in %s doesn\'t match the one with which binary sw cache file %s was written' % (self.get_cache_glfo_dir(cachefname) if os.path.exists(self.get_cache_glfo_dir(cachefname)) else 'the current germline dir', cachefname))
+            for line in cachefo['lines']:
+                self.add_cached_line(line, parsed=True)
+        else:
+            with open(cachefname) as cachefile:
+                reader = csv.DictReader(cachefile)
+                for line in reader:
+                    self.add_cached_line(line)
 
         self.finalize(cachefname=None, just_read_cachefile=True)
 
+    # ----------------------------------------------------------------------------------------
+    def binary_cachefile(self, cachefname):
+        """ if <cachefname> ends in .pickle or .pkl, we write and read the already-parsed lines with cPickle (along with a format version and a hash of the germline set), rather than writing csv and then reparsing every line when we read it """
+        return os.path.splitext(cachefname)[1] in ['.pickle', '.pkl']
+
+    # ----------------------------------------------------------------------------------------
+    def get_cache_glfo_dir(self, cachefname):
+        return os.path.splitext(cachefname)[0] + '-glfo'
+
+    # ----------------------------------------------------------------------------------------
+    def write_cachefile(self, cachefname):
+        print '        writing sw results to %s' % cachefname
+        glutils.write_glfo(self.get_cache_glfo_dir(cachefname), self.glfo)
+        if self.binary_cachefile(cachefname):
+            keys_to_write = set(utils.annotation_headers + utils.sw_cache_headers) - set([r + '_per_gene_support' for r in utils.regions])  # i.e. the same columns as in a csv cache file (the rest of the implicit info gets added when we read it)
+            lines = [{k : copy.deepcopy(v) for k, v in self.info[query].items() if k in keys_to_write} for query in self.info['queries']]  # deepcopy so they're plain lists and dicts (rather than pooled sequences)
+            with open(cachefname, 'wb') as outfile:
+                cPickle.dump({'format-version' : binary_cache_format_version, 'glfo-hash' : self.get_glfo_hash(), 'lines' : lines}, outfile, cPickle.HIGHEST_PROTOCOL)
+            return
+
+        with open(cachefname, 'w') as outfile:
+            writer = csv.DictWriter(outfile, utils.annotation_headers + utils.sw_cache_headers)
+            writer.writeheader()
+            for query in self.info['queries']:
+                outline = utils.get_line_for_output(self.info[query])  # convert lists to colon-separated strings and whatnot (doens't modify input dictionary)
+                outline = {k : v for k, v in outline.items() if k in utils.annotation_headers + utils.sw_cache_headers}  # remove the columns we don't want to output
+                writer.writerow(outline)
+
+    # ----------------------------------------------------------------------------------------
+    def add_cached_line(self, line, parsed=False):
+        """ add to self.info the sw info in <line>, as read from a cache file (either --sw-cachefname or --sw-store). If <parsed>, it's from a binary cache file, so it's already been through process_input_line() and doesn't have the per-gene support """
+        if not parsed:
+            utils.process_input_line(line)
+            for region in utils.regions:  # uh... should do this more cleanly at some point
+                del line[region + '_per_gene_support']
+        assert len(line['unique_ids']) == 1
+        utils.add_implicit_info(self.glfo, line, existing_implicit_keys=['cdr3_length', 'naive_seq', 'mut_freqs'] + utils.functional_columns + ['aligned_' + r + '_seqs' for r in utils.regions])
+        self.add_to_info(line)
+        if line['indelfos'][0]['reversed_seq'] != '':
+            self.info['indels'][line['unique_ids'][0]] = line['indelfos'][0]
+
+    # ----------------------------------------------------------------------------------------
+    def get_glfo_keystrs(self):
+        """ list of strings that specify the germline set (genes, sequences, and codon positions) """
+        keystrs = []
+        for region in utils.regions:
+            for gene in sorted(self.glfo['seqs'][region]):
+                keystrs += [gene, self.glfo['seqs'][region][gene]]
+        for region, codon in utils.conserved_codons[self.args.chain].items():
+            keystrs += ['%s:%d' % (gene, pos) for gene, pos in sorted(self.glfo[codon + '-positions'].items())]
+        return keystrs
+
+    # ----------------------------------------------------------------------------------------
+    def get_glfo_hash(self):
+        return hashlib.md5(' '.join(self.get_glfo_keystrs())).hexdigest()
+
+    # ----------------------------------------------------------------------------------------
+    def get_sw_store_key(self, query):
+        """ key for <query> in --sw-store, i.e. a hash of its sequence, the germline set, and the parameters that affect the sw info """
+        if self.sw_store_key_base is None:
+            keystrs = [self.args.chain, str(self.args.initial_match_mismatch), str(self.args.gap_open_penalty), str(self.args.default_v_fuzz), str(self.args.default_d_fuzz), str(self.args.no_indels), str(self.args.skip_unproductive)]
+            keystrs += self.get_glfo_keystrs()
+            self.sw_store_key_base = hashlib.md5(' '.join(keystrs)).hexdigest()
+        return hashlib.md5(self.sw_store_key_base + self.input_info[query]['seqs'][0]).hexdigest()
+
+    # ----------------------------------------------------------------------------------------
+    def read_sw_store(self):
+        """ add to self.info any remaining queries whose sequences are in --sw-store (with the same germline set and parameters), and return the set of them """
+        if not os.path.exists(self.args.sw_store):
+            return set()
+
+        query_keys = {}  # map from store key to the queries with that key (more than one if there's duplicate sequences)
+        for query in self.remaining_queries:
+            key = self.get_sw_store_key(query)
+            if key not in query_keys:
+                query_keys[key] = []
+            query_keys[key].append(query)
+
+        found_queries = set()
+        lockfile = partitioncache.lock(self.args.sw_store, shared=True)
+        with open(self.args.sw_store) as storefile:
+            reader = csv.DictReader(storefile)  # NOTE has to go through the csv module even for lines we don't need, since quoted fields can have newlines in them
+            for storeline in reader:
+                key = storeline['sw_key']
+                if key not in query_keys:
+                    continue
+                for query in query_keys.pop(key):
+                    line = dict(storeline)  # each query gets its own copy, since add_cached_line() modifies it
+                    del line['sw_key']
+                    line['unique_ids'] = query
+                    self.add_cached_line(line)
+                    found_queries.add(query)
+        lockfile.close()
+
+        print '        read sw info for %d / %d queries from %s' % (len(found_queries), len(self.input_info), self.args.sw_store)
+        return found_queries
+
+    # ----------------------------------------------------------------------------------------
+    def write_sw_store(self, queries):
+        """ append the (unpadded) sw info for <queries> to --sw-store """
+        headers = ['sw_key', ] + [h for h in utils.annotation_headers + utils.sw_cache_headers if h not in ['padlefts', 'padrights']]  # padding depends on the other sequences in the sample
+        lockfile = partitioncache.lock(self.args.sw_store)
+        new_file = not os.path.exists(self.args.sw_store) or os.stat(self.args.sw_store).st_size == 0
+        with open(self.args.sw_store, 'a') as storefile:
+            writer = csv.DictWriter(storefile, headers, extrasaction='ignore')
+            if new_file:
+                writer.writeheader()
+            written_keys = set()
+            for query in queries:
+                key = self.get_sw_store_key(query)
+                if key in written_keys:  # duplicate sequence
+                    continue
+                outline = utils.get_line_for_output(self.info[query])
+                outline['sw_key'] = key
+                writer.writerow(outline)
+                written_keys.add(key)
+        lockfile.close()
+        print '        wrote sw info for %d queries to %s' % (len(written_keys), self.args.sw_store)
+
     # ----------------------------------------------------------------------------------------
     def finalize(self, cachefname=None, just_read_cachefile=False):
         print '      info for %d' % len(self.info['queries']),
@@ -163,6 +354,9 @@ class Waterer(object):
         if not just_read_cachefile:  # add padded info to self.info (returns if stuff has already been padded)
             self.pad_seqs_to_same_length()  # NOTE this uses *all the gene matches (not just the best ones), so it has to come before we call pcounter.write(), since that fcn rewrites the germlines removing genes that weren't best matches. But NOTE also that I'm not sure what but that the padding actually *needs* all matches (rather than just all *best* matches)
 
+        if self.seqpool is not None:
+            print '      pooled %d sequences in %.1f MB' % (len(self.seqpool), self.seqpool.n_bytes() / 1e6)
+
         if self.perfplotter is not None:
             self.perfplotter.plot(self.args.plotdir + '/sw', only_csv=self.args.only_csv_plots)
 
@@ -177,17 +371,7 @@ class Waterer(object):
                     self.true_pcounter.write(self.parameter_out_dir + '-true')
 
         if cachefname is not None and not found_germline_changes:
-            print '        writing sw results to %s' % cachefname
-            glutils.write_glfo(cachefname.replace('.csv', '-glfo'), self.glfo)
-            with open(cachefname, 'w') as outfile:
-                writer = csv.DictWriter(outfile, utils.annotation_headers + utils.sw_cache_headers)
-                writer.writeheader()
-                missing_input_keys = set(self.input_info.keys())  # all the keys we originially read from the file
-                for query in self.info['queries']:
-                    missing_input_keys.remove(query)
-                    outline = utils.get_line_for_output(self.info[query])  # convert lists to colon-separated strings and whatnot (doens't modify input dictionary)
-                    outline = {k : v for k, v in outline.items() if k in utils.annotation_headers + utils.sw_cache_headers}  # remove the columns we don't want to output
-                    writer.writerow(outline)
+            self.write_cachefile(cachefname)
 
         sys.stdout.flush()
 
@@ -202,51 +386,49 @@ class Waterer(object):
     def execute_commands(self, base_infname, base_outfname, n_procs):
 
         def get_cmd_str(iproc):
-            return self.get_ig_sw_cmd_str(self.subworkdir(iproc, n_procs), base_infname, base_outfname, n_procs)
+            return self.get_ig_sw_cmd_str(self.subworkdir(iproc, n_procs) + '/' + base_infname, self.subworkdir(iproc, n_procs) + '/' + base_outfname, n_procs)
             # return self.get_vdjalign_cmd_str(self.subworkdir(iproc, n_procs), base_infname, base_outfname, n_procs)
 
         cmdfos = [{'cmd_str' : get_cmd_str(iproc),
                    'workdir' : self.subworkdir(iproc, n_procs),
                    'outfname' : self.subworkdir(iproc, n_procs) + '/' + base_outfname}
                   for iproc in range(n_procs)]
-        utils.run_cmds(cmdfos)
+        straggler_factor = self.args.straggler_factor if (n_procs > 1 and self.args.straggler_factor > 0.) else None
+        executor = utils.run_cmds(cmdfos, straggler_factor=straggler_factor)
+        if executor.n_speculative > 0:
+            print '      %d speculative ig-sw %s (%d finished first)' % (executor.n_speculative, utils.plural_str('duplicate', executor.n_speculative), executor.n_speculative_wins)
 
         for iproc in range(n_procs):
             os.remove(self.subworkdir(iproc, n_procs) + '/' + base_infname)
         sys.stdout.flush()
 
     # ----------------------------------------------------------------------------------------
-    def write_vdjalign_input(self, base_infname, n_procs):
-        n_remaining = len(self.remaining_queries)
-        queries_per_proc = float(n_remaining) / n_procs
-        n_queries_per_proc = int(math.ceil(queries_per_proc))
-        written_queries = set()  # make sure we actually write each query NOTE I should be able to remove this when I work out where they're disappearing to. But they don't seem to be disappearing any more, *sigh*
-        if n_procs == 1:  # double check for rounding problems or whatnot
-            assert n_queries_per_proc == n_remaining
+    def split_queries(self, n_procs):
+        """ split the remaining queries into <n_procs> chunks whose sizes differ by at most one """
+        queries = list(self.remaining_queries)
+        return [queries[iproc * len(queries) / n_procs : (iproc + 1) * len(queries) / n_procs] for iproc in range(n_procs)]
+
+    # ----------------------------------------------------------------------------------------
+    def get_query_seq(self, query_name):
+        assert len(self.input_info[query_name]['seqs']) == 1  # sw can't handle multiple simultaneous sequences, but it's nice to have the same headers/keys everywhere, so we use the plural versions (with lists) even here
+        if query_name in self.info['indels']:
+            return self.info['indels'][query_name]['reversed_seq']  # use the query sequence with shm insertions and deletions reversed
+        return self.input_info[query_name]['seqs'][0]
+
+    # ----------------------------------------------------------------------------------------
+    def write_ig_sw_input(self, outfile, queries):
+        for query_name in queries:
+            outfile.write('>' + query_name + ' NUKES\n' + self.get_query_seq(query_name) + '\n')
+
+    # ----------------------------------------------------------------------------------------
+    def write_vdjalign_input(self, base_infname, query_chunks):
+        n_procs = len(query_chunks)
         for iproc in range(n_procs):
             workdir = self.subworkdir(iproc, n_procs)
             if n_procs > 1:
                 utils.prep_dir(workdir)
             with opener('w')(workdir + '/' + base_infname) as sub_infile:
-                iquery = 0
-                for query_name in self.remaining_queries:  # NOTE this is wasteful to loop of all the remaining queries for each process... but maybe not that wasteful
-                    if iquery >= n_remaining:
-                        break
-                    if iquery < iproc*n_queries_per_proc or iquery >= (iproc + 1)*n_queries_per_proc:  # not for this process
-                        iquery += 1
-                        continue
-                    sub_infile.write('>' + query_name + ' NUKES\n')
-
-                    assert len(self.input_info[query_name]['seqs']) == 1  # sw can't handle multiple simultaneous sequences, but it's nice to have the same headers/keys everywhere, so we use the plural versions (with lists) even here
-                    seq = self.input_info[query_name]['seqs'][0]
-                    if query_name in self.info['indels']:
-                        seq = self.info['indels'][query_name]['reversed_seq']  # use the query sequence with shm insertions and deletions reversed
-                    sub_infile.write(seq + '\n')
-                    written_queries.add(query_name)
-                    iquery += 1
-        not_written = self.remaining_queries - written_queries
-        if len(not_written) > 0:
-            raise Exception('didn\'t write %s to %s' % (':'.join(not_written), self.args.workdir))
+                self.write_ig_sw_input(sub_infile, query_chunks[iproc])
 
     # ----------------------------------------------------------------------------------------
     def get_vdjalign_cmd_str(self, workdir, base_infname, base_outfname, n_procs=None):
@@ -269,9 +451,9 @@ class Waterer(object):
         return cmd_str
 
     # ----------------------------------------------------------------------------------------
-    def get_ig_sw_cmd_str(self, workdir, base_infname, base_outfname, n_procs=None):
+    def get_ig_sw_cmd_str(self, infname, outfname, n_procs=None):
         """
-        Run smith-waterman alignment (from Connor's ighutils package) on the seqs in <base_infname>, and toss all the top matches into <base_outfname>.
+        Run smith-waterman alignment (from Connor's ighutils package) on the seqs in <infname>, and toss all the top matches into <outfname>.
         """
         # large gap-opening penalty: we want *no* gaps in the middle of the alignments
         # match score larger than (negative) mismatch score: we want to *encourage* some level of shm. If they're equal, we tend to end up with short unmutated alignments, which screws everything up
@@ -284,35 +466,186 @@ class Waterer(object):
         cmd_str += ' -m ' + str(match) + ' -u ' + str(mismatch)
         cmd_str += ' -o ' + str(self.gap_open_penalty)
         cmd_str += ' -p ' + self.my_gldir + '/' + self.args.chain + '/'  # NOTE needs the trailing slash
-        cmd_str += ' ' + workdir + '/' + base_infname + ' ' + workdir + '/' + base_outfname
+        cmd_str += ' ' + infname + ' ' + outfname
         return cmd_str
 
     # ----------------------------------------------------------------------------------------
-    def read_output(self, base_outfname, n_procs=1):
+    def start_pool(self, n_procs):
+        """
+        If it's worth it, start a pool of <n_procs> worker processes for summarize_sam_file() and summarize_sam_lines() (otherwise return None).
+        NOTE the workers are forked from the current process, so they see this Waterer as it is right now (which is what we want, since they need this try's indel info, mismatch score, etc.)
+        """
+        if n_procs < 2 or self.debug:  # not worth it for one proc, and we don't want the debug printing from different procs all mixed up
+            return None
+        global pool_waterer
+        pool_waterer = self
+        pool = multiprocessing.Pool(n_procs)
+        pool_waterer = None  # the workers already have their copy
+        return pool
+
+    # ----------------------------------------------------------------------------------------
+    def stream_ig_sw(self, query_chunks, n_max_tries=5):
+        """
+        Run an ig-sw process on each chunk of queries, writing the queries to its stdin (from a separate thread, so neither side blocks on a full pipe) and
+        summarizing the queries in batches as their sam records come out of its stdout (in a pool of worker processes, if there's more than one chunk).
+        This means there's no files in the workdir, and our processing overlaps with the alignment.
+        If an ig-sw process fails, we throw away its chunk's summaries and rerun the chunk in a new process (up to <n_max_tries> times).
+        """
+        pool = self.start_pool(len(query_chunks))  # NOTE start it before the threads and pipes, so the workers don't get copies of them
+        poller = utils.PipePoller()
+        procinfos = []
+        for ichunk in range(len(query_chunks)):
+            procinfo = {'ichunk' : ichunk, 'queries' : query_chunks[ichunk], 'n_procs' : len(query_chunks), 'n_tries' : 0}
+            self.start_ig_sw(procinfo, poller)
+            procinfos.append(procinfo)
+
+        while len(poller.fdinfo) > 0:
+            chunks, finished = poller.read_pipes()  # NOTE don't finish (and maybe restart) anything until we're through this batch of events, since restarting changes the file descriptors
+            for procinfo, fdtype, chunk in chunks:
+                if fdtype == 'out':
+                    del procinfo['output']['out'][:]  # we deal with stdout as it arrives, rather than keeping it around
+                    lines = (procinfo['partial_line'] + chunk).split('\n')
+                    procinfo['partial_line'] = lines.pop()  # last one's either empty or incomplete
+                    self.add_sam_lines(procinfo, lines, pool)
+            for procinfo in finished:  # closed both its pipes, so there's nothing more coming
+                self.add_sam_lines(procinfo, [procinfo['partial_line'], ], pool, finished=True)
+                self.finish_ig_sw(procinfo, poller, n_max_tries)
+
+        self.apply_summaries([summary for procinfo in procinfos for summary in procinfo['summaries']], pool)
+
+    # ----------------------------------------------------------------------------------------
+    def start_ig_sw(self, procinfo, poller):
+        """ start an ig-sw process for the chunk of queries in <procinfo> (see stream_ig_sw()), starting over from scratch if it's a rerun """
+        proc = Popen(self.get_ig_sw_cmd_str('/dev/stdin', '/dev/stdout', procinfo['n_procs']), shell=True, stdin=PIPE, stdout=PIPE, stderr=PIPE, close_fds=True)  # NOTE need close_fds so the other procs don't hold on to this one's stdin
+        feeder = threading.Thread(target=self.feed_ig_sw, args=(proc.stdin, procinfo['queries']))
+        feeder.daemon = True
+        feeder.start()
+        procinfo.update({'proc' : proc, 'feeder' : feeder, 'partial_line' : '', 'references' : [], 'qname' : None, 'batch' : [], 'n_batch_queries' : 0, 'summaries' : [], 'output' : {'out' : [], 'err' : []}})
+        procinfo['n_tries'] += 1
+        poller.register_pipes(procinfo, proc)
+
+    # ----------------------------------------------------------------------------------------
+    def finish_ig_sw(self, procinfo, poller, n_max_tries):
+        """ clean up after an ig-sw process that's closed its output, and rerun its chunk if it failed """
+        proc = procinfo['proc']
+        proc.wait()
+        procinfo['feeder'].join()
+        poller.close_pipes(proc)
+        if proc.returncode == 0:
+            return
+        if procinfo['n_tries'] >= n_max_tries:
+            raise Exception('ig-sw exited with %d (after %d tries):\n%s' % (proc.returncode, procinfo['n_tries'], ''.join(procinfo['output']['err'])))
+        print '    rerunning ig-sw proc %d (exited with %d)' % (procinfo['ichunk'], proc.returncode)
+        self.start_ig_sw(procinfo, poller)  # NOTE this throws away the summaries from the failed process (any that are still running in the pool just get ignored)
+
+    # ----------------------------------------------------------------------------------------
+    def feed_ig_sw(self, stdin, queries):
+        try:
+            self.write_ig_sw_input(stdin, queries)
+            stdin.close()
+        except IOError:  # ig-sw went away, which we'll notice (and complain about) when we check its return code
+            pass
+
+    # ----------------------------------------------------------------------------------------
+    def add_sam_lines(self, procinfo, lines, pool, finished=False):
+        """ add <lines> from an ig-sw process (see stream_ig_sw()) to its current batch, and summarize the batch once it has enough queries (never splitting a query's records between batches) or the process is <finished> """
+        for line in lines:
+            if line == '':
+                continue
+            if line[0] == '@':
+                if line[:3] == '@SQ':
+                    procinfo['references'].append(line.split('\t')[1][3:])  # strip off 'SN:'
+                continue
+            qname = line[ : line.find('\t')]
+            if qname != procinfo['qname']:  # start of a new query
+                if procinfo['n_batch_queries'] >= self.sam_batch_size:
+                    self.summarize_batch(procinfo, pool)
+                procinfo['qname'] = qname
+                procinfo['n_batch_queries'] += 1
+            procinfo['batch'].append(line)
+        if finished and len(procinfo['batch']) > 0:
+            self.summarize_batch(procinfo, pool)
+
+    # ----------------------------------------------------------------------------------------
+    def summarize_batch(self, procinfo, pool):
+        if pool is None:
+            procinfo['summaries'].append(self.summarize_sam_lines(procinfo['references'], procinfo['batch']))
+        else:
+            procinfo['summaries'].append(pool.apply_async(summarize_sam_lines_in_worker, (procinfo['references'], procinfo['batch'])))
+        procinfo['batch'] = []
+        procinfo['n_batch_queries'] = 0
+
+    # ----------------------------------------------------------------------------------------
+    def summarize_sam_lines(self, references, lines):
+        """ return a list of (query name, status, value) summaries (see summarize_query()) for the queries in sam <lines> """
+        reference_indices = {references[iref] : iref for iref in range(len(references))}
+        summaries = []
+        for _, reads in itertools.groupby([SamRead(line, reference_indices) for line in lines], operator.attrgetter('qname')):
+            summaries.append(self.summarize_reads(references, list(reads)))
+        return summaries
+
+    # ----------------------------------------------------------------------------------------
+    def summarize_sam_file(self, fname):
+        """ same as summarize_sam_lines(), but for the queries in sam file <fname> """
+        summaries = []
+        with contextlib.closing(pysam.Samfile(fname)) as sam:  # changed bam to sam because ig-sw outputs sam files
+            grouped = itertools.groupby(iter(sam), operator.attrgetter('qname'))
+            for _, reads in grouped:  # loop over query sequences
+                try:
+                    readlist = list(reads)
+                except:
+                    print 'failed!'
+                    # print 'len', len(readlist)
+                    for thing in reads:
+                        print thing
+                    assert False
+                summaries.append(self.summarize_reads(sam.references, readlist))
+        return summaries
+
+    # ----------------------------------------------------------------------------------------
+    def summarize_reads(self, references, readlist):
+        qinfo = self.read_query(references, readlist)
+        status, value = self.summarize_query(qinfo)
+        return qinfo['name'], status, value
+
+    # ----------------------------------------------------------------------------------------
+    def apply_summaries(self, summary_lists, pool):
+        """ apply each list of query summaries in <summary_lists> (each of which is an AsyncResult, if <pool> isn't None), in order, then close <pool> """
         queries_to_rerun = OrderedDict()  # This is to keep track of every query that we don't add to self.info (i.e. it does *not* include unproductive queries that we ignore/skip entirely because we were told to by a command line argument)
                                           # ...whereas <self.unproductive_queries> is to keep track of the queries that were definitively unproductive (i.e. we removed them from self.remaining_queries) when we were told to skip unproductives by a command line argument
         for reason in ['unproductive', 'no-match', 'weird-annot.', 'nonsense-bounds', 'invalid-codon']:
             queries_to_rerun[reason] = set()
-
         self.new_indels = 0
-        queries_read_from_file = set()  # should be able to remove this, eventually
+        queries_read = set()
+        for summaries in summary_lists:
+            if pool is not None:
+                summaries = summaries.get()
+            for qname, status, value in summaries:
+                self.apply_query_summary(qname, status, value, queries_to_rerun, queries_read)
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+        self.finish_output_reading(queries_to_rerun, queries_read)
+
+    # ----------------------------------------------------------------------------------------
+    def read_output(self, base_outfname, n_procs=1):
+        outfnames = [self.subworkdir(iproc, n_procs) + '/' + base_outfname for iproc in range(n_procs)]
+        pool = self.start_pool(n_procs)
+        if pool is None:
+            summary_lists = [self.summarize_sam_file(fname) for fname in outfnames]
+        else:
+            summary_lists = [pool.apply_async(summarize_sam_file_in_worker, (fname, )) for fname in outfnames]
+        self.apply_summaries(summary_lists, pool)
+
         for iproc in range(n_procs):
-            outfname = self.subworkdir(iproc, n_procs) + '/' + base_outfname
-            with contextlib.closing(pysam.Samfile(outfname)) as sam:  # changed bam to sam because ig-sw outputs sam files
-                grouped = itertools.groupby(iter(sam), operator.attrgetter('qname'))
-                for _, reads in grouped:  # loop over query sequences
-                    try:
-                        readlist = list(reads)
-                    except:
-                        print 'failed!'
-                        # print 'len', len(readlist)
-                        for thing in reads:
-                            print thing
-                        assert False
-                    qinfo = self.read_query(sam.references, readlist)
-                    self.summarize_query(qinfo, queries_to_rerun)  # returns before adding to <self.info> if it thinks we should rerun the query
-                    queries_read_from_file.add(qinfo['name'])
+            workdir = self.subworkdir(iproc, n_procs)
+            os.remove(workdir + '/' + base_outfname)
+            if n_procs > 1:  # still need the top-level workdir
+                os.rmdir(workdir)
 
+    # ----------------------------------------------------------------------------------------
+    def finish_output_reading(self, queries_to_rerun, queries_read_from_file):
         not_read = self.remaining_queries - queries_read_from_file
         if len(not_read) > 0:
             raise Exception('didn\'t read %s from %s' % (':'.join(not_read), self.args.workdir))
@@ -343,12 +676,6 @@ class Waterer(object):
         else:
             print '        all done'
 
-        for iproc in range(n_procs):
-            workdir = self.subworkdir(iproc, n_procs)
-            os.remove(workdir + '/' + base_outfname)
-            if n_procs > 1:  # still need the top-level workdir
-                os.rmdir(workdir)
-
     # ----------------------------------------------------------------------------------------
     def get_indel_info(self, query_name, cigarstr, qrseq, glseq, gene):
         cigars = re.findall('[0-9][0-9]*[A-Z]', cigarstr)  # split cigar string into its parts
@@ -422,13 +749,13 @@ class Waterer(object):
         """ convert bam crap to python dict """
         primary = next((r for r in reads if not r.is_secondary), None)
         qinfo = {
-            'name' : primary.qname,
+            'name' : intern(primary.qname),  # see utils.intern_uids()
             'seq' : primary.seq,
             'matches' : {r : [] for r in utils.regions},
             'qrbounds' : {},
             'glbounds' : {},
             'first_match_qrbounds' : None,  # since sw excises its favorite v match, we have to know this match's boundaries in order to calculate k_d for all the other matches
-            'new_indel' : False
+            'new_indel' : None  # indel info, if we find a new indel (which we then need to reverse and rerun)
         }
         for read in reads:  # loop over the matches found for each query sequence
             # set this match's values
@@ -455,11 +782,9 @@ class Waterer(object):
                     continue
                 if len(qinfo['matches'][region]) == 0:  # if this is the first (best) match for this region, allow indels (otherwise skip the match)
                     if qinfo['name'] not in self.info['indels']:
-                        self.info['indels'][qinfo['name']] = self.get_indel_info(qinfo['name'], read.cigarstring, qinfo['seq'][qrbounds[0] : qrbounds[1]], self.glfo['seqs'][region][gene][glbounds[0] : glbounds[1]], gene)
-                        self.info['indels'][qinfo['name']]['reversed_seq'] = qinfo['seq'][ : qrbounds[0]] + self.info['indels'][qinfo['name']]['reversed_seq'] + qinfo['seq'][qrbounds[1] : ]
-                        self.new_indels += 1
-                        qinfo['new_indel'] = True
-                        return qinfo  # don't process this query any further -- since it's now in the indel info it'll get run next time through
+                        qinfo['new_indel'] = self.get_indel_info(qinfo['name'], read.cigarstring, qinfo['seq'][qrbounds[0] : qrbounds[1]], self.glfo['seqs'][region][gene][glbounds[0] : glbounds[1]], gene)
+                        qinfo['new_indel']['reversed_seq'] = qinfo['seq'][ : qrbounds[0]] + qinfo['new_indel']['reversed_seq'] + qinfo['seq'][qrbounds[1] : ]
+                        return qinfo  # don't process this query any further -- once it's in the indel info (see apply_query_summary()) it'll get run next time through
                     else:
                         if self.debug:
                             print '     ignoring subsequent indels for %s' % qinfo['name']
@@ -676,6 +1001,9 @@ class Waterer(object):
         assert len(infoline['unique_ids'])
         qname = infoline['unique_ids'][0]
 
+        if self.seqpool is not None:
+            infoline = seqpool.PooledLine(self.seqpool, infoline)
+
         self.info['queries'].append(qname)
         self.info[qname] = infoline
 
@@ -692,9 +1020,10 @@ class Waterer(object):
             utils.print_reco_event(self.glfo['seqs'], self.info[qname], extra_str='      ', label=inf_label)
 
         if self.pcounter is not None:
-            self.pcounter.increment(self.info[qname])
+            self.pcounter.increment(self.info[qname], multiplicities=[1 + len(self.duplicates.get(qname, []))])
             if self.true_pcounter is not None:
-                self.true_pcounter.increment(self.reco_info[qname])
+                for uid in [qname] + self.duplicates.get(qname, []):  # duplicates can have different true events
+                    self.true_pcounter.increment(self.reco_info[uid])
         if self.perfplotter is not None:
             if qname in self.info['indels']:
                 print '    skipping performance evaluation of %s because of indels' % qname  # I just have no idea how to handle naive hamming fraction when there's indels
@@ -704,10 +1033,12 @@ class Waterer(object):
         self.remaining_queries.remove(qname)
 
     # ----------------------------------------------------------------------------------------
-    def summarize_query(self, qinfo, queries_to_rerun):
+    def summarize_query(self, qinfo):
         """
         Fiddle with a few things, but mostly decide whether we're satisfied with the current matches.
-        If not, return without calling add_to_info().
+        Returns a (status, value) pair for apply_query_summary(): ('ok', <info line>) if we are, ('new-indel', <indel info>) if we found a new indel,
+        ('skip-unproductive', None) if we're skipping it, or (<reason>, None) if we need to rerun it.
+        NOTE doesn't modify anything but <qinfo>, so it can run in a worker process (see summarize_sam_file()).
         """
         qname = qinfo['name']
         qseq = qinfo['seq']
@@ -719,18 +1050,17 @@ class Waterer(object):
                 for score, gene in qinfo['matches'][region]:  # sorted by decreasing match quality
                     self.print_match(region, gene, score, qseq, qinfo['glbounds'][gene], qinfo['qrbounds'][gene], skipping=False)
 
-        if qinfo['new_indel']:
+        if qinfo['new_indel'] is not None:
             if self.debug:
                 print '    new indel -- rerunning'
-            return
+            return 'new-indel', qinfo['new_indel']
 
         # do we have a match for each region?
         for region in utils.getregions(self.args.chain):
             if len(qinfo['matches'][region]) == 0:
                 if self.debug:
                     print '      no', region, 'match found for', qname  # TODO if no d match found, we should really just assume entire d was eroded
-                queries_to_rerun['no-match'].add(qname)
-                return
+                return 'no-match', None
 
         best = {r : qinfo['matches'][r][0][1] for r in utils.regions}  # already made sure there's at least one match for each region
 
@@ -740,8 +1070,7 @@ class Waterer(object):
             if overlap_status == 'overlap':
                 self.shift_overlapping_boundaries(rpair, qinfo, best)
             elif overlap_status == 'nonsense':
-                queries_to_rerun['nonsense-bounds'].add(qname)
-                return
+                return 'nonsense-bounds', None
             else:
                 assert overlap_status == 'ok'
 
@@ -754,8 +1083,7 @@ class Waterer(object):
             if insertion_length > self.absolute_max_insertion_length or (self.nth_try < 2 and insertion_length > self.max_insertion_length):
                 if self.debug:
                     print '      suspiciously long insertion in %s, rerunning' % qname
-                queries_to_rerun['weird-annot.'].add(qname)
-                return
+                return 'weird-annot.', None
 
         if self.debug == 1:
             print qname
@@ -768,8 +1096,7 @@ class Waterer(object):
             if pos < 0 or pos >= len(qseq):
                 if self.debug:
                     print '      invalid %s codon position (%d in seq of length %d), rerunning' % (codon, pos, len(qseq))
-                queries_to_rerun['invalid-codon'].add(qname)
-                return
+                return 'invalid-codon', None
             codon_positions[region] = pos
 
         # check for unproductive rearrangements
@@ -779,8 +1106,7 @@ class Waterer(object):
         if cdr3_length < 6:  # NOTE six is also hardcoded in utils
             if self.debug:
                 print '      negative cdr3 length %d' % (cdr3_length)
-            queries_to_rerun['invalid-codon'].add(qname)
-            return
+            return 'invalid-codon', None
 
         in_frame_cdr3 = (cdr3_length % 3 == 0)
         stop_codon = utils.is_there_a_stop_codon(qseq, codon_positions['v'])
@@ -798,19 +1124,34 @@ class Waterer(object):
             if self.nth_try < 2 and (not codons_ok or not in_frame_cdr3):  # rerun with higher mismatch score (sometimes unproductiveness is the result of a really screwed up annotation rather than an actual unproductive sequence). Note that stop codons aren't really indicative of screwed up annotations, so they don't count.
                 if self.debug:
                     print '            ...rerunning'
-                queries_to_rerun['unproductive'].add(qname)
-                return
+                return 'unproductive', None
             elif self.args.skip_unproductive:
                 if self.debug:
                     print '            ...skipping'
-                self.unproductive_queries.add(qname)
-                self.remaining_queries.remove(qname)
-                return
+                return 'skip-unproductive', None
             else:
                 pass  # this is here so you don't forget that if neither of the above is true, we fall through and add the query to self.info
 
-        infoline = self.convert_qinfo(qinfo, best, codon_positions)
-        self.add_to_info(infoline)
+        return 'ok', self.convert_qinfo(qinfo, best, codon_positions)
+
+    # ----------------------------------------------------------------------------------------
+    def apply_query_summary(self, qname, status, value, queries_to_rerun, queries_read):
+        """ apply the results of summarize_query() for <qname> to self.info and friends """
+        qname = intern(qname)  # it won't be interned if it came back from a worker process (see utils.intern_uids())
+        queries_read.add(qname)
+        if status == 'ok':
+            value['unique_ids'] = [qname, ]
+            if qname in self.info['indels']:  # make sure it's the same object (which it won't be if <value> came back from a worker process), since padding modifies it
+                value['indelfos'] = [self.info['indels'][qname], ]
+            self.add_to_info(value)
+        elif status == 'new-indel':
+            self.info['indels'][qname] = value
+            self.new_indels += 1
+        elif status == 'skip-unproductive':
+            self.unproductive_queries.add(qname)
+            self.remaining_queries.remove(qname)
+        else:
+            queries_to_rerun[status].add(qname)
 
     # ----------------------------------------------------------------------------------------
     def get_kbounds(self, qinfo, best):
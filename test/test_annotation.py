@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+import os
+import sys
+import copy
+import pickle
+import unittest
+import collections
+sys.path.insert(1, os.path.dirname(os.path.realpath(__file__)).replace('/test', '') + '/python')
+import utils
+
+# ----------------------------------------------------------------------------------------
+class TestAnnotation(unittest.TestCase):
+    def setUp(self):
+        self.dictline = {'unique_ids' : ['a', 'b'], 'seqs' : ['ACGT', 'ACGA'], 'v_gene' : 'IGHV1-2*02', 'v_3p_del' : 2, 'indelfos' : [{'reversed_seq' : ''}, {'reversed_seq' : ''}], 'some_other_key' : [1, 2]}
+        self.line = utils.Annotation(copy.deepcopy(self.dictline))
+
+    def test_dict_interface(self):
+        self.assertEqual(self.line, self.dictline)
+        self.assertEqual(dict(self.line), self.dictline)
+        self.assertEqual(sorted(self.line.keys()), sorted(self.dictline.keys()))
+        self.assertEqual(len(self.line), len(self.dictline))
+        self.assertTrue('v_gene' in self.line and 'd_gene' not in self.line)
+        self.assertEqual(self.line.get('d_gene', 'x'), 'x')
+        self.assertRaises(KeyError, lambda: self.line['d_gene'])
+        self.assertEqual(self.line.pop('v_3p_del'), 2)
+        self.assertFalse('v_3p_del' in self.line)
+        self.assertTrue(isinstance(self.line, collections.MutableMapping))
+
+    def test_shallow_copy(self):  # same as for a dict
+        newline = self.line.copy()
+        newline['v_gene'] = 'IGHV3-23*01'
+        newline['seqs'].append('ACGC')
+        self.assertEqual(self.line['v_gene'], 'IGHV1-2*02')
+        self.assertEqual(self.line['seqs'], ['ACGT', 'ACGA', 'ACGC'])
+
+    def test_alias_then_deepcopy(self):
+        seqs, indelfo = self.line['seqs'], self.line['indelfos'][0]  # references we got before copying
+        newline = copy.deepcopy(self.line)
+        seqs.append('ACGC')
+        indelfo['reversed_seq'] = 'ACGG'
+        self.line['some_other_key'].append(3)
+        self.assertEqual(newline, self.dictline)
+        self.assertEqual(self.line['seqs'], ['ACGT', 'ACGA', 'ACGC'])
+
+        newline['indelfos'][1]['reversed_seq'] = 'TTTT'
+        newline['unique_ids'][0] = 'c'
+        self.assertEqual(self.line['indelfos'][1]['reversed_seq'], '')
+        self.assertEqual(self.line['unique_ids'], ['a', 'b'])
+
+    def test_deepcopy_of_cow_copy(self):
+        cowline = self.line.cow_copy()
+        seqs = self.line['seqs']  # gets its own copy, since it's shared
+        deepline = copy.deepcopy(cowline)
+        seqs.append('ACGC')
+        deepline['seqs'].append('ACGG')
+        self.assertEqual(cowline['seqs'], ['ACGT', 'ACGA'])
+        self.assertEqual(self.line['seqs'], ['ACGT', 'ACGA', 'ACGC'])
+
+    def test_cow_copy(self):
+        cowline = self.line.cow_copy()
+        self.assertEqual(cowline, self.line)
+        cowline['seqs'][0] = 'TTTT'
+        cowline['indelfos'][0]['reversed_seq'] = 'ACGG'
+        cowline['some_other_key'].append(3)
+        self.assertEqual(self.line, self.dictline)
+        self.line['seqs'].append('ACGC')
+        self.assertEqual(cowline['seqs'], ['TTTT', 'ACGA'])
+        self.assertEqual(utils.cow_copy(self.dictline), self.dictline)
+
+    def test_pickle(self):
+        newline = pickle.loads(pickle.dumps(self.line.cow_copy(), -1))
+        self.assertTrue(isinstance(newline, utils.Annotation))
+        self.assertEqual(newline, self.dictline)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+import os
+import sys
+import csv
+import shutil
+import argparse
+import tempfile
+import unittest
+sys.path.insert(1, os.path.dirname(os.path.realpath(__file__)).replace('/test', '') + '/python')
+from partitiondriver import PartitionDriver
+from clusterpath import ClusterPath
+
+header = 'unique_ids,logprob,naive_seq,naive_hfrac,errors\n'
+
+# ----------------------------------------------------------------------------------------
+def read_logprobs(fname):
+    """ cached logprobs in <fname>, merging multiple lines for the same key the way bcrham does """
+    logprobs = {}
+    with open(fname) as cachefile:
+        for line in csv.DictReader(cachefile):
+            if line['logprob'] != '':
+                logprobs[line['unique_ids']] = float(line['logprob'])
+    return logprobs
+
+# ----------------------------------------------------------------------------------------
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.checkpoint_dir = self.tmpdir + '/checkpoint'
+        os.makedirs(self.checkpoint_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def get_driver(self, workdir):
+        """ just the bits of a PartitionDriver that checkpointing uses (the real __init__ needs parameters, germline info, etc.) """
+        os.makedirs(workdir)
+        pdriver = PartitionDriver.__new__(PartitionDriver)
+        pdriver.args = argparse.Namespace(checkpoint_dir=self.checkpoint_dir, seed_unique_id=None, debug=0)
+        pdriver.sw_info = {'queries' : ['a', 'b', 'c']}
+        pdriver.hmm_cachefname = workdir + '/hmm_cached_info.csv'
+        pdriver.hmm_cache = None
+        pdriver.checkpoint_fname = self.checkpoint_dir + '/checkpoint.json'
+        pdriver.checkpoint_cachefname = self.checkpoint_dir + '/hmm_cached_info.csv'
+        pdriver.checkpoint_cache = None
+        pdriver.finished_clusters = []
+        pdriver.unseeded_clusters = set()
+        pdriver.time_to_remove_unseeded_clusters = False
+        pdriver.already_removed_unseeded_clusters = False
+        return pdriver
+
+    def test_resume_keeps_logprobs(self):
+        pdriver = self.get_driver(self.tmpdir + '/work')
+        cpath = ClusterPath()
+        cpath.add_partition([['a'], ['b'], ['c']], -30., 3)
+
+        # first step only calculates the naive seq for a:b...
+        with open(pdriver.hmm_cachefname, 'w') as cachefile:
+            cachefile.write(header + 'a,-10.,AC,,\nb,-11.,AC,,\nc,-12.,GG,,\na:b,,AC,,\n')
+        pdriver.write_checkpoint(cpath, 2, [3, ])
+
+        # ...and the next one its logprob (which gets merged in from the subprocess cache files)
+        subfname = self.tmpdir + '/sub-cache.csv'
+        with open(subfname, 'w') as subfile:
+            subfile.write(header + 'a:b,-18.,AC,,\n')
+        pdriver.get_hmm_cache().append_new_entries(subfname)
+        cpath.add_partition([['a', 'b'], ['c']], -28., 2)
+        pdriver.write_checkpoint(cpath, 1, [3, 2])
+        original_logprobs = read_logprobs(pdriver.hmm_cachefname)
+        self.assertEqual(original_logprobs['a:b'], -18.)
+
+        resumed_pdriver = self.get_driver(self.tmpdir + '/resumed-work')
+        resumed_cpath, n_procs, n_proc_list = resumed_pdriver.read_checkpoint()
+        self.assertEqual(resumed_cpath.partitions[resumed_cpath.i_best], [['a', 'b'], ['c']])
+        self.assertEqual((n_procs, n_proc_list), (1, [3, 2]))
+        self.assertEqual(read_logprobs(resumed_pdriver.hmm_cachefname), original_logprobs)
+
+        # and the subprocesses in the resumed run get them too
+        subset_fname = self.tmpdir + '/subset.csv'
+        resumed_pdriver.hmm_cache.write_subset(subset_fname, ['a', 'b'])
+        self.assertEqual(read_logprobs(subset_fname), {'a' : -10., 'b' : -11., 'a:b' : -18.})
+
+if __name__ == '__main__':
+    unittest.main()
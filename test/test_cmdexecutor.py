@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+sys.path.insert(1, os.path.dirname(os.path.realpath(__file__)).replace('/test', '') + '/python')
+import utils
+
+dbg_str = 'echo calcd: vtb %d fwd %d; echo time: bcrham %.1f'
+
+# ----------------------------------------------------------------------------------------
+class TestSpeculativeExecution(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def get_cmdfos(self, straggler_cmd, duplicate_cmd):
+        """ one command that finishes right away, and one straggler that runs <straggler_cmd> (while its speculative duplicate, which runs in the -spec dir, runs <duplicate_cmd>) """
+        cmdfos = []
+        for iproc, cmd in enumerate([dbg_str % (1, 1, 0.1), 'if pwd | grep -q spec; then %s; else %s; fi' % (duplicate_cmd, straggler_cmd)]):
+            workdir = '%s/proc-%d' % (self.tmpdir, iproc)
+            os.makedirs(workdir)
+            cmdfos.append({'cmd_str' : 'cd %s/ && %s' % (workdir, cmd), 'workdir' : workdir, 'dbgfo' : {}})
+        return cmdfos
+
+    def run_cmds(self, cmdfos):
+        executor = utils.CmdExecutor(straggler_factor=2., min_straggler_time=0.5)
+        for cmdfo in cmdfos:
+            executor.submit(cmdfo)
+        executor.wait()
+        return executor
+
+    def test_duplicate_wins(self):
+        term_fname = self.tmpdir + '/got-term'
+        straggler_cmd = 'trap "touch %s; exit 1" TERM; sleep 60 & wait' % term_fname
+        cmdfos = self.get_cmdfos(straggler_cmd, dbg_str % (3, 4, 0.5))
+        executor = self.run_cmds(cmdfos)
+        self.assertEqual((executor.n_speculative, executor.n_speculative_wins), (1, 1))
+        self.assertTrue(os.path.exists(term_fname))  # the original got a chance to clean up (e.g. srun passing it on to the job step) before being killed
+        self.assertEqual(cmdfos[1]['dbgfo'], {'calcd' : {'vtb' : 3., 'fwd' : 4.}, 'time' : {'bcrham' : 0.5}})
+        self.assertFalse(os.path.exists(cmdfos[1]['workdir'] + '-spec'))
+
+    def test_failed_duplicate(self):
+        cmdfos = self.get_cmdfos('sleep 3; ' + dbg_str % (5, 6, 3.), 'exit 1')
+        executor = self.run_cmds(cmdfos)
+        self.assertEqual((executor.n_speculative, executor.n_speculative_wins), (1, 0))
+        self.assertEqual(cmdfos[1]['dbgfo'], {'calcd' : {'vtb' : 5., 'fwd' : 6.}, 'time' : {'bcrham' : 3.}})
+        self.assertFalse(os.path.exists(cmdfos[1]['workdir'] + '-spec'))
+
+if __name__ == '__main__':
+    unittest.main()
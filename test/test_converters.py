@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+import os
+import sys
+import unittest
+from collections import OrderedDict
+sys.path.insert(1, os.path.dirname(os.path.realpath(__file__)).replace('/test', '') + '/python')
+import utils
+
+# ----------------------------------------------------------------------------------------
+class TestConverters(unittest.TestCase):
+    def setUp(self):
+        self.strline = {'unique_ids' : 'a:b', 'seqs' : 'ACGT:ACGA', 'v_gene' : 'IGHV1-2*02', 'cdr3_length' : '42', 'v_3p_del' : '', 'logprob' : '-123.456789012345',
+                        'mut_freqs' : '0.1:0.25', 'padlefts' : '0:3', 'stops' : 'False:True', 'in_frames' : '1:0', 'indelfos' : '[{\'reversed_seq\': \'\'}, {\'reversed_seq\': \'\'}]',
+                        'v_per_gene_support' : 'IGHV1-2*02:-0.5;IGHV1-18*01:-2.25', 'd_per_gene_support' : ''}
+
+    def test_input(self):
+        line = dict(self.strline)
+        utils.process_input_line(line)
+        self.assertEqual(line['unique_ids'], ['a', 'b'])
+        self.assertTrue(line['unique_ids'][0] is intern('a'))
+        self.assertEqual(line['seqs'], ['ACGT', 'ACGA'])
+        self.assertEqual(line['v_gene'], 'IGHV1-2*02')
+        self.assertEqual((line['cdr3_length'], line['v_3p_del'], line['logprob']), (42, '', -123.456789012345))
+        self.assertEqual((line['mut_freqs'], line['padlefts']), ([0.1, 0.25], [0, 3]))
+        self.assertEqual((line['stops'], line['in_frames']), ([False, True], [True, False]))
+        self.assertEqual(line['indelfos'], [{'reversed_seq' : ''}, {'reversed_seq' : ''}])
+        self.assertEqual(line['v_per_gene_support'], OrderedDict([('IGHV1-2*02', -0.5), ('IGHV1-18*01', -2.25)]))
+        self.assertEqual(line['d_per_gene_support'], ['', ])
+
+    def test_round_trip(self):
+        line = dict(self.strline)
+        utils.process_input_line(line)
+        del line['d_per_gene_support']  # empty string-float pair lists get read as [''], which doesn't get written back (same as before the converters were precompiled)
+        outline = utils.get_line_for_output(line)
+        for key in ['unique_ids', 'seqs', 'v_gene', 'cdr3_length', 'v_3p_del', 'logprob', 'mut_freqs', 'padlefts', 'stops', 'v_per_gene_support']:
+            self.assertEqual(outline[key], self.strline[key])
+        self.assertEqual(outline['in_frames'], 'True:False')  # bools get written as words
+        reread_line = dict(outline)
+        utils.process_input_line(reread_line)
+        self.assertEqual(reread_line, line)
+
+    def test_bad_input(self):
+        self.assertRaises(Exception, utils.process_input_line, {'stops' : 'maybe'})
+        self.assertRaises(Exception, utils.process_input_line, {None : 'x'})
+
+if __name__ == '__main__':
+    unittest.main()
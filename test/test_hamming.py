@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+import os
+import sys
+import random
+import unittest
+sys.path.insert(1, os.path.dirname(os.path.realpath(__file__)).replace('/test', '') + '/python')
+import utils
+
+# ----------------------------------------------------------------------------------------
+class TestBatchHamming(unittest.TestCase):
+    def setUp(self):
+        random.seed(1)
+        self.seqs = [''.join([random.choice('ACGTN') for _ in range(30)]) for _ in range(20)]
+        self.seqs += ['N' * 30, 'A' * 30]  # all ambiguous, so zero length excluding ambiguous bases
+
+    def test_distances(self):
+        for seq in self.seqs:
+            distances, lengths = utils.hamming_distances(seq, self.seqs)
+            self.assertEqual(zip(distances.tolist(), lengths.tolist()), [utils.hamming_distance(seq, s, return_len_excluding_ambig=True) for s in self.seqs])
+
+    def test_fractions(self):
+        encoded = utils.encode_seqs(self.seqs)  # pre-encoded input should give the same results
+        for iseq, seq in enumerate(self.seqs):
+            expected = [utils.hamming_fraction(seq, s) for s in self.seqs]
+            self.assertEqual(utils.hamming_fractions(seq, self.seqs), expected)
+            self.assertEqual(utils.hamming_fractions(encoded[iseq], encoded), expected)
+
+    def test_row_by_row(self):
+        reversed_seqs = list(reversed(self.seqs))
+        expected = [utils.hamming_fraction(s1, s2) for s1, s2 in zip(self.seqs, reversed_seqs)]
+        self.assertEqual(utils.hamming_fractions(utils.encode_seqs(self.seqs), reversed_seqs), expected)
+        self.assertRaises(Exception, utils.hamming_distances, utils.encode_seqs(self.seqs[:3]), self.seqs[:4])
+
+    def test_matrix(self):
+        matrix = utils.hamming_fraction_matrix(self.seqs)
+        for iseq in range(len(self.seqs)):
+            for jseq in range(len(self.seqs)):
+                expected = 0. if iseq == jseq else utils.hamming_fraction(self.seqs[iseq], self.seqs[jseq])
+                self.assertAlmostEqual(matrix[iseq, jseq], expected)
+
+    def test_bad_input(self):
+        self.assertRaises(Exception, utils.encode_seqs, ['ACGT', 'ACG'])
+        self.assertRaises(Exception, utils.encode_seqs, ['ACGT', 'AC-T'])
+        self.assertEqual(utils.hamming_distances('ACGT', ['AC-T', 'ACGG'], extra_bases='-')[0].tolist(), [1, 1])
+        self.assertRaises(Exception, utils.hamming_distances, 'ACGT', ['ACGTA'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+import os
+import sys
+import csv
+import copy
+import unittest
+partis_dir = os.path.dirname(os.path.realpath(__file__)).replace('/test', '')
+sys.path.insert(1, partis_dir + '/python')
+import utils
+import glutils
+
+simu_dir = partis_dir + '/test/reference-results/test'
+
+# ----------------------------------------------------------------------------------------
+class TestGermlineImplicitInfoCache(unittest.TestCase):
+    def setUp(self):
+        self.glfo = glutils.read_glfo(simu_dir + '/parameters/simu/hmm/germline-sets', 'h')
+        self.lines = []
+        with open(simu_dir + '/simu.csv') as simfile:
+            for line in csv.DictReader(simfile):
+                utils.process_input_line(line)
+                line['unique_ids'] = [line['unique_id'], ]
+                line['seqs'] = [line['seq'], ]
+                line['indelfos'] = [line['indelfo'], ]
+                for key in ['unique_id', 'seq', 'indelfo', 'reco_id', 'cdr3_length']:
+                    del line[key]
+                self.lines.append(line)
+                if len(self.lines) >= 5:  # the first four are from the same rearrangement event, and the fifth isn't
+                    break
+        utils.germline_implicit_info_cache.clear()
+
+    def tearDown(self):
+        utils.germline_implicit_info_cache.clear()
+
+    def add_implicit_info(self, line):
+        newline = copy.deepcopy(line)
+        utils.add_implicit_info(self.glfo, newline)
+        return newline
+
+    def test_cache_hits_give_same_info(self):
+        uncached_lines = []
+        for line in self.lines:
+            utils.germline_implicit_info_cache.clear()
+            uncached_lines.append(self.add_implicit_info(line))
+        utils.germline_implicit_info_cache.clear()
+        cached_lines = [self.add_implicit_info(line) for line in self.lines]
+        self.assertEqual(len(utils.germline_implicit_info_cache), 2)  # one for the four lines from the same event, and one for the other
+        self.assertEqual(cached_lines, uncached_lines)
+        self.assertNotEqual(cached_lines[0]['naive_seq'], cached_lines[4]['naive_seq'])
+
+    def test_lines_get_copies(self):
+        line_a, line_b = [self.add_implicit_info(line) for line in self.lines[:2]]
+        line_a['lengths']['v'] += 5  # e.g. padding
+        line_a['codon_positions']['v'] += 5
+        line_a['regional_bounds']['v'] = (0, 0)
+        line_c = self.add_implicit_info(self.lines[2])
+        for newline in [line_b, line_c]:
+            self.assertEqual(newline['lengths']['v'], line_a['lengths']['v'] - 5)
+            self.assertEqual(newline['codon_positions']['v'], line_a['codon_positions']['v'] - 5)
+            self.assertNotEqual(newline['regional_bounds']['v'], (0, 0))
+
+    def test_cache_size_limit(self):
+        original_max_size = utils.max_germline_implicit_info_cache_size
+        utils.max_germline_implicit_info_cache_size = 1
+        try:
+            first_line = self.add_implicit_info(self.lines[0])
+            self.add_implicit_info(self.lines[4])
+            self.assertEqual(len(utils.germline_implicit_info_cache), 1)
+            self.assertEqual(self.add_implicit_info(self.lines[0]), first_line)
+        finally:
+            utils.max_germline_implicit_info_cache_size = original_max_size
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+import os
+import sys
+import csv
+import unittest
+partis_dir = os.path.dirname(os.path.realpath(__file__)).replace('/test', '')
+sys.path.insert(1, partis_dir + '/python')
+import utils
+import glutils
+from parametercounter import ParameterCounter
+
+simu_dir = partis_dir + '/test/reference-results/test'
+
+# ----------------------------------------------------------------------------------------
+class TestMultiplicities(unittest.TestCase):
+    def setUp(self):
+        self.glfo = glutils.read_glfo(simu_dir + '/parameters/simu/hmm/germline-sets', 'h')
+        self.lines = []
+        with open(simu_dir + '/simu.csv') as simfile:
+            for line in csv.DictReader(simfile):
+                utils.process_input_line(line)
+                line['unique_ids'] = [line['unique_id'], ]
+                line['seqs'] = [line['seq'], ]
+                line['indelfos'] = [line['indelfo'], ]
+                for key in ['unique_id', 'seq', 'indelfo', 'reco_id', 'cdr3_length']:
+                    del line[key]
+                utils.add_implicit_info(self.glfo, line)
+                self.lines.append(line)
+                if len(self.lines) >= 5:
+                    break
+
+    def assertSameCounts(self, pc_a, pc_b):
+        self.assertEqual(pc_a.counts, pc_b.counts)
+        self.assertEqual((pc_a.reco_total, pc_a.mute_total), (pc_b.reco_total, pc_b.mute_total))
+        self.assertEqual(pc_a.mfreqer.counts, pc_b.mfreqer.counts)
+        for key in pc_a.mfreqer.mean_rates:
+            self.assertEqual(pc_a.mfreqer.mean_rates[key].bin_contents, pc_b.mfreqer.mean_rates[key].bin_contents)
+            self.assertEqual(pc_a.mfreqer.mean_rates[key].errors, pc_b.mfreqer.mean_rates[key].errors)
+
+    def test_single_seq_lines(self):  # i.e. what sw and single-sequence hmm annotations give you with --collapse-duplicate-sequences
+        multiplicities = [3, 1, 2, 1, 4]
+        weighted, repeated = ParameterCounter(self.glfo, None), ParameterCounter(self.glfo, None)
+        for line, multiplicity in zip(self.lines, multiplicities):
+            weighted.increment(line, multiplicities=[multiplicity])
+            for _ in range(multiplicity):
+                repeated.increment(line)
+        self.assertSameCounts(weighted, repeated)
+
+if __name__ == '__main__':
+    unittest.main()
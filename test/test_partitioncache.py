@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+sys.path.insert(1, os.path.dirname(os.path.realpath(__file__)).replace('/test', '') + '/python')
+from partitioncache import PartitionCache
+
+header = 'unique_ids,logprob,naive_seq,naive_hfrac,errors\n'
+
+# ----------------------------------------------------------------------------------------
+class TestPartitionCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_file(self, name, lines):
+        fname = self.tmpdir + '/' + name
+        with open(fname, 'w') as cachefile:
+            cachefile.write(header + ''.join(lines))
+        return fname
+
+    def read_lines(self, fname):
+        with open(fname) as cachefile:
+            return cachefile.readlines()[1:]
+
+    def test_logprob_line_after_naive_seq_line(self):
+        cache = PartitionCache(self.write_file('cache.csv', ['a,,ACGT,,\n']))
+        n_new = cache.append_new_entries(self.write_file('new.csv', ['a,-10.5,ACGT,,\n']))
+        self.assertEqual(n_new, 1)
+        self.assertEqual(self.read_lines(cache.fname), ['a,,ACGT,,\n', 'a,-10.5,ACGT,,\n'])
+        self.assertEqual(len(cache), 1)
+
+        # a line with nothing new doesn't get appended
+        n_new = cache.append_new_entries(self.write_file('new2.csv', ['a,-10.5,,,\n', 'a,,ACGT,,\n']))
+        self.assertEqual(n_new, 0)
+
+        # subprocesses (and resumed runs) get both lines, and bcrham merges them
+        cache.write_subset(self.tmpdir + '/subset.csv', ['a', 'b'])
+        self.assertEqual(self.read_lines(self.tmpdir + '/subset.csv'), ['a,,ACGT,,\n', 'a,-10.5,ACGT,,\n'])
+
+        # and we get the same thing reading it back in from scratch
+        reread_cache = PartitionCache(cache.fname)
+        self.assertEqual(reread_cache.offsets, cache.offsets)
+        self.assertEqual(reread_cache.field_masks, cache.field_masks)
+
+    def test_write_subset_requires_all_uids(self):
+        cache = PartitionCache(self.write_file('cache.csv', ['a,-1.,,,\n', 'b,-2.,,,\n', 'a:b,-3.,AC,,\n', '"c",,GG,,\n']))
+        self.assertEqual(cache.write_subset(self.tmpdir + '/subset.csv', ['a', 'c']), 2)
+        self.assertEqual(self.read_lines(self.tmpdir + '/subset.csv'), ['a,-1.,,,\n', '"c",,GG,,\n'])
+
+    def test_compact_merges_lines(self):
+        cache = PartitionCache(self.write_file('cache.csv', ['a,,ACGT,,\n', 'b,-2.,,,\n', 'a,-10.5,ACGT,,\n', 'b,-2.,,,\n', 'a:b,,,,no_path\n', '"c",,GG,,\n']))
+        cache.compact()
+        self.assertEqual(self.read_lines(cache.fname), ['a,-10.5,ACGT,,\n', 'b,-2.,,,\n', 'a:b,,,,no_path\n', 'c,,GG,,\n'])
+        self.assertEqual(len(cache), 4)
+
+        cache.compact(keep_fcn=lambda key: 'b' not in key.split(':'))
+        self.assertEqual(self.read_lines(cache.fname), ['a,-10.5,ACGT,,\n', 'c,,GG,,\n'])
+        self.assertEqual(cache.append_new_entries(self.write_file('new.csv', ['a,-10.5,,,\n', 'c,-3.,,,\n'])), 1)
+
+    def test_get_logprob(self):
+        cache = PartitionCache(self.write_file('cache.csv', ['a,,ACGT,,\n', 'a,-10.5,ACGT,,\n', 'b,,GG,,\n', 'a:b,,,,no_path\n']))
+        self.assertEqual(cache.get_logprob('a'), -10.5)
+        self.assertEqual(cache.get_logprob('b'), None)
+        self.assertEqual(cache.get_logprob('a:b'), float('-inf'))
+        self.assertEqual(cache.get_logprob('c'), None)
+
+if __name__ == '__main__':
+    unittest.main()
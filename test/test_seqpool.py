@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+import os
+import sys
+import copy
+import pickle
+import unittest
+sys.path.insert(1, os.path.dirname(os.path.realpath(__file__)).replace('/test', '') + '/python')
+import numpy
+import utils
+import seqpool
+from seqpool import SeqPool, PooledLine
+
+# ----------------------------------------------------------------------------------------
+class TestSeqPool(unittest.TestCase):
+    def test_add_and_get(self):
+        pool = SeqPool()
+        seqs = ['ACGTACGTA', 'AC', '', 'ACGNNNTT', 'ACG-T.A', 'TTTT']
+        indices = [pool.add(seq) for seq in seqs]
+        self.assertEqual([pool.get(i) for i in indices], seqs)
+        self.assertEqual(list(pool.is_packed), [1, 1, 1, 0, 0, 1])
+        self.assertEqual(len(pool), len(seqs))
+
+        self.assertEqual(pool.add('ACGNNNTT', dedup=True), len(seqs))  # wasn't added with dedup, so we get a new one...
+        self.assertEqual(pool.add('ACGNNNTT', dedup=True), len(seqs))  # ...but only the first time
+        self.assertEqual(pool.add('ACGTACGTA'), len(seqs) + 1)
+        self.assertEqual(len(pool), len(seqs) + 2)
+
+    def test_encode(self):
+        pool = SeqPool()
+        seqs = ['ACGTACGTA', 'ACGNNNTTA', 'TTTTGGGGC', 'ACGTACGTA']
+        indices = [pool.add(seq) for seq in seqs]
+        pool.add('AC')
+        self.assertTrue(numpy.array_equal(pool.encode(indices), utils.encode_seqs(seqs)))
+        self.assertTrue(numpy.array_equal(pool.encode(indices[2:3]), utils.encode_seqs(seqs[2:3])))
+        self.assertEqual(pool.encode([]).shape, (0, 0))
+        self.assertRaises(Exception, pool.encode, indices + [len(seqs)])  # different length
+        self.assertRaises(Exception, pool.encode, [pool.add('ACG-TACGT')])  # not in the hamming alphabet
+
+# ----------------------------------------------------------------------------------------
+class TestPooledLine(unittest.TestCase):
+    def setUp(self):
+        self.dictline = {'unique_ids' : ['a', 'b'], 'seqs' : ['ACGTAC', 'ACGNAC'], 'naive_seq' : 'ACGTAC', 'v_gene' : 'IGHV1-2*02', 'v_qr_seqs' : ['ACG', 'ACG']}
+        self.line = PooledLine(SeqPool(), copy.deepcopy(self.dictline))
+
+    def test_dict_interface(self):
+        self.assertEqual(self.line, self.dictline)
+        self.assertEqual(dict(self.line), self.dictline)  # i.e. not the pool indices
+        updated = {}
+        updated.update(self.line)
+        self.assertEqual(updated, self.dictline)
+        self.assertEqual(self.line.copy(), self.dictline)
+        self.assertEqual(sorted(self.line.items()), sorted(self.dictline.items()))
+        self.assertEqual(self.line.get('d_gene'), None)
+        self.assertEqual(self.line.pop('naive_seq'), 'ACGTAC')
+        self.assertFalse('naive_seq' in self.line)
+
+    def test_modify_seqs(self):
+        self.line['seqs'][1] = 'TTTTTT'
+        self.line['v_qr_seqs'].append('AAA')
+        self.line['naive_seq'] = 'GGGGGG'
+        self.assertEqual(self.line['seqs'], ['ACGTAC', 'TTTTTT'])
+        self.assertEqual(self.line['v_qr_seqs'], ['ACG', 'ACG', 'AAA'])
+        self.assertEqual(self.line['naive_seq'], 'GGGGGG')
+        seqs = self.line['seqs']  # modifying the list in place writes it back to the line...
+        seqs.append('CCCCCC')
+        self.assertEqual(self.line['seqs'], ['ACGTAC', 'TTTTTT', 'CCCCCC'])
+        seqs = seqs + ['GGGGGG']  # ...but making a new one doesn't
+        self.assertEqual(len(self.line['seqs']), 3)
+
+    def test_encode_lines(self):
+        lines = [self.line, PooledLine(self.line.pool, {'seqs' : ['ACGAAC'], 'naive_seq' : 'TCGTAC'})]
+        self.assertEqual(seqpool.get_pool_indices(lines, 'seqs', iseq=0), [self.line.line['seqs'][0], lines[1].line['seqs'][0]])
+        self.assertEqual(seqpool.seq_length(lines[1], 'naive_seq'), 6)
+        self.assertTrue(numpy.array_equal(seqpool.encode_line_seqs(lines, 'naive_seq'), utils.encode_seqs(['ACGTAC', 'TCGTAC'])))
+        self.assertTrue(numpy.array_equal(seqpool.encode_line_seqs(lines, 'seqs', iseq=0), utils.encode_seqs(['ACGTAC', 'ACGAAC'])))
+        dictlines = [dict(line) for line in lines]  # regular dicts go through the strings
+        self.assertEqual(seqpool.get_pool_indices(dictlines, 'naive_seq'), None)
+        self.assertTrue(numpy.array_equal(seqpool.encode_line_seqs(dictlines, 'naive_seq'), utils.encode_seqs(['ACGTAC', 'TCGTAC'])))
+
+    def test_copies_are_dicts(self):
+        for newline in [copy.deepcopy(self.line), pickle.loads(pickle.dumps(self.line, -1)), self.line.copy()]:
+            self.assertTrue(type(newline) is dict and type(newline['seqs']) is list)
+            self.assertEqual(newline, self.dictline)
+            newline['seqs'][0] = 'TTTTTT'  # the sequences in the copies are new lists, even for the shallow copy
+            self.assertEqual(self.line['seqs'][0], 'ACGTAC')
+
+if __name__ == '__main__':
+    unittest.main()
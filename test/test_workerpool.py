@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+sys.path.insert(1, os.path.dirname(os.path.realpath(__file__)).replace('/test', '') + '/python')
+import utils
+
+# runs the job on its command line, then one job per line on stdin, like bcrham --worker
+worker_script = """
+run_job() {
+    echo calcd: vtb 1 fwd 2; echo time: bcrham 0.1
+    if [ "$2" == die ] || ( [ "$2" == die-once ] && [ ! -f $1.died ] ); then
+        touch $1.died
+        exit 1
+    fi
+    touch $1
+}
+run_job $1 $2
+echo worker done
+while read outfname mode; do
+    run_job $outfname $mode
+    echo worker done
+done
+"""
+
+# ----------------------------------------------------------------------------------------
+class TestWorkerPool(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.script = self.tmpdir + '/worker.sh'
+        with open(self.script, 'w') as scriptfile:
+            scriptfile.write(worker_script)
+        self.pool = utils.WorkerPool('--worker', 'worker done')
+
+    def tearDown(self):
+        self.pool.close()
+        shutil.rmtree(self.tmpdir)
+
+    def get_cmdfos(self, modes, istep):
+        cmdfos = []
+        for iproc, mode in enumerate(modes):
+            outfname = '%s/step-%d-proc-%d.out' % (self.tmpdir, istep, iproc)
+            job_str = '%s %s' % (outfname, mode)
+            cmdfos.append({'cmd_str' : 'bash %s %s' % (self.script, job_str), 'job_str' : job_str, 'workdir' : self.tmpdir, 'outfname' : outfname, 'dbgfo' : {}})
+        return cmdfos
+
+    def test_workers_are_reused(self):
+        for istep, n_procs in enumerate([3, 3, 2]):
+            cmdfos = self.get_cmdfos(['ok' for _ in range(n_procs)], istep)
+            self.pool.run(cmdfos)
+            for cmdfo in cmdfos:
+                self.assertTrue(os.path.exists(cmdfo['outfname']))
+                self.assertEqual(cmdfo['dbgfo'], {'calcd' : {'vtb' : 1., 'fwd' : 2.}, 'time' : {'bcrham' : 0.1}})
+        self.assertEqual(self.pool.n_workers_started, 3)
+        self.assertEqual(len(self.pool.workers), 2)
+
+    def test_dead_worker_gets_restarted(self):
+        self.pool.run(self.get_cmdfos(['ok', 'ok'], 0))
+        cmdfos = self.get_cmdfos(['ok', 'die-once'], 1)
+        self.pool.run(cmdfos)
+        self.assertTrue(os.path.exists(cmdfos[1]['outfname']))
+        self.assertEqual(cmdfos[1]['n_tries'], 2)
+        self.assertEqual(self.pool.n_workers_started, 3)
+        self.pool.run(self.get_cmdfos(['ok', 'ok'], 2))  # the replacement keeps going
+        self.assertEqual(self.pool.n_workers_started, 3)
+
+    def test_give_up(self):
+        self.assertRaises(Exception, self.pool.run, self.get_cmdfos(['ok', 'die'], 0))
+
+if __name__ == '__main__':
+    unittest.main()